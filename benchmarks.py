@@ -0,0 +1,211 @@
+"""
+Benchmarks for the slow parts of the pipeline, run on made up lakes (see toolbox/synthetic.py) so every machine
+times the exact same work. Every case is timed a few times and the best time is kept. The results get
+written to a json file and compared against a stored baseline: anything that got a lot slower fails the run. The
+baseline keeps the python, numpy and pandas versions it was recorded with, and if those don't match this setup the
+slowdowns are only reported, since they could just be the upgrade.
+
+    python benchmarks.py                    # run and compare against benchmark_baseline.json
+    python benchmarks.py --update-baseline  # run and make these numbers the new baseline
+    python benchmarks.py --quick            # only the small sizes
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from toolbox.files import read_polygons_from_csv, preprocess_polygons
+from toolbox.polygons import (convex_hull_diameter, has_length_within_polygon_exact, has_length_within_polygon_naive,
+                              raw_vertices_to_df)
+from toolbox.statistics import generate_positive_identification_statistics
+from toolbox.synthetic import GENERATORS, synthetic_lakes, write_gee_csv
+from toolbox.visualization import map_lakes, map_lakes_grouped
+
+BASELINE_PATH = "benchmark_baseline.json"
+ENVIRONMENT_KEYS = ("python", "numpy", "pandas", "machine")  # timings from different setups aren't comparable
+
+
+def best_time(function, repeat=3):
+    """
+    Returns: the fastest of repeat runs of function, in seconds. The fastest one is the one with the least noise.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def silently(function, *args, **kwargs):
+    # a few of the functions print stop_watch lines and stats, keep them out of the benchmark output
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                function(*args, **kwargs)
+            finally:
+                sys.stdout = stdout
+    return run
+
+
+def engine_cases(vertex_counts, repeat, exact_max_vertices=400):
+    """
+    Times the engines on one lake of each shape and size.
+
+    The naive engine turns down any target longer than the hull diameter before it looks at a single pair, so it
+    gets 0.9 of the diameter, which it has to find a pair for. Its worst case, every pair checked, is timed on its
+    own with the long chords first search turned off and a target no pair reaches. The exact engine doesn't have
+    that shortcut, so it gets a target just longer than the lake and has to rule out every chord. It gets slow fast
+    on stars (every tip sees every other tip), so it only runs up to exact_max_vertices.
+    """
+    results = {}
+    for shape in GENERATORS:
+        for num_vertices in vertex_counts:
+            vertices = synthetic_lakes(shape, 1, num_vertices)[0]
+            diameter = convex_hull_diameter(vertices)
+            cases = {
+                f"has_length_within_polygon_naive/{shape}/{num_vertices}":
+                    lambda: has_length_within_polygon_naive(vertices, 0.9 * diameter),
+                f"has_length_within_polygon_naive_every_pair/{shape}/{num_vertices}":
+                    lambda: has_length_within_polygon_naive(vertices, 1.01 * diameter, ordered=False),
+            }
+            if num_vertices <= exact_max_vertices:
+                cases[f"has_length_within_polygon_exact/{shape}/{num_vertices}"] = \
+                    lambda: has_length_within_polygon_exact(vertices, 1.01 * diameter)
+            for case, run in cases.items():
+                results[case] = best_time(run, repeat)
+    return results
+
+
+def file_cases(polygon_counts, directory, repeat):
+    """
+    Times reading a GEE export and the dataframe version of the same parsing.
+    """
+    results = {}
+    for num_polygons in polygon_counts:
+        path = os.path.join(directory, f"lakes_{num_polygons}.csv")
+        write_gee_csv(path, synthetic_lakes("jagged", num_polygons, 200, seed=num_polygons))
+        raw = pd.read_csv(path)
+        results[f"read_polygons_from_csv/{num_polygons}"] = best_time(lambda: read_polygons_from_csv(path), repeat)
+        results[f"preprocess_polygons/{num_polygons}"] = best_time(lambda: preprocess_polygons(raw), repeat)
+    return results
+
+
+def pipeline_cases(polygon_counts, directory, repeat):
+    """
+    Times matching the ground truth markers against the outlines, and drawing the map.
+    """
+    results = {}
+    for num_polygons in polygon_counts:
+        outline_df = raw_vertices_to_df(synthetic_lakes("convex", num_polygons, 60, seed=num_polygons))
+
+        # one marker in the middle of every lake and one off to the side of it
+        centers = outline_df.groupby('Polygon')[['Latitude', 'Longitude']].mean().to_numpy()
+        points = np.vstack([centers, centers + 0.02])
+        marker_df = pd.DataFrame({'Lat': points[:, 0], 'Long': points[:, 1], 'LakeName': 'synthetic'})
+
+        results[f"generate_positive_identification_statistics/{num_polygons}"] = best_time(
+            silently(generate_positive_identification_statistics, outline_df, marker_df.copy()), repeat)
+
+        marker_df['detected'] = np.arange(len(marker_df)) < num_polygons
+        map_file_name = os.path.join(directory, "lake_map.html")
+        results[f"map_lakes/{num_polygons}"] = best_time(
+            silently(map_lakes, outline_df, marker_df, map_file_name=map_file_name), repeat)
+        results[f"map_lakes_grouped/{num_polygons}"] = best_time(
+            silently(map_lakes_grouped, outline_df, marker_df, map_file_name=map_file_name), repeat)
+    return results
+
+
+def run_benchmarks(quick=False, repeat=3) -> dict:
+    vertex_counts = [100, 400] if quick else [100, 400, 1600]
+    polygon_counts = [100] if quick else [100, 1000]
+
+    with tempfile.TemporaryDirectory() as directory:
+        timings = {}
+        timings.update(engine_cases(vertex_counts, repeat))
+        timings.update(file_cases(polygon_counts, directory, repeat))
+        timings.update(pipeline_cases(polygon_counts, directory, repeat))
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "timings": timings,
+    }
+
+
+def compare_to_baseline(timings: dict, baseline: dict, tolerance=0.5, slack_seconds=0.005) -> list:
+    """
+    Finds the cases that got slower than the baseline by more than tolerance (0.5 = 50%). Really fast cases are
+    mostly noise, so they also have to be at least slack_seconds slower to count.
+
+    Returns: list of (case, baseline seconds, new seconds) for every regression
+    """
+    regressions = []
+    for case, seconds in timings.items():
+        before = baseline.get(case)
+        if before is not None and seconds > before * (1 + tolerance) and seconds - before > slack_seconds:
+            regressions.append((case, before, seconds))
+    return regressions
+
+
+def environment_differences(results: dict, baseline: dict) -> list:
+    """
+    Finds where the setup the baseline was recorded on differs from this one (python, numpy, pandas, machine). A
+    numpy or pandas upgrade can move the timings by more than the tolerance on its own, so those runs can't be
+    judged against the baseline.
+
+    Returns: list of (key, baseline value, this run's value) for everything that differs
+    """
+    return [(key, baseline.get(key), results.get(key)) for key in ENVIRONMENT_KEYS
+            if baseline.get(key) != results.get(key)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="the baseline to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="save these results as the baseline")
+    parser.add_argument("--quick", action="store_true", help="only run the small sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="how many times to time each case")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="how much slower counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.quick, args.repeat)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    for case, seconds in results["timings"].items():
+        print(f"{case:<60} {1000 * seconds:>10.2f} ms")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        differences = environment_differences(results, baseline)
+        for key, recorded, running in differences:
+            print(f"WARNING the baseline was recorded with {key} {recorded}, this is {key} {running}")
+
+        regressions = compare_to_baseline(results["timings"], baseline["timings"], args.tolerance)
+        label = "SLOWER" if differences else "REGRESSION"
+        for case, before, after in regressions:
+            print(f"{label} {case}: {1000 * before:.2f} ms -> {1000 * after:.2f} ms")
+        if differences:
+            print(f"Not failing on {args.baseline} since it's from a different setup, "
+                  f"run with --update-baseline to record one for this setup.")
+        elif regressions:
+            sys.exit(1)
+        else:
+            print(f"No regressions against {args.baseline}.")
+    else:
+        print(f"No baseline at {args.baseline}, run with --update-baseline to make one.")
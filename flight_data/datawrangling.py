@@ -1,39 +1,18 @@
 """
 data cleaning and wrangling code to clean the test data
-"""
-
-import pandas as pd
-
-df = pd.read_csv('lakes.csv')
-print(df)
-
-df['floatplanes'] = 1
-
-apts = pd.read_csv('airports.csv')
-print(apts)
-
-
-def dms_to_decimal(dms):
-    parts = dms.split('-')
-    degrees, minutes, seconds_direction = parts[0], parts[1], parts[2]
-    seconds, direction = seconds_direction[:-1], seconds_direction[-1]
-
-    decimal = float(degrees) + float(minutes) / 60 + float(seconds) / 3600
-
-    # Adjust for direction
-    if direction in ['S', 'W']:
-        decimal *= -1
-
-    return decimal
-
-apts['Lat'] = apts['ARPLatitude'].apply(dms_to_decimal)
-apts['Long'] = apts['ARPLongitude'].apply(dms_to_decimal)
 
+The parsing lives in toolbox/ingest.py now (main.py loads the source of truth from there and caches it), this just
+writes the table out as ground_truth.csv for anyone who wants to look at it. The hand edits from cleaned.csv are applied
+from ground_truth_overrides.csv (see the notes at the top of toolbox/ingest.py and in readme.md).
+"""
 
-apts['floatplanes'] = apts['Type'].apply(lambda r: 1 if r == "SEAPLANE BASE" else 0)
-apts['LakeName'] = apts['FacilityName']
+import os
+import sys
 
-wdf = pd.concat([df[['Lat', 'Long', 'floatplanes', 'LakeName']], apts[['Lat', 'Long', 'floatplanes', "LakeName"]]])
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolbox.ingest import FLIGHT_DATA, load_ground_truth  # noqa: E402
 
-wdf[['Lat', 'Long', 'floatplanes', "LakeName"]].to_csv("cleaned.csv", index=False)
+wdf = load_ground_truth()
+print(wdf)
 
+wdf.to_csv(os.path.join(FLIGHT_DATA, "ground_truth.csv"), index=False)
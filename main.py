@@ -7,118 +7,488 @@
 
 
 import os
-from copy import deepcopy
+from collections import Counter
 import pandas as pd
 import numpy as np
-from toolbox.files import read_polygons_from_csv, export_polygons_from_raw_vertices
-from toolbox.polygons import (has_length_within_polygon_naive, average_vertice_location,
-                              find_most_common_id_and_remove, is_point_in_polygon,
-                              edge_lengths_of_polygon, lat_lon_to_meters, raw_vertices_to_df)
-
-from toolbox.visualization import map_lakes
+from toolbox.files import (read_polygons_from_csv, iter_polygons_from_csv, export_polygons_from_raw_vertices,
+                           export_polygons_npy, export_results_npy)
+from toolbox.polygons import (LANDABILITY_ENGINES, find_most_common_id_and_remove, points_in_polygon,
+                              polygons_in_region, raw_vertices_to_df)
+from toolbox.landability import (RESULT_COLUMNS, evaluate_polygons, evaluate_polygon_lengths, print_summary,
+                                 verdicts_for_target)
+from toolbox.parallel import evaluate_stores_in_parallel
+from toolbox.store import PolygonStore
+from toolbox.cache import ResultCache
+from toolbox.tiling import polygons_in_tiles, tile_hash, tiles_in_region
+from toolbox.manifest import (assign_id_block, file_hash, load_manifest, outputs_current, record_file, save_manifest,
+                              save_outputs_stamp, stale_files)
+from toolbox.visualization import map_lakes_grouped
 from toolbox.statistics import generate_positive_identification_statistics
+from toolbox.bases import nearest_base_per_polygon
+from toolbox.ingest import (FLIGHTS_PATH, filter_ground_truth, ground_truth_key, load_ground_truth, read_faa_facilities,
+                            read_flight_destinations)
+from toolbox.shapes import detection_by_size, match_destinations
 from toolbox.debugging_tools import stop_watch
+from toolbox.metrics import METRICS
 from toolbox.constants import MATSU_REGION_OF_INTEREST as roi
 
 
 @stop_watch
 def main_function(target_meters=500.0,
                   polygons_path='polygons_unprocessed.csv',
-                  results_path=None,  # use this to export the results to .csv
+                  results_path=None,  # use this to export the results to .csv (or .npy)
                   visualize=False,  # use this to visualize the algorithm (not working yet)
                   max_polygons=None,
                   print_info=False,
-                  export_successful=False) -> pd.DataFrame:
+                  export_successful=False,
+                  engine='naive',
+                  stream=False,
+                  chunksize=10_000,
+                  region=None,
+                  cache_path=None,
+                  simplify_meters=None,
+                  budget_seconds=None) -> pd.DataFrame:
     """
-    Determines which polygons have a straight line distance of at least target_miles contained within them.
-    Assumes that polygon vertices represent lattitudes and longitudes. Distances based on haversine formula.
-    THIS IS A NAIVE SOLUTION. It ISN'T accurate for concave polygons. For example: the case of a thin 'S' shaped polygon.
+    Determines which polygons have a straight line of at least target_meters contained within them. Polygon vertices
+    are latitudes and longitudes, distances are measured in each polygon's local meters (see PolygonStore.in_meters).
+    The check itself is picked with engine: the naive vertex pair check isn't accurate for concave polygons (a thin
+    'S' shaped lake can pass on a line that crosses land), the exact engine is. Polygons outside region, cached
+    verdicts, simplification and a time budget all happen around whichever engine is used.
 
     Parameters:
-        export_successful: flag to tell the algorithm to export the successful vertices
         target_meters (float): the distance that we are checking for within the polygon
         polygons_path (str): file path to file containing csv polygons. 
-        results_path (str): file path to file containing the results.
+        results_path (str): file path to file containing the results. A path ending in .npy writes binary files
+            instead of csvs: the results as a .npy of records and the passing vertices as a bundle of .npy arrays
+            in a folder next to it, see export_results_npy and export_polygons_npy.
         visualize (bool): If True, the algorithm will be visualized.
         max_polygons (int): The maximum number of polygons to load.
         print_info (bool): If True, print the information on each of the polygons; otherwise, only write them to the results file.
+        export_successful (bool): If True, write the vertices of the passing polygons next to the results file.
+        engine (str): which landability check to use, a key of LANDABILITY_ENGINES. 'naive' is the original vertex
+            pair check, 'exact' only accepts segments that stay inside the polygon (concave shapes and holes),
+            'raster' screens the polygon on a grid first and falls back to 'exact' when the grid can't decide.
+        stream (bool): If True, read the csv chunksize rows at a time and write the results (and the passing
+            vertices) as each chunk is done, so memory stays flat no matter how big the file is. Needs results_path.
+        chunksize (int): how many csv rows to read at a time in stream mode.
+        region (list[tuple]): optional (lat, lon) vertices of a region of interest, polygons entirely outside of it
+            are dropped before the landability check and don't show up in the results.
+        cache_path (str): optional path of a ResultCache file. Engine verdicts are looked up there first and new ones
+            are added, so polygons that haven't changed since the last run skip the pair search.
+        simplify_meters (float): optional tolerance to simplify the polygons by before the pair search. A polygon
+            that passes simplified is checked again in full, so this can only ever turn a pass into a fail.
+        budget_seconds (float): optional time limit for the engine on each polygon. Polygons that run out get
+            "Fails*" in the results and count as failed.
 
     return:
-        the successful polygons in a dataframe
+        the successful polygons in a dataframe, or None in stream mode (they're in the files instead)
     """
     abs_polygons_path = os.path.abspath(polygons_path)
     if not os.path.exists(abs_polygons_path):
         print(f"CSV file '{polygons_path}' not found.")
         return
 
-    polygons = read_polygons_from_csv(polygons_path, max_polygons)
-    polygon_results = []
-    passing_polygons = []
-
-    passed = 0
-    failed = 0
-
-    for polygon, vertices in polygons.items():
-        solution = has_length_within_polygon_naive(vertices, target_meters, visualize)
-        location = average_vertice_location(vertices)
-
-        # calculate all the data
-        edge_lengths = edge_lengths_of_polygon(vertices, lat_lon_to_meters(vertices[0]))
-        edge_mean = np.mean(edge_lengths)
-        edge_std = np.std(edge_lengths)
-        perimeter = np.sum(edge_lengths)
-        edge_min_length = np.min(edge_lengths)
-        edge_max_length = np.max(edge_lengths)
-        vertices_amount = len(vertices)
-
-        polygon_results.append((int(polygon), location[0], location[1], solution, perimeter))
-        if print_info and solution == "Passes":
-            printable_info = [
-                f"Polygon {polygon:>6.0f}: {solution:<10} ",
-                f"Lat,Lon: ({location[0]}, {location[1]}), # vertices: {vertices_amount}, Edge mean: {edge_mean:.3f},",
-                f"Edge std: {edge_std:.3f}, Perimeter: {perimeter:>10},",
-                f", Edge Min Length {edge_min_length}, Edge Max Length {edge_max_length}"
-            ]
-            print(" ".join(printable_info))
-
-        if solution == 'Fails':
-            failed += 1
-        else:
-            # print(np.array2string(vertices, separator=', '))
-            passing_polygons.append(vertices)
-            passed += 1
+    if engine not in LANDABILITY_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {list(LANDABILITY_ENGINES)}")
+    has_length_within_polygon = LANDABILITY_ENGINES[engine]
+
+    vertices_file_name = vertices_path(results_path) if export_successful else None
+
+    counts = Counter()
+    cache = ResultCache(cache_path) if cache_path else None
 
-    total = passed + failed
-    percent_passed = (100 * passed) / total
+    if stream:
+        if results_path is None:
+            raise ValueError("stream mode writes its results as it goes, so it needs a results_path")
+        if is_binary(results_path):
+            raise ValueError("stream mode appends to its results as it goes, which only works with csv files")
+
+        passing_written = 0
+        for chunk_number, polygons in enumerate(iter_polygons_from_csv(polygons_path, chunksize, max_polygons)):
+            if region is not None:
+                polygons = polygons.subset(polygons_in_region(polygons, region))
+            polygon_results, passing_polygons = evaluate_polygons(polygons, target_meters, has_length_within_polygon,
+                                                                  counts, visualize, print_info, cache,
+                                                                  simplify_meters, budget_seconds)
+            if cache is not None:
+                cache.flush()
+
+            # first chunk starts the files, the rest get added on the end
+            pd.DataFrame(polygon_results, columns=RESULT_COLUMNS).to_csv(
+                results_path, index=False, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+
+            if vertices_file_name:
+                export_polygons_from_raw_vertices(filename=vertices_file_name,
+                                                  polygons=polygons.subset(np.array(passing_polygons, dtype=np.int64)),
+                                                  first_id=passing_written,
+                                                  append=chunk_number > 0)
+                passing_written += len(passing_polygons)
+
+        if cache is not None:
+            cache.close()
+        if print_info:
+            print_summary(counts, engine)
+        return None
+
+    polygons = read_polygons_from_csv(polygons_path, max_polygons)
+    if region is not None:
+        polygons = polygons.subset(polygons_in_region(polygons, region))
+    polygon_results, passing_polygons = evaluate_polygons(polygons, target_meters, has_length_within_polygon,
+                                                          counts, visualize, print_info, cache, simplify_meters,
+                                                          budget_seconds)
+    if cache is not None:
+        cache.close()
 
     if print_info:
         # if you're going to print everything out, do so
-        print()
-        print(f"Results:")
-        print(f"{total} total polygons.")
-        print(f"{passed} polygons passed.")
-        print(f"{failed} polygons failed.")
-        print(f"{percent_passed:.1f}% of the polygons passed.")
+        print_summary(counts, engine)
+
+    return write_outputs(polygons, polygon_results, passing_polygons, results_path, vertices_file_name)
+
+
+def is_binary(results_path) -> bool:
+    return results_path is not None and results_path.endswith('.npy')
+
+
+def vertices_path(results_path):
+    """
+    Returns: where the passing vertices go for a results file, a csv or a folder of .npy files to match it. None if
+        there's no results file.
+    """
+    if results_path is None:
+        return None
+    root = os.path.splitext(results_path)[0]
+    return f"{root}_vertices" if is_binary(results_path) else f"{root}_vertices.csv"
+
+
+def write_outputs(polygons: PolygonStore,
+                  polygon_results: list,
+                  passing_polygons: list,
+                  results_path=None,
+                  vertices_file_name=None) -> pd.DataFrame:
+    """
+    Writes the results of one file and builds the dataframe main_function hands back.
+
+    Parameters:
+        polygons (PolygonStore): every polygon of the file.
+        polygon_results (list): one result row per polygon, from evaluate_polygons.
+        passing_polygons (list): positions of the passing polygons in the store.
+        results_path (str): where to write the results, or None.
+        vertices_file_name (str): where to write the passing vertices, or None.
 
+    return:
+        the successful polygons in a dataframe
+    """
     # Write results to CSV file using Pandas
-    if results_path is not None:
+    if is_binary(results_path):
+        export_results_npy(results_path, pd.DataFrame(polygon_results, columns=RESULT_COLUMNS))
+    elif results_path is not None:
         # if you've turned on results path send that to .csv
         pd.DataFrame(
             polygon_results,
-            columns=['Polygon', 'Latitude', 'Longitude', 'Result', 'Perimeter']
+            columns=RESULT_COLUMNS
         ).to_csv(
             results_path,
             index=False)
 
-    if export_successful and results_path:
+    passing_polygons = polygons.subset(np.array(passing_polygons, dtype=np.int64))
+
+    if vertices_file_name and is_binary(results_path):
+        export_polygons_npy(vertices_file_name, passing_polygons)
+    elif vertices_file_name:
         # if you've turned on export successful and specified a path, export those
-        vertices_file_name = f"{os.path.splitext(results_path)[0]}_vertices.csv"
         export_polygons_from_raw_vertices(filename=vertices_file_name, polygons=passing_polygons)
 
     # convert the raw vertices to a df and return that
     return find_most_common_id_and_remove(raw_vertices_to_df(passing_polygons))
 
 
+@stop_watch
+def main_function_parallel(polygons_paths: list,
+                           workers=None,
+                           target_meters=500.0,
+                           results_paths=None,
+                           max_polygons=None,
+                           print_info=False,
+                           export_successful=False,
+                           engine='naive',
+                           region=None,
+                           cache_path=None,
+                           simplify_meters=None,
+                           budget_seconds=None) -> list:
+    """
+    Same as calling main_function on each file one after another, but the landability checks run on a process pool.
+    Work is split across files and across the polygons inside each file, weighted by vertex count squared, so a few
+    huge polygons don't leave one worker running long after the rest are done. The output is identical to the
+    serial run, in the same order.
+
+    Parameters:
+        polygons_paths (list[str]): the csv files to process.
+        workers (int): how many processes to use, defaults to the number of cpus.
+        results_paths (list[str]): optional results file for each csv, like results_path in main_function.
+        print_info (bool): If True, print the summary of each file (the per polygon lines are left out).
+        cache_path (str): optional ResultCache file shared by the workers, see main_function.
+        the rest: see main_function.
+
+    return:
+        a list with the successful polygons of each file in a dataframe
+    """
+    if engine not in LANDABILITY_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {list(LANDABILITY_ENGINES)}")
+    results_paths = results_paths or [None] * len(polygons_paths)
+
+    stores = [read_polygons_from_csv(polygons_path, max_polygons) for polygons_path in polygons_paths]
+    if region is not None:
+        stores = [store.subset(polygons_in_region(store, region)) for store in stores]
+    outputs = evaluate_stores_in_parallel(stores, target_meters, engine, workers, cache_path=cache_path,
+                                          simplify_meters=simplify_meters, budget_seconds=budget_seconds)
+
+    successful_polygons = []
+    for polygons, results_path, (polygon_results, passing_polygons, counts) in zip(stores, results_paths, outputs):
+        if print_info:
+            print_summary(counts, engine)
+
+        vertices_file_name = vertices_path(results_path) if export_successful else None
+        successful_polygons.append(write_outputs(polygons, polygon_results, passing_polygons, results_path,
+                                                 vertices_file_name))
+    return successful_polygons
+
+
+@stop_watch
+def main_function_sweep(targets_meters: list,
+                        polygons_path='polygons_unprocessed.csv',
+                        results_path=None,
+                        max_polygons=None,
+                        engine='naive',
+                        region=None) -> pd.DataFrame:
+    """
+    Checks a file against several target lengths at once, say one per aircraft class. Each polygon's longest straight
+    line is only worked out once (stopping at the biggest target), and every target is answered from that, so ten
+    targets cost about the same as one run of main_function. The verdicts are the same ones main_function gives.
+
+    Parameters:
+        targets_meters (list[float]): the distances to check for.
+        polygons_path (str): file path to file containing csv polygons.
+        results_path (str): optional file path to write the table to, a .csv or a .npy (see main_function).
+        max_polygons (int): The maximum number of polygons to load.
+        engine (str): 'naive' or 'exact', see main_function.
+        region (list[tuple]): see main_function.
+
+    return:
+        a dataframe of every polygon with its lengths (LENGTH_COLUMNS) and a "Result <target>" column per target.
+        Longest is nan for polygons shorter than every target.
+    """
+    if engine not in LANDABILITY_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {list(LANDABILITY_ENGINES)}")
+
+    polygons = read_polygons_from_csv(polygons_path, max_polygons)
+    if region is not None:
+        polygons = polygons.subset(polygons_in_region(polygons, region))
+
+    lengths = evaluate_polygon_lengths(polygons, engine, cap_meters=max(targets_meters),
+                                       floor_meters=min(targets_meters))
+    results = pd.concat([lengths] + [verdicts_for_target(lengths, target, engine) for target in targets_meters],
+                        axis='columns')
+
+    if is_binary(results_path):
+        export_results_npy(results_path, results)
+    elif results_path is not None:
+        results.to_csv(results_path, index=False)
+    return results
+
+
+@stop_watch
+def main_function_incremental(csv_list: list,
+                              manifest_path='lake_results/manifest.json',
+                              output_dir='lake_results/successful',
+                              workers=1,
+                              target_meters=500.0,
+                              engine='naive',
+                              region=None,
+                              cache_path=None) -> tuple:
+    """
+    Runs main_function over a list of csvs, but only on the files that are new or changed since the last run. The
+    successful polygons of every file are saved under output_dir and the manifest remembers which ones are current,
+    so the rest are just read back in. Each file owns a block of global polygon ids that stays put between runs
+    (see toolbox/manifest.py).
+
+    Parameters:
+        csv_list (list[str]): the csv files to process.
+        manifest_path (str): where to keep the manifest.
+        output_dir (str): where to keep the successful polygons of each file.
+        workers (int): more than 1 runs the changed files with main_function_parallel.
+        the rest: see main_function. Changing any of them makes every stored result stale.
+
+    return:
+        (list with the successful polygons of each file in a dataframe with global polygon ids, list of the files
+        that had to be processed)
+    """
+    params = {'target_meters': target_meters, 'engine': engine, 'region': region}
+    manifest = load_manifest(manifest_path, params)
+    hashes = {csv_file: file_hash(csv_file) for csv_file in csv_list}
+    stale = stale_files(manifest, csv_list, hashes)
+
+    if workers > 1 and len(stale) > 0:
+        fresh = main_function_parallel(stale, workers=workers, target_meters=target_meters, engine=engine,
+                                       region=region, cache_path=cache_path)
+    else:
+        fresh = [main_function(target_meters=target_meters, polygons_path=csv_file, engine=engine, region=region,
+                               cache_path=cache_path) for csv_file in stale]
+
+    # files that aren't there anymore give up their entries, then the new results get their id blocks
+    manifest['files'] = {csv_file: entry for csv_file, entry in manifest['files'].items() if csv_file in hashes}
+    os.makedirs(output_dir, exist_ok=True)
+    for csv_file, df in zip(stale, fresh):
+        output = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(csv_file))[0]}_"
+                                          f"{hashes[csv_file][:16]}.csv")
+        df.to_csv(output, index=False)
+
+        polygon_count = int(np.max(df['Polygon'].to_numpy(), initial=-1)) + 1
+        first_id = assign_id_block(manifest, csv_file, polygon_count)
+        previous = manifest['files'].get(csv_file)
+        if previous is not None and previous['output'] != output and os.path.exists(previous['output']):
+            os.remove(previous['output'])
+        record_file(manifest, csv_file, hashes[csv_file], output, first_id, polygon_count)
+    save_manifest(manifest_path, manifest)
+
+    successful_polygons = []
+    for csv_file in csv_list:
+        entry = manifest['files'][csv_file]
+        df = pd.read_csv(entry['output'], float_precision='round_trip')
+        df['Polygon'] = df['Polygon'] + entry['first_id']
+        successful_polygons.append(df)
+    return successful_polygons, stale
+
+
+@stop_watch
+def main_function_tiled(polygons_paths: list,
+                        region=roi,
+                        tile_degrees=0.25,
+                        tiles=None,
+                        tiles_dir=None,
+                        workers=1,
+                        target_meters=500.0,
+                        engine='naive',
+                        simplify_meters=None,
+                        cache_path=None,
+                        chunksize=10_000) -> list:
+    """
+    Same as main_function_parallel with a region, but the work is split into tiles of a lat / lon grid instead of
+    files. Every polygon belongs to the one tile holding the middle of its bounding box, and each tile is checked
+    (and its results saved under tiles_dir) on its own. The files are read chunksize rows at a time and each chunk
+    only keeps the polygons in the tiles being run that aren't entirely outside the region, so polygons of other
+    tiles are never held onto and a borough costs what a borough costs.
+
+    Parameters:
+        polygons_paths (list[str]): the csv files to process.
+        region (list[tuple]): (lat, lon) vertices of the area to run, the Mat-Su ROI by default.
+        tile_degrees (float): the size of a tile in degrees.
+        tiles (list[str]): optional names of the tiles to run (see toolbox/tiling.py), defaults to every tile
+            touching the region.
+        tiles_dir (str): optional folder to save each tile's results in. A tile whose polygons and parameters
+            haven't changed is read back from there instead of being checked again.
+        workers (int): more than 1 checks the tiles on a process pool.
+        chunksize (int): how many csv rows to read at a time.
+        the rest: see main_function.
+
+    return:
+        a list with the successful polygons of each file in a dataframe, the same as main_function_parallel would
+        give for the polygons in the tiles that were run
+    """
+    if engine not in LANDABILITY_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {list(LANDABILITY_ENGINES)}")
+    tile_boxes = tiles_in_region(region, tile_degrees)
+    tiles = list(tile_boxes) if tiles is None else [tile for tile in tiles if tile in tile_boxes]
+    params = {'target_meters': target_meters, 'engine': engine, 'simplify_meters': simplify_meters,
+              'tile_degrees': tile_degrees, 'region': [tuple(map(float, vertex)) for vertex in region]}
+
+    # which polygons of which file go in each tile, only counting the ones in the region. kept has the positions in
+    # the file and the polygons of everything that made it into one of the tiles
+    requested = {tile: tile_boxes[tile] for tile in tiles}
+    pieces = {tile: [] for tile in tiles}
+    kept = []
+    for file_index, polygons_path in enumerate(polygons_paths):
+        file_positions, file_stores, file_tiles = [np.empty(0, dtype=np.int64)], [], [np.empty(0, dtype=object)]
+        first_position = 0
+        for chunk in iter_polygons_from_csv(polygons_path, chunksize):
+            positions, chunk_tiles = polygons_in_tiles(chunk, region, requested, tile_degrees)
+            file_positions.append(positions + first_position)
+            file_stores.append(chunk.subset(positions))
+            file_tiles.append(chunk_tiles)
+            first_position += len(chunk)
+
+        positions = np.concatenate(file_positions)
+        store = PolygonStore.concatenate(file_stores)
+        polygon_tiles = np.concatenate(file_tiles)
+        kept.append((positions, store))
+        for tile in tiles:
+            selection = np.flatnonzero(polygon_tiles == tile)
+            if len(selection):
+                pieces[tile].append((file_index, positions[selection], store.subset(selection)))
+
+    # saved tiles get read back, the rest get checked
+    tile_results = {}
+    to_run = []
+    for tile in tiles:
+        if not pieces[tile]:
+            continue
+        tile_file = None
+        if tiles_dir is not None:
+            names = [os.path.basename(polygons_paths[file_index]) for file_index, _, _ in pieces[tile]]
+            digest = tile_hash([(name, positions, store) for name, (_, positions, store) in zip(names, pieces[tile])],
+                               params)
+            tile_file = os.path.join(tiles_dir, f"tile_{tile}_{digest[:16]}.csv")
+        if tile_file is not None and os.path.exists(tile_file):
+            tile_results[tile] = pd.read_csv(tile_file, float_precision='round_trip')
+        else:
+            to_run.append((tile, tile_file))
+
+    shards = [store for tile, _ in to_run for _, _, store in pieces[tile]]
+    if workers > 1 and len(shards) > 1:
+        outputs = evaluate_stores_in_parallel(shards, target_meters, engine, workers, cache_path=cache_path,
+                                              simplify_meters=simplify_meters)
+    else:
+        cache = ResultCache(cache_path) if cache_path else None
+        outputs = []
+        for store in shards:
+            counts = Counter()
+            outputs.append(evaluate_polygons(store, target_meters, LANDABILITY_ENGINES[engine], counts, cache=cache,
+                                             simplify_meters=simplify_meters) + (counts,))
+        if cache is not None:
+            cache.close()
+
+    outputs = iter(outputs)
+    for tile, tile_file in to_run:
+        frames = []
+        for file_index, positions, _ in pieces[tile]:
+            polygon_results, _, _ = next(outputs)
+            frame = pd.DataFrame(polygon_results, columns=RESULT_COLUMNS)
+            frame.insert(0, 'Position', positions)
+            frame.insert(0, 'File', os.path.basename(polygons_paths[file_index]))
+            frames.append(frame)
+        tile_results[tile] = pd.concat(frames, ignore_index=True)
+        if tile_file is not None:
+            os.makedirs(tiles_dir, exist_ok=True)
+            tile_results[tile].to_csv(tile_file, index=False)
+
+    # back to one set of results per file, in file order
+    results = pd.concat(list(tile_results.values()) or [pd.DataFrame(columns=['File', 'Position'] + RESULT_COLUMNS)],
+                        ignore_index=True)
+    successful_polygons = []
+    for polygons_path, (kept_positions, store) in zip(polygons_paths, kept):
+        file_results = results[results['File'] == os.path.basename(polygons_path)].sort_values('Position')
+        positions = file_results['Position'].to_numpy(dtype=np.int64)
+        if not len(positions):
+            # none of this file's polygons are in the tiles that were run, the usual case for one borough of a
+            # statewide export
+            successful_polygons.append(pd.DataFrame(columns=['Polygon', 'Latitude', 'Longitude']))
+            continue
+        passing = np.flatnonzero(~file_results['Result'].str.startswith('Fails').to_numpy())
+        successful_polygons.append(write_outputs(store.subset(np.searchsorted(kept_positions, positions)), [],
+                                                 passing))
+    return successful_polygons
+
+
 def filter_source_of_truth(df: pd.DataFrame) -> pd.DataFrame:
     """
     Takes the dataframe containing the source of truth, then filters out the stuff that is not relevant
@@ -129,13 +499,9 @@ def filter_source_of_truth(df: pd.DataFrame) -> pd.DataFrame:
     and airports
     """
 
-    working_df = deepcopy(df[df['floatplanes'] == 1])  # we don't care about runways, get rid of them
-
-    """
-    we need to filter out places that aren't in our ROI
-    """
-    working_df['roi'] = working_df.apply(lambda r: is_point_in_polygon(roi, (r["Lat"], r['Long'])), axis='columns')
-    return working_df[working_df['roi']]
+    # we don't care about runways, and we need to filter out places that aren't in our ROI. Both checks run over the
+    # whole column at once
+    return filter_ground_truth(df, roi)
 
 
 if __name__ == "__main__":
@@ -149,23 +515,53 @@ if __name__ == "__main__":
 
     csv_list = [os.path.join("lakes_csv", filename) for filename in os.listdir("lakes_csv") if
                 filename.endswith(".csv")]
-    successful_polygons = [main_function(polygons_path=csv_file,) for csv_file in csv_list]
 
-    # make all the polygon indices unique by adding the length of the previous df to the polygon
-    index_counter = 1
-    for df in successful_polygons:
-        df['Polygon'] = df['Polygon'] + index_counter
-        index_counter = index_counter + df["Polygon"].max()
+    # record how long every stage takes and how hard the engines had to work, written out at the end
+    METRICS.enable()
+
+    # only the files that changed since the last run get processed, the parallel run gives the exact same output as
+    # the serial one. every file keeps its block of polygon ids from run to run
+    successful_polygons, changed_files = main_function_incremental(csv_list, workers=os.cpu_count() or 1, region=roi,
+                                                                   cache_path="landability_cache.sqlite")
+    print(f"{len(changed_files)} of {len(csv_list)} lake files were new or changed.")
+
+    # the stats, the map and the tables are made from the lake results and the flight data, so they only get redone
+    # when one of those changed or one of the files has gone missing
+    outputs = ['detected_lakes.csv', 'lake_map.html', 'lakes_by_base.csv', 'destinations_matched.csv']
+    inputs = {'lake results': file_hash('lake_results/manifest.json'), 'ground truth': ground_truth_key(),
+              'flights': file_hash(FLIGHTS_PATH)}
+    if outputs_current('lake_results/outputs.json', inputs, outputs):
+        print(f"Nothing changed since the last run, {', '.join(outputs)} are up to date.")
+    else:
+        # put all of these together and calculate the min and max lat-lons
+        df = pd.concat(successful_polygons)
+
+        # now load the source of truth (parsed once, then cached next to the csvs) and keep only the floatplane
+        # spots in the ROI
+        lake_truth = load_ground_truth(region=roi)
+
+        # now we need to check each point in the source of truth data and see if it's bounded by one of the polygons
+        with METRICS.stage('stats'):
+            lake_truth = generate_positive_identification_statistics(df, lake_truth, verbose=True)
+        lake_truth.to_csv('detected_lakes.csv', columns=['Lat', "Long", "LakeName", "detected"], index=False)
+
+        # now send all this to map_lakes_grouped to generate an html file, it stays small even with every lake in it
+        with METRICS.stage('map'):
+            map_lakes_grouped(outline_df=df, marker_df=lake_truth)
 
-    # put all of these together and calculate the min and max lat-lons
-    df = pd.concat(successful_polygons)
+        # every landable lake with its closest seaplane base, closest first, for dispatch
+        with METRICS.stage('bases'):
+            nearest_base_per_polygon(df, read_faa_facilities()).to_csv('lakes_by_base.csv', index=False)
 
-    # now load the source of truth and filter out unnecessary information
-    lake_truth = filter_source_of_truth(pd.read_csv('flight_data/cleaned.csv'))
+        # which of the lakes the flights in the paper land on we found, and how close our areas are, by lake size
+        with METRICS.stage('destinations'):
+            destinations = read_flight_destinations()
+            destinations = destinations[points_in_polygon(roi, destinations[['Lat', 'Long']].to_numpy())]
+            matches = match_destinations(PolygonStore.from_frame(df), destinations)
+            matches.to_csv('destinations_matched.csv', index=False)
+            print(detection_by_size(matches).to_string(index=False))
 
-    # now we need to check each point in the source of truth data and see if it's bounded by one of the polygons
-    lake_truth = generate_positive_identification_statistics(df, lake_truth, verbose=True)
-    lake_truth.to_csv('detected_lakes.csv', columns=['Lat', "Long", "LakeName", "detected"], index=False)
+        save_outputs_stamp('lake_results/outputs.json', inputs)
 
-    # now send all this to the map_lakes function to generate an html file
-    map_lakes(outline_df=df, marker_df=lake_truth)
+    METRICS.export_json('run_metrics.json')
+    print("Saved the run metrics to run_metrics.json")
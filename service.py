@@ -0,0 +1,409 @@
+"""
+Keeps the lakes loaded and answers landability questions without starting the whole pipeline for every one. The
+polygons, their hull diameters, a bounding box index and the verdict cache are built once at startup, then requests
+come in as json, either one per line on stdin (answers go to stdout) or POSTed to a local http server.
+
+    python service.py lakes_csv/*.csv                    # json lines over stdin / stdout
+    python service.py lakes_csv/*.csv --http 8765        # http on localhost:8765
+
+Requests (the "id" is optional and handed back with the answer):
+    {"id": 1, "op": "check", "target_meters": 500, "vertices": [[lat, lon], ...], "holes": [[[lat, lon], ...]]}
+        -> {"id": 1, "result": "Passes"}
+    {"id": 3, "op": "check", "target_meters": 500, "point": [lat, lon]}
+        -> {"id": 3, "result": "Fails", "lake": {"polygon": 17, "file": "...", "latitude": ..., "longitude": ...}}
+    {"id": 2, "op": "landable", "target_meters": 500, "region": [[lat, lon], ...]}
+        -> {"id": 2, "count": 12, "lakes": [{"polygon": 4, "file": "...", "latitude": ..., "longitude": ...}, ...]}
+Both take an optional "engine", any of LANDABILITY_ENGINES ('naive', 'exact' or 'raster'). A check's "result" is
+the engine's verdict as it is, so the naive engine can say "Passes*". Anything that goes wrong comes back as
+{"id": .., "error": ..}, with the id of the request it's for.
+
+Requests that show up within a few milliseconds of each other get answered as one batch, so several dispatchers
+asking about the same target (or the same polygon) only cost one search.
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+import numpy as np
+from toolbox.cache import ResultCache
+from toolbox.constants import MATSU_REGION_OF_INTEREST as roi
+from toolbox.files import read_polygons_from_csv
+from toolbox.landability import evaluate_polygons
+from toolbox.polygons import LANDABILITY_ENGINES, planar_hull_diameter, points_in_polygon, polygons_in_region
+from toolbox.spatial_index import BoundingBoxGrid
+from toolbox.store import PolygonStore
+
+
+def with_id(request: dict, response: dict) -> dict:
+    # hands the request's id back with its answer, so a client can tell which answer is which
+    return {'id': request['id'], **response} if 'id' in request else response
+
+
+class LakeService:
+    """
+    Everything that's worth keeping between requests.
+
+    A polygon that passes for some target passes for every shorter one, and one that fails fails for every longer
+    one, so for each engine we remember the longest target each polygon is known to pass and the shortest one it's
+    known to fail. A "landable" query only runs the engine on the polygons those don't already decide.
+
+    Attributes:
+        engine (str): the engine used when a request doesn't pick one, any key of LANDABILITY_ENGINES ('naive',
+            'exact' or 'raster').
+        polygons (PolygonStore): every loaded polygon, the files one after another.
+        files (numpy.ndarray): the file each polygon came from.
+        centers (numpy.ndarray): (k, 2) average vertex of each polygon.
+        hull_diameters (numpy.ndarray): nothing inside a polygon is longer than this.
+        grid (BoundingBoxGrid): index of the polygons' bounding boxes, for finding the lake under a point.
+    """
+
+    def __init__(self, csv_list, engine='naive', cache_path=None, region=None):
+        if engine not in LANDABILITY_ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {list(LANDABILITY_ENGINES)}")
+        self.engine = engine
+        self.cache_path = cache_path
+        self._cache = None
+
+        stores, files = [], []
+        for csv_file in csv_list:
+            store = read_polygons_from_csv(csv_file)
+            if region is not None:
+                store = store.subset(polygons_in_region(store, region))
+            stores.append(store)
+            files += [csv_file] * len(store)
+        self.polygons = PolygonStore.concatenate(stores)
+        self.files = np.array(files, dtype=object)
+
+        counts = self.polygons.vertex_counts
+        starts = self.polygons.offsets[:-1][counts > 0]
+        self.centers = np.full((len(self.polygons), 2), np.nan)
+        self.centers[counts > 0] = np.add.reduceat(self.polygons.coordinates, starts) / counts[counts > 0, None]
+        meters, _ = self.polygons.in_meters()
+        self.hull_diameters = np.array([planar_hull_diameter(meters[start:stop])
+                                        for start, stop in zip(self.polygons.offsets[:-1], self.polygons.offsets[1:])])
+        self.grid = BoundingBoxGrid.from_store(self.polygons)
+
+        # per engine: the longest target each polygon is known to pass, and the shortest it's known to fail
+        self._passes_up_to = {}
+        self._fails_from = {}
+        self._regions = {}
+
+    @property
+    def cache(self):
+        # sqlite connections belong to the thread that made them, so open it from the thread that answers requests
+        if self._cache is None and self.cache_path:
+            self._cache = ResultCache(self.cache_path)
+        return self._cache
+
+    def _engine(self, request):
+        engine = request.get('engine', self.engine)
+        if engine not in LANDABILITY_ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {list(LANDABILITY_ENGINES)}")
+        return engine
+
+    def _region_positions(self, region):
+        if region is None:
+            return np.arange(len(self.polygons))
+        key = json.dumps(region)
+        if key not in self._regions:
+            self._regions[key] = np.flatnonzero(polygons_in_region(self.polygons, region))
+        return self._regions[key]
+
+    def lakes_at(self, point) -> np.ndarray:
+        """
+        Returns: the positions of the loaded polygons that hold a (lat, lon) point.
+        """
+        point = np.asarray(point, dtype=np.float64).reshape(1, 2)
+        _, candidates = self.grid.candidates(point)
+        return np.array([k for k in candidates if points_in_polygon(self.polygons[k], point)[0]], dtype=np.int64)
+
+    def _known(self, engine):
+        return (self._passes_up_to.setdefault(engine, np.zeros(len(self.polygons))),
+                self._fails_from.setdefault(engine, np.full(len(self.polygons), np.inf)))
+
+    def verdicts(self, positions, target_meters, engine=None) -> np.ndarray:
+        """
+        Runs the engine on the loaded polygons at positions and remembers which passed and which failed, for passes.
+
+        Returns: the engine's verdict for each one ("Passes", "Passes*", "Fails", ...), the same as evaluate_polygons
+        """
+        engine = engine or self.engine
+        positions = np.asarray(positions, dtype=np.int64)
+        rows, _ = evaluate_polygons(self.polygons.subset(positions), target_meters, LANDABILITY_ENGINES[engine],
+                                    Counter(), cache=self.cache)
+        verdicts = np.array([row[3] for row in rows], dtype=object)
+
+        # a "Fails*" ran out of budget, that doesn't say anything about other targets
+        passes_up_to, fails_from = self._known(engine)
+        passing_positions = positions[[not verdict.startswith('Fails') for verdict in verdicts]]
+        failing_positions = positions[verdicts == "Fails"]
+        passes_up_to[passing_positions] = np.maximum(passes_up_to[passing_positions], target_meters)
+        fails_from[failing_positions] = np.minimum(fails_from[failing_positions], target_meters)
+        return verdicts
+
+    def passes(self, positions, target_meters, engine=None) -> np.ndarray:
+        """
+        Returns: for each of the loaded polygons at positions, whether it passes for target_meters. Only the ones
+        that aren't already decided by an earlier answer (or their hull diameter) go through the engine.
+        """
+        engine = engine or self.engine
+        positions = np.asarray(positions, dtype=np.int64)
+        passes_up_to, fails_from = self._known(engine)
+
+        known_pass = passes_up_to[positions] >= target_meters
+        known_fail = (fails_from[positions] <= target_meters) | (self.hull_diameters[positions] < target_meters)
+        unknown = np.flatnonzero(~known_pass & ~known_fail)
+
+        if len(unknown):
+            verdicts = self.verdicts(positions[unknown], target_meters, engine)
+            known_pass[unknown] = [not verdict.startswith('Fails') for verdict in verdicts]
+
+        return known_pass
+
+    def landable(self, target_meters, engine=None, region=None) -> np.ndarray:
+        """
+        Returns: the positions of the loaded polygons that pass for target_meters (inside region, if there is one).
+        """
+        positions = self._region_positions(region)
+        return positions[self.passes(positions, target_meters, engine)]
+
+    def _describe(self, positions):
+        return [{'polygon': int(polygon), 'file': str(csv_file), 'latitude': float(lat), 'longitude': float(lon)}
+                for polygon, csv_file, (lat, lon) in zip(self.polygons.ids[positions], self.files[positions],
+                                                         self.centers[positions])]
+
+    def handle_batch(self, requests) -> list:
+        """
+        Answers a batch of requests. Identical questions (the same target, engine and region for "landable", the same
+        polygon, target and engine for "check") are only worked out once.
+
+        Returns: one response dict per request, in the same order.
+        """
+        responses = [None] * len(requests)
+        landable_groups = {}
+        check_groups = {}
+        lake_groups = {}
+        for index, request in enumerate(requests):
+            try:
+                op = request.get('op')
+                target_meters = float(request['target_meters'])
+                engine = self._engine(request)
+                if op == 'landable':
+                    key = (target_meters, engine, json.dumps(request.get('region')))
+                    landable_groups.setdefault(key, []).append(index)
+                elif op == 'check' and 'point' in request:
+                    # a lake we already have loaded, picked by a point on it
+                    positions = self.lakes_at(request['point'])
+                    if len(positions) == 0:
+                        raise ValueError("no loaded lake holds that point")
+                    lake_groups.setdefault((target_meters, engine), {}).setdefault(positions[0], []).append(index)
+                elif op == 'check':
+                    vertices = np.asarray(request['vertices'], dtype=np.float64).reshape(-1, 2)
+                    holes = [np.asarray(hole, dtype=np.float64).reshape(-1, 2) for hole in request.get('holes', [])]
+                    if len(vertices) < 3:
+                        raise ValueError("a polygon needs at least 3 vertices")
+                    polygon = json.dumps([vertices.tolist(), [hole.tolist() for hole in holes]])
+                    check_groups.setdefault((target_meters, engine), {}).setdefault(
+                        polygon, (vertices, holes, []))[2].append(index)
+                else:
+                    raise ValueError(f"Unknown op {op!r}, expected 'check' or 'landable'")
+            except (KeyError, TypeError, ValueError) as error:
+                responses[index] = {'error': f"{type(error).__name__}: {error}"}
+
+        for (target_meters, engine, region), indices in landable_groups.items():
+            try:
+                lakes = self._describe(self.landable(target_meters, engine, json.loads(region)))
+                response = {'count': len(lakes), 'lakes': lakes}
+            except (TypeError, ValueError) as error:
+                response = {'error': f"{type(error).__name__}: {error}"}
+            for index in indices:
+                responses[index] = response
+
+        for (target_meters, engine), lakes in lake_groups.items():
+            positions = np.array(list(lakes), dtype=np.int64)
+            for verdict, lake, indices in zip(self.verdicts(positions, target_meters, engine),
+                                              self._describe(positions), lakes.values()):
+                for index in indices:
+                    responses[index] = {'result': verdict, 'lake': lake}
+
+        for (target_meters, engine), polygons in check_groups.items():
+            outlines = [vertices for vertices, _, _ in polygons.values()]
+            all_holes = [(position, hole) for position, (_, holes, _) in enumerate(polygons.values())
+                         for hole in holes]
+            store = PolygonStore.from_vertices(outlines)
+            if all_holes:
+                hole_store = PolygonStore.from_vertices([hole for _, hole in all_holes])
+                store = PolygonStore(store.coordinates, store.offsets, None, hole_store.coordinates,
+                                     hole_store.offsets, [position for position, _ in all_holes])
+            rows, _ = evaluate_polygons(store, target_meters, LANDABILITY_ENGINES[engine], Counter(),
+                                        cache=self.cache)
+            for row, (_, _, indices) in zip(rows, polygons.values()):
+                for index in indices:
+                    responses[index] = {'result': row[3]}
+
+        if self.cache is not None:
+            self.cache.flush()
+
+        return [with_id(request, response) for request, response in zip(requests, responses)]
+
+    def close(self):
+        # call this from the same thread as handle_batch, see MicroBatcher's on_stop
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+
+class MicroBatcher:
+    """
+    Collects requests from any number of threads and hands them to handle_batch in batches, from one thread of its
+    own. A batch goes as soon as it has max_batch requests or max_wait_seconds have passed since its first one.
+    on_stop gets called from that thread once it's done, for cleaning up things that belong to it (like the sqlite
+    connection of the cache).
+    """
+
+    def __init__(self, handle_batch, max_batch=256, max_wait_seconds=0.005, on_stop=None):
+        self.handle_batch = handle_batch
+        self.on_stop = on_stop
+        self.max_batch = max_batch
+        self.max_wait_seconds = max_wait_seconds
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, request: dict) -> Future:
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def close(self):
+        # let everything that's already queued finish, then stop the thread
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self._answer_batches()
+        finally:
+            if self.on_stop is not None:
+                self.on_stop()
+
+    def _answer_batches(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = monotonic() + self.max_wait_seconds
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                responses = list(self.handle_batch([request for request, _ in batch]))
+            except Exception as error:  # don't let one bad batch take the service down
+                responses = [with_id(request, {'error': f"{type(error).__name__}: {error}"}) for request, _ in batch]
+            for (_, future), response in zip(batch, responses):
+                future.set_result(response)
+
+
+def serve_json_lines(batcher: MicroBatcher, input_stream=sys.stdin, output_stream=sys.stdout):
+    """
+    Reads one json request per line and writes one json answer per line as each is done, which isn't necessarily
+    the order they came in. Returns at the end of the input once everything has been answered.
+    """
+    write_lock = threading.Lock()
+
+    def write(response):
+        with write_lock:
+            output_stream.write(json.dumps(response) + "\n")
+            output_stream.flush()
+
+    futures = []
+    for line in input_stream:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request has to be a json object")
+        except ValueError as error:
+            write({'error': f"Bad request: {error}"})
+            continue
+        future = batcher.submit(request)
+        future.add_done_callback(lambda done: write(done.result()))
+        futures.append(future)
+
+    for future in futures:
+        future.result()
+
+
+def make_http_server(batcher: MicroBatcher, port=8765, host='127.0.0.1') -> ThreadingHTTPServer:
+    """
+    An http server that takes a request (or a list of them) as the json body of a POST and answers with json. Every
+    connection gets its own thread, and they all feed the same batcher.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                requests = body if isinstance(body, list) else [body]
+                if not all(isinstance(request, dict) for request in requests):
+                    raise ValueError("a request has to be a json object")
+            except ValueError as error:
+                self._reply(400, {'error': f"Bad request: {error}"})
+                return
+            responses = [future.result() for future in [batcher.submit(request) for request in requests]]
+            self._reply(200, responses if isinstance(body, list) else responses[0])
+
+        def _reply(self, status, response):
+            payload = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass  # keep stderr quiet, dispatch tools poll a lot
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv_files", nargs='+', help="the gee exports to load")
+    parser.add_argument("--engine", default='naive', choices=list(LANDABILITY_ENGINES), help="the default engine")
+    parser.add_argument("--cache", default=None, help="path of a ResultCache file to share with main.py")
+    parser.add_argument("--roi", action="store_true", help="only load the lakes in the region of interest")
+    parser.add_argument("--http", type=int, default=None, metavar="PORT", help="serve http on localhost:PORT")
+    args = parser.parse_args()
+
+    service = LakeService(args.csv_files, args.engine, args.cache, roi if args.roi else None)
+    batcher = MicroBatcher(service.handle_batch, on_stop=service.close)
+    print(f"Loaded {len(service.polygons)} polygons from {len(args.csv_files)} files.", file=sys.stderr)
+
+    try:
+        if args.http is not None:
+            server = make_http_server(batcher, args.http)
+            print(f"Listening on http://127.0.0.1:{args.http}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.server_close()
+        else:
+            serve_json_lines(batcher)
+    finally:
+        batcher.close()
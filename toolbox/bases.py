@@ -0,0 +1,65 @@
+"""
+Finds the closest seaplane base to every landable lake, so dispatch can rank the lakes by how far they are from a
+base. The search itself is nearest_points in toolbox/nearest.py (a kd tree on the unit sphere), so every lake in
+Alaska against every FAA facility takes seconds.
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+from toolbox.ingest import SEAPLANE_BASE, read_faa_facilities  # noqa: F401, kept here for callers
+from toolbox.nearest import build_point_tree, nearest_points
+
+BASE_COLUMNS = ['Polygon', 'Latitude', 'Longitude', 'Base', 'BaseName', 'BaseDistance']
+
+
+def build_base_tree(bases: pd.DataFrame) -> KDTree:
+    """
+    Returns: the tree over the (Lat, Long) of bases that nearest_bases searches.
+    """
+    return build_point_tree(bases[['Lat', 'Long']].to_numpy())
+
+
+def nearest_bases(points, bases: pd.DataFrame, tree: KDTree = None):
+    """
+    Finds the closest base to each point.
+
+    Parameters:
+        points (numpy.ndarray): (n, 2) array of (latitude, longitude).
+        bases (pandas.DataFrame): the bases, with Lat and Long columns, like read_faa_facilities gives.
+        tree (KDTree): optional tree from build_base_tree, so it can be reused for more queries.
+
+    Returns:
+        tuple: (the row position in bases of each point's closest base, the great circle distance to it in meters)
+    """
+    return nearest_points(points, bases[['Lat', 'Long']].to_numpy(), tree)
+
+
+def nearest_base_per_polygon(df: pd.DataFrame, bases: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reports the closest base to each polygon, measured from the average of its vertices (the same spot the results
+    file gives for it).
+
+    Parameters:
+        df (pandas.DataFrame): polygons in Kai's format (Polygon, Latitude, Longitude), like main_function returns.
+        bases (pandas.DataFrame): the bases, like read_faa_facilities gives.
+
+    Returns:
+        a dataframe with BASE_COLUMNS, one row per polygon, closest to a base first. BaseDistance is in meters.
+    """
+    centers = df.groupby('Polygon', sort=False)[['Latitude', 'Longitude']].mean()
+    positions, distances = nearest_bases(centers.to_numpy(), bases)
+
+    found = positions >= 0
+    names = np.full(len(centers), None, dtype=object)
+    location_ids = np.full(len(centers), None, dtype=object)
+    names[found] = bases['FacilityName'].to_numpy()[positions[found]]
+    location_ids[found] = bases['LocationID'].to_numpy()[positions[found]]
+
+    result = pd.DataFrame({'Polygon': centers.index.to_numpy(),
+                           'Latitude': centers['Latitude'].to_numpy(),
+                           'Longitude': centers['Longitude'].to_numpy(),
+                           'Base': location_ids,
+                           'BaseName': names,
+                           'BaseDistance': distances}, columns=BASE_COLUMNS)
+    return result.sort_values('BaseDistance', kind='stable', ignore_index=True)
@@ -0,0 +1,90 @@
+"""
+An on-disk cache of landability verdicts so reruns on mostly unchanged GEE exports don't redo the pair search.
+Entries are keyed by a hash of the polygon's vertex bytes plus the parameters that change the answer, so a polygon
+that shows up again in next week's export (even in a different file or at a different position) is a hit.
+It's a single sqlite file, which comes with python and is safe to share between the worker processes.
+"""
+
+import hashlib
+import sqlite3
+import time
+import numpy as np
+
+# bump this when an engine changes in a way that could change a verdict, old entries then stop matching
+CACHE_VERSION = 2
+
+
+def polygon_key(vertices, holes, target_meters, engine) -> bytes:
+    """
+    Content hash of everything that goes into a verdict: the vertices, the holes, target_meters and the engine.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{CACHE_VERSION}|{engine}|{float(target_meters)!r}|{len(holes or [])}".encode())
+    for ring in [vertices] + list(holes or []):
+        ring = np.ascontiguousarray(ring, dtype=np.float64)
+        digest.update(len(ring).to_bytes(8, 'little'))
+        digest.update(ring.tobytes())
+    return digest.digest()
+
+
+class ResultCache:
+    """
+    sqlite backed key -> verdict store with a cap on the number of entries. Reads go straight to the database,
+    writes and the "last used" bumps are held until flush so a run only does one write transaction. When the cap is
+    passed the least recently used entries get evicted.
+    """
+
+    def __init__(self, path, max_entries=1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS verdicts "
+                                "(key BLOB PRIMARY KEY, verdict TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)")
+        self.connection.commit()
+        self._pending = {}
+        self._used = []
+
+    def get(self, key):
+        """
+        Returns: the cached verdict for key, or None on a miss.
+        """
+        if key in self._pending:
+            return self._pending[key]
+        row = self.connection.execute("SELECT verdict FROM verdicts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._used.append(key)
+        return row[0]
+
+    def put(self, key, verdict):
+        self._pending[key] = verdict
+
+    def flush(self):
+        """
+        Writes the new verdicts, marks the hits as recently used and evicts the oldest entries past max_entries.
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("UPDATE verdicts SET last_used = ? WHERE key = ?",
+                                        [(now, key) for key in self._used])
+            self.connection.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+                                        [(key, verdict, now) for key, verdict in self._pending.items()])
+            extra = len(self) - self.max_entries
+            if extra > 0:
+                self.connection.execute("DELETE FROM verdicts WHERE key IN "
+                                        "(SELECT key FROM verdicts ORDER BY last_used LIMIT ?)", (extra,))
+        self._pending, self._used = {}, []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
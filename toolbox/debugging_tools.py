@@ -2,15 +2,23 @@
 this is debugging code created by kai to decorate code and get an idea of how fast the code was running
 """
 
+from functools import wraps
 from time import time
+from toolbox.metrics import METRICS
 
 def stop_watch(func):
-    # This tells you how long it took for a function to execute.
+    # This tells you how long it took for a function to execute. When the metrics are turned on the time goes into
+    # them (as a stage named after the function) instead of getting printed.
+    @wraps(func)
     def wrap_func(*args, **kwargs):
+        if METRICS.enabled:
+            with METRICS.stage(func.__name__):
+                return func(*args, **kwargs)
+
         t1 = time()
         result = func(*args, **kwargs)
         t2 = time()
         print(f'Function {func.__name__!r} executed in {(t2 - t1):.4f}s')
         return result
 
-    return wrap_func
\ No newline at end of file
+    return wrap_func
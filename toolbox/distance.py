@@ -15,7 +15,7 @@ def haversine(lat1: float, lon1: float, lat2: float, lon2: float):
         lat1, lon1, lat2, lon2: Latitude and longitude of the two points
 
     Returns:
-        float: Distance between the two points in miles
+        float: Distance between the two points in meters. Works on arrays too, one distance per item.
     """
     lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
 
@@ -54,19 +54,36 @@ def lat_lon_to_meters(point, epsilon=0.0001):
     Note that lat should be the same number no matter where on earth it is calculated.
 
     Parameters:
-        point (numpy.ndarray): A lattitude and longitude.
+        point (numpy.ndarray): A lattitude and longitude, or an (n, 2) array of them.
         epsilon (float): A small number. The smaller, the more precise the calculation.
 
     Returns: 
-        numpy.ndarray: The conversion rates.
+        numpy.ndarray: The conversion rates, shaped like point.
     """
     # TODO: just calculate the percise limit.
-    dmeter_dlat = 111_120.0 # haversine(point[0], point[1], point[0] + epsilon, point[1]) / epsilon     # Partial derivative of meters with respect to lattitude.
-    dmeter_dlon = 111_319.488 * np.cos(np.deg2rad(point[0])) # haversine(point[0], point[1], point[0], point[1] + epsilon) / epsilon     # Partial derivative of meters with respect to longitude.
-    conversion_rate = np.array([dmeter_dlat, dmeter_dlon])
+    latitude = np.asarray(point, dtype=float)[..., 0]
+    dmeter_dlat = np.full_like(latitude, 111_120.0) # haversine(point[0], point[1], point[0] + epsilon, point[1]) / epsilon     # Partial derivative of meters with respect to lattitude.
+    dmeter_dlon = 111_319.488 * np.cos(np.deg2rad(latitude)) # haversine(point[0], point[1], point[0], point[1] + epsilon) / epsilon     # Partial derivative of meters with respect to longitude.
+    conversion_rate = np.stack([dmeter_dlat, dmeter_dlon], axis=-1)
     return conversion_rate
 
 
+def polygon_conversion(vertices):
+    """
+    The conversion rate to use for a whole polygon: lat_lon_to_meters at the middle of its latitude range. The east
+    west scale changes with latitude, so taking it from one end of a long north south lake stretches the other end.
+    From the middle the error is half as big, and it's tiny either way for a lake (see projection_errors).
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs (latitude, longitude).
+
+    Returns:
+        numpy.ndarray: The conversion rates.
+    """
+    latitudes = np.asarray(vertices, dtype=float)[:, 0]
+    return lat_lon_to_meters(((latitudes.min() + latitudes.max()) / 2, 0.0))
+
+
 def distance_between_vertices(vertices: np.ndarray, 
                               index1: int, index2: int,
                               lat_lon_to_meters) -> float:
@@ -86,4 +103,60 @@ def distance_between_vertices(vertices: np.ndarray,
     x2, y2 = vertices[index2]
     distance = euclidean(x1, y1, x2, y2, lat_lon_to_meters)
     # distance = haversine(x1, y1, x2, y2)             This is slightly over twice as slow.
-    return distance
\ No newline at end of file
+    return distance
+
+
+def distances_between_vertices(vertices: np.ndarray,
+                               indices1: np.ndarray, indices2: np.ndarray,
+                               lat_lon_to_meters) -> np.ndarray:
+    """
+    Batched version of distance_between_vertices, calculates the distance for many pairs of vertices at once.
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs representing the vertices of the polygon.
+        indices1 (numpy.ndarray): Indices of the first point of each pair.
+        indices2 (numpy.ndarray): Indices of the second point of each pair.
+        lat_lon_to_meters ([float, float]): The conversion rate from lat to meters and from lon to meters.
+
+    Returns:
+        numpy.ndarray: Distance between each pair of points in meters.
+    """
+    first = vertices[indices1]
+    second = vertices[indices2]
+    return euclidean(first[:, 0], first[:, 1], second[:, 0], second[:, 1], lat_lon_to_meters)
+
+
+def projection_errors(coordinates, meters, offsets):
+    """
+    Checks how far the local meters are from the real distances on the earth. For every polygon it compares the
+    planar and haversine distances from its first vertex to each of the others, and along each of its edges, all
+    polygons in one pass. The first lot are about the longest lines we ever measure and the edges cover the far
+    side of the lake, where the scale is furthest off. The errors are measured against the size of the lake, a few
+    centimeters on a short edge don't matter.
+
+    Parameters:
+        coordinates (numpy.ndarray): every vertex as (latitude, longitude), one polygon after another.
+        meters (numpy.ndarray): the same vertices in local meters, like PolygonStore.in_meters gives.
+        offsets (numpy.ndarray): polygon k is coordinates[offsets[k]:offsets[k + 1]].
+
+    Returns:
+        numpy.ndarray: for each polygon the worst error over its longest haversine distance, 0 for polygons with
+            fewer than 2 vertices.
+    """
+    from toolbox.store import ring_next  # store imports this module, so it can't be imported up top
+
+    counts = np.diff(offsets)
+    owners = np.repeat(np.arange(len(counts)), counts)
+    first = offsets[:-1][owners]
+    following = ring_next(offsets)  # the last edge wraps around
+
+    starts = np.concatenate([first, np.arange(len(owners))])
+    ends = np.concatenate([np.arange(len(owners)), following])
+    planar = np.hypot(*(meters[ends] - meters[starts]).T)
+    spherical = haversine(coordinates[starts, 0], coordinates[starts, 1], coordinates[ends, 0], coordinates[ends, 1])
+
+    errors = np.zeros(len(counts))
+    sizes = np.zeros(len(counts))
+    np.maximum.at(errors, np.tile(owners, 2), np.abs(planar - spherical))
+    np.maximum.at(sizes, np.tile(owners, 2), spherical)
+    return np.divide(errors, sizes, out=np.zeros(len(counts)), where=sizes > 0)
@@ -3,50 +3,177 @@ Helper functions in here to do various operations on polygons and preprocess the
 Pat and Kai developed this
 """
 
+import json
+import os
+from itertools import chain
 import numpy as np
 import pandas as pd
-import re
+from toolbox.metrics import METRICS
+from toolbox.store import PolygonStore
 
 
-def extract_numbers(input_string):
-    # regular expression to get all the numbers (thanks chatgpt for generating the expression)
-    return [float(x) for x in re.findall(r'-?\d+(?:\.\d+)?', input_string)]
+def _collect_polygons(geometry, feature, polygons):
+    """
+    Walks a GeoJSON geometry and adds each polygon it holds to the list as (feature, [outer ring, hole, hole, ...]).
+    Anything that isn't an area (points, lines) is skipped.
+    """
+    if not geometry:
+        return
+    kind = geometry.get('type')
+    if kind == 'Polygon':
+        if geometry['coordinates']:
+            polygons.append((feature, geometry['coordinates']))
+    elif kind == 'MultiPolygon':
+        polygons.extend((feature, rings) for rings in geometry['coordinates'] if rings)
+    elif kind == 'GeometryCollection':
+        for part in geometry['geometries']:
+            _collect_polygons(part, feature, polygons)
+
+
+def _flatten_rings(rings):
+    """
+    Turns a list of GeoJSON rings ([lon, lat] pairs) into one flat (lat, lon) array and the offsets of each ring.
+    """
+    counts = np.fromiter((len(ring) for ring in rings), dtype=np.int64, count=len(rings))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if offsets[-1] == 0:
+        return np.empty((0, 2)), offsets
 
+    lon_lat = np.array(list(chain.from_iterable(rings)), dtype=np.float64).reshape(-1, 2)
+    return lon_lat[:, ::-1], offsets
+
+
+def _parse_geometries_json(geo_strings) -> PolygonStore:
+    # the general path: let the json module build the geometries and walk them
+    geometries = json.loads('[' + ','.join(geo_strings) + ']')
+
+    polygons = []
+    for feature, geometry in enumerate(geometries):
+        _collect_polygons(geometry, feature, polygons)
 
-def find_polygons(numbers):
+    features = np.fromiter((feature for feature, _ in polygons), dtype=np.int64, count=len(polygons))
+    outer_rings = [rings[0] for _, rings in polygons]
+    holes = [(position, hole) for position, (_, rings) in enumerate(polygons) for hole in rings[1:]]
+
+    coordinates, offsets = _flatten_rings(outer_rings)
+    hole_coordinates, hole_offsets = _flatten_rings([hole for _, hole in holes])
+    hole_owners = np.fromiter((position for position, _ in holes), dtype=np.int64, count=len(holes))
+
+    return PolygonStore(coordinates, offsets, None, hole_coordinates, hole_offsets, hole_owners, features)
+
+
+# lookup tables for the characters we care about when reading the gee text
+_DIGIT = np.zeros(256, dtype=bool)
+_DIGIT[[ord(c) for c in '0123456789']] = True
+_NUMBER_START = _DIGIT.copy()
+_NUMBER_START[[ord(c) for c in '-+.']] = True
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[ord(c) for c in ' \t\r\n']] = True
+
+
+def _parse_polygons_by_brackets(geo_strings):
+    """
+    Fast path for exports that only hold Polygons and MultiPolygons, which is what reduceToVectors gives us.
+    Rather than building python lists for every vertex, this finds the structure from where the brackets are:
+        [[[x    opens a polygon (its list of rings)
+        [[x     opens a ring
+        [x      opens a vertex
+    and then reads every number in one numpy call.
+
+    Returns: a PolygonStore, or None if the text doesn't look the way we expect (the caller falls back to json).
     """
-    takes a list of lat-lons and extracts the polygons from the list.
+    row_lengths = geo_strings.str.len().to_numpy(dtype=np.int64) + 1  # +1 for the comma that joins them
+    row_starts = np.concatenate([[0], np.cumsum(row_lengths)[:-1]])
+
+    try:
+        text = ','.join(geo_strings).encode('ascii')
+    except UnicodeEncodeError:
+        return None
+
+    # squeeze out any whitespace so the bracket patterns below line up, and move the row starts with it
+    chars = np.frombuffer(text, dtype=np.uint8)
+    spaces = np.flatnonzero(_WHITESPACE[chars])
+    if len(spaces):
+        row_starts = row_starts - np.searchsorted(spaces, row_starts)
+        chars = np.delete(chars, spaces)
+    size = len(chars)
+    chars = np.concatenate([chars, np.zeros(3, dtype=np.uint8)])
+
+    opens = np.flatnonzero(chars == ord('['))
+    after_1 = chars[opens + 1]
+    after_2 = chars[opens + 2]
+    after_3 = chars[opens + 3]
+
+    vertex_opens = opens[_NUMBER_START[after_1]]
+    ring_opens = opens[(after_1 == ord('[')) & _NUMBER_START[after_2]]
+    polygon_opens = opens[(after_1 == ord('[')) & (after_2 == ord('[')) & _NUMBER_START[after_3]]
+    if len(vertex_opens) == 0:
+        return PolygonStore(np.empty((0, 2)), [0])
+
+    # blank out everything that can't be part of a number so numpy can read them all in one go. an 'e' only counts
+    # when it follows a digit (an exponent), otherwise it's from a word like "type"
+    number_text = chars[:size].copy()
+    is_number = _NUMBER_START[number_text]
+    exponent = (number_text == ord('e')) | (number_text == ord('E'))
+    exponent[1:] &= _DIGIT[number_text[:-1]]
+    exponent[0] = False
+    number_text[~(is_number | exponent)] = ord(' ')
+    # float() on every token raises on a mangled number ("1.2.3", a lone "-") instead of stopping short
+    try:
+        numbers = np.array(number_text.tobytes().decode('ascii').split(), dtype=np.float64)
+    except ValueError:
+        return None
+    if len(numbers) % 2 or len(numbers) != 2 * len(vertex_opens):
+        return None  # something other than [lon, lat] pairs, like a 3d coordinate or numbers in the properties
+
+    ring_of_vertex = np.searchsorted(ring_opens, vertex_opens, side='right') - 1
+    polygon_of_ring = np.searchsorted(polygon_opens, ring_opens, side='right') - 1
+    if len(ring_opens) == 0 or ring_of_vertex[0] < 0 or len(polygon_opens) == 0 or polygon_of_ring[0] < 0:
+        return None
+
+    ring_counts = np.bincount(ring_of_vertex, minlength=len(ring_opens))
+    is_outer = ring_opens == polygon_opens[polygon_of_ring] + 1
+    outer_vertex = is_outer[ring_of_vertex]
+    lat_lon = numbers.reshape(-1, 2)[:, ::-1]
+
+    return PolygonStore(lat_lon[outer_vertex],
+                        np.concatenate([[0], np.cumsum(ring_counts[is_outer])]),
+                        None,
+                        lat_lon[~outer_vertex],
+                        np.concatenate([[0], np.cumsum(ring_counts[~is_outer])]),
+                        polygon_of_ring[~is_outer],
+                        np.searchsorted(row_starts, polygon_opens, side='right') - 1)
+
+
+def parse_gee_geometries(geo_strings) -> PolygonStore:
+    """
+    Parses the '.geo' column of a google earth engine export into a PolygonStore.
 
-    Args:
-        numbers: a list of numbers corresponding to the data from gee
+    Exports that only have Polygons and MultiPolygons are read by looking at where the brackets are, everything
+    else goes through the json module. Either way each part of a MultiPolygon becomes its own polygon, and the holes
+    stay attached to the polygon they're cut out of instead of showing up as polygons of their own.
 
-    Returns: a list of polygons
+    Args:
+        geo_strings: the '.geo' column, one GeoJSON geometry per row
 
+    Returns: a PolygonStore with the polygons numbered 0, 1, 2, ... in the order they show up.
     """
-    # loop through the numbers
-    polygons = []
-    polygon = []
-    for i in range(0, len(numbers), 2):
-        x, y = numbers[i], numbers[i + 1]
-        if not polygon or [x, y] != polygon[0]:
-            # if you don't have anything in the polygon, or the polygon isn't closed add the point onto the list
-            polygon.append([x, y])
-        else:
-            # now that you have all the points close the polygon
-            polygon.append(polygon[0])
-            polygons.append(polygon)
-            polygon = []  # reset the polygon for the next one
-    return polygons
+    geo_strings = pd.Series(geo_strings, dtype=object).fillna('null').astype(str)
+
+    everything = ''.join(geo_strings)
+    if not any(kind in everything for kind in ('Point', 'LineString', 'GeometryCollection')):
+        store = _parse_polygons_by_brackets(geo_strings)
+        if store is not None:
+            return store
+
+    return _parse_geometries_json(geo_strings)
 
 
 def preprocess_polygons(df: pd.DataFrame) -> pd.DataFrame:
     """
     takes a dataframe in the format output by google earth engine and forms it into a dataframe that we can
-    work with that's in the format that Kai produced.  It does this by iterating through the rows of the dataframe
-    and parsing the strings with a regular expression.
-
-    there is probably a better way to do that though, and arguably we should explore how to vectorize this if we're
-    running into performance issues.
+    work with that's in the format that Kai produced. The '.geo' strings are parsed with parse_gee_geometries.
+    Only the outer ring of each polygon is kept, use read_polygons_from_csv if you need the holes.
 
     Args:
         df: the dataframe loaded from the .csv file
@@ -62,79 +189,141 @@ def preprocess_polygons(df: pd.DataFrame) -> pd.DataFrame:
         ...     ...         ...
 
     """
+    return parse_gee_geometries(df['.geo']).to_frame()[["Latitude", "Longitude", "Polygon"]]
 
-    # lists to hold the inevitable data we extract
-    latitudes = []
-    longitudes = []
-    numbering = []
-
-    # get the raw coordinates by parsing the text in the dataframe
-    raw_coordinates = sum([extract_numbers(polygon_row['.geo']) for _, polygon_row in df.iterrows()], [])
 
-    # convert those raw coordinates into polygons again
-    polygons = find_polygons(raw_coordinates)
+def read_polygons_from_csv(polygons_path, max_polygons=None) -> PolygonStore:
+    """
+    Read polygons from a CSV file.
 
-    # now loop through the data and build a dataframe
-    for i, polygon in enumerate(polygons):
-        for lon, lat in polygon:
-            numbering.append(i)
-            latitudes.append(lat)
-            longitudes.append(lon)
+    Parameters: 
+        polygons_path (str): File path to the CSV file containing polygon data.
+        max_polygons (int): The maximum number of polygons to load.
 
-    data = {"Latitude": latitudes,
-            "Longitude": longitudes,
-            "Polygon": numbering}
-    return pd.DataFrame(data)
+    Returns: 
+        PolygonStore: every polygon in the file, each one an array of (latitude, longitude) pairs, with its holes.
+    """
+    with METRICS.stage('load'):
+        df = pd.read_csv(polygons_path, usecols=['.geo'])
+    with METRICS.stage('parse'):
+        return parse_gee_geometries(df['.geo']).head(max_polygons)
 
 
-def read_polygons_from_csv(polygons_path, max_polygons=None):
+def iter_polygons_from_csv(polygons_path, chunksize=10_000, max_polygons=None):
     """
-    Read polygons from a CSV file.
+    Reads a gee export a chunk of rows at a time. Every row holds whole geometries, so the polygons of a chunk are
+    complete as soon as it's parsed and we never need more than one chunk in memory.
 
-    Parameters: 
+    Parameters:
         polygons_path (str): File path to the CSV file containing polygon data.
+        chunksize (int): how many rows to read at a time.
         max_polygons (int): The maximum number of polygons to load.
 
-    Returns: 
-        numpy.ndarray: Array of polygons, where each polygon is represented as an array of ordered pairs.
+    Yields:
+        PolygonStore: the polygons of each chunk. The ids and feature rows carry on from the previous chunk so they
+            match what read_polygons_from_csv would give for the whole file.
     """
-    polygons = {}
-    df = preprocess_polygons(pd.read_csv(polygons_path))
-    df.reset_index()
-    polygon_amount = 0
+    first_id = 0
+    first_row = 0
+    for chunk in pd.read_csv(polygons_path, usecols=['.geo'], chunksize=chunksize):
+        with METRICS.stage('parse'):
+            polygons = parse_gee_geometries(chunk['.geo'])
+        if max_polygons is not None:
+            polygons = polygons.head(max_polygons - first_id)
 
-    for index, row in df.iterrows():
-        if row['Polygon'] not in polygons.keys():
-            polygon_amount += 1
-            if max_polygons and polygon_amount > max_polygons:
-                break
+        polygons.ids += first_id
+        polygons.features += first_row
+        yield polygons
 
-            polygons[row['Polygon']] = []
+        first_id += len(polygons)
+        first_row += len(chunk)
+        if max_polygons is not None and first_id >= max_polygons:
+            return
 
-        polygons[row['Polygon']].append([row['Latitude'], row['Longitude']])
 
-    for key in polygons.keys():
-        polygons[key] = np.array(polygons[key])
+def export_polygons_from_raw_vertices(filename: str,
+                                      polygons,
+                                      first_id: int = 0,
+                                      append: bool = False) -> None:
+    """
+    Writes polygons to a csv in Kai's format (Polygon, Latitude, Longitude), numbering them first_id, first_id + 1, ...
 
-    return polygons
+    Args:
+        filename: where to write the csv
+        polygons: a PolygonStore, or a list of vertex arrays
+        first_id: the number to give the first polygon
+        append: add the rows to the end of an existing file (without a header) instead of starting a new one
+    """
+    if not isinstance(polygons, PolygonStore):
+        polygons = PolygonStore.from_vertices(polygons)
 
+    polygons.to_frame(ids=first_id + np.arange(len(polygons))).to_csv(
+        filename, index=False, mode='a' if append else 'w', header=not append)
 
+    return None
 
 
+# the arrays of a PolygonStore, each one saved to <name>.npy in a bundle directory
+_STORE_ARRAYS = ['coordinates', 'offsets', 'ids', 'hole_coordinates', 'hole_offsets', 'hole_owners', 'features']
 
-def export_polygons_from_raw_vertices(filename: str,
-                                      polygons: list[list]) -> None:
-    data = {"Polygon": [],
-            "Latitude": [],
-            "Longitude": []}
 
-    for polygon_number, polygon in enumerate(polygons):
-        for latitude, longitude in polygon:
-            data["Polygon"].append(polygon_number)
-            data["Latitude"].append(latitude)
-            data["Longitude"].append(longitude)
+def export_polygons_npy(directory: str, polygons) -> None:
+    """
+    Writes polygons as a bundle of .npy files (the flat coordinates, the offsets, the ids, ...), one per array of the
+    PolygonStore. Nothing has to be turned into text, and read_polygons_npy can map it back without parsing.
 
-    df = pd.DataFrame(data, columns=['Polygon', 'Latitude', 'Longitude'])
-    df.to_csv(filename, index=False)
+    Args:
+        directory: the folder to write the bundle into, made if it isn't there.
+        polygons: a PolygonStore, or a list of vertex arrays
+    """
+    if not isinstance(polygons, PolygonStore):
+        polygons = PolygonStore.from_vertices(polygons)
 
-    return None
+    os.makedirs(directory, exist_ok=True)
+    for name in _STORE_ARRAYS:
+        np.save(os.path.join(directory, f"{name}.npy"), getattr(polygons, name))
+
+
+def read_polygons_npy(directory: str, mmap=True) -> PolygonStore:
+    """
+    Reads a bundle written by export_polygons_npy.
+
+    Parameters:
+        directory (str): the bundle folder.
+        mmap (bool): map the files instead of reading them. Only the pages of the polygons you actually touch get
+            read off the disk, so pulling a few polygons (store[k], store.subset(...)) out of a huge bundle is quick.
+
+    Returns:
+        PolygonStore: backed by the files when mmap is on, treat it as read only.
+    """
+    arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None)
+              for name in _STORE_ARRAYS}
+    return PolygonStore(**arrays)
+
+
+def export_results_npy(path: str, df: pd.DataFrame) -> None:
+    """
+    Writes a results table as one .npy file of records, a field per column. Text columns (like 'Result') become
+    fixed width strings so the whole file can be memory mapped.
+    """
+    fields = []
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype.kind not in 'biuf':
+            values = values.astype(str)
+        fields.append((column, values.dtype))
+
+    records = np.empty(len(df), dtype=fields)
+    for column in df.columns:
+        records[column] = df[column].to_numpy().astype(records.dtype[column])
+    np.save(path, records)
+
+
+def read_results_npy(path: str, mmap=True) -> np.ndarray:
+    """
+    Reads a results table written by export_results_npy.
+
+    Returns: the records, memory mapped when mmap is on. Index them like a table (records['Result'], records[mask])
+        and only the rows you touch get read, pd.DataFrame(records) gives the whole thing as a dataframe.
+    """
+    return np.load(path, mmap_mode='r' if mmap else None)
@@ -0,0 +1,219 @@
+"""
+Loads the source of truth: the floatplane lakes (flight_data/lakes.csv) and the FAA facilities
+(flight_data/airports.csv), put together into one table of Lat, Long, floatplanes and LakeName, the same columns
+as flight_data/cleaned.csv.
+
+cleaned.csv used to be that table, edited by hand: 21 markers taken out (a glacier, a few seaplane bases and Mat-Su
+lakes like Horseshoe, Cottonwood and Kashwitna) and 9 moved onto the water (Alexander, Felt, Figure Eight, Nancy,
+Trinity, Tukallah, two on the Susitna River ...). Those edits live in flight_data/ground_truth_overrides.csv now and
+get applied after the csvs are parsed (see apply_overrides), so the table comes out the same as cleaned.csv. The one
+difference is WASILLA LAKE, which cleaned.csv has at 61.05 instead of 61.586, a typo that isn't carried over (along
+with two runways that are a millionth of a degree off from rounding). New hand edits go in the overrides file.
+
+The DMS coordinates ("61-10-53.9000N") are parsed a whole column at a time instead of one row at a time, and the
+finished table is saved as a typed .npy named after the hashes of the input files. Every run after the first just
+reads that file back, and editing any of the csvs gives a new name, so a stale table never gets used.
+"""
+
+import glob
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from toolbox.files import export_results_npy, read_results_npy
+from toolbox.manifest import file_hash
+from toolbox.polygons import points_in_polygon
+
+INGEST_VERSION = 2  # bump when the table changes so old cache files get ignored
+FLIGHT_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight_data')
+LAKES_PATH = os.path.join(FLIGHT_DATA, 'lakes.csv')
+AIRPORTS_PATH = os.path.join(FLIGHT_DATA, 'airports.csv')
+FLIGHTS_PATH = os.path.join(FLIGHT_DATA, 'flights.csv')
+OVERRIDES_PATH = os.path.join(FLIGHT_DATA, 'ground_truth_overrides.csv')
+SEAPLANE_BASE = "SEAPLANE BASE"
+GROUND_TRUTH_COLUMNS = ['Lat', 'Long', 'floatplanes', 'LakeName']
+
+
+def parse_dms(column: pd.Series) -> np.ndarray:
+    """
+    Converts degrees-minutes-seconds strings like "61-10-53.9000N" to decimal degrees, south and west negative.
+
+    Returns:
+        numpy.ndarray: the degrees, NaN where a value isn't in that format.
+    """
+    parts = column.astype(str).str.extract(r'^\s*(\d+)-(\d+)-(\d+(?:\.\d*)?)\s*([NSEW])\s*$')
+    degrees = (parts[0].astype(float) + parts[1].astype(float) / 60 + parts[2].astype(float) / 3600).to_numpy()
+    return np.where(parts[3].isin(['S', 'W']).to_numpy(), -degrees, degrees)
+
+
+def read_faa_facilities(path=AIRPORTS_PATH, types=(SEAPLANE_BASE,)) -> pd.DataFrame:
+    """
+    Reads the FAA facility list. A facility listed more than once (the same LocationID, like when two exports get
+    pasted together) is kept once, with its newest EffectiveDate. Rows without a usable position are dropped.
+
+    Parameters:
+        path (str): the FAA airports csv.
+        types (tuple[str]): the facility types to keep, None for all of them (airports, heliports, ...).
+
+    Returns:
+        a dataframe with LocationID, FacilityName, Type, Lat and Long, one row per facility.
+    """
+    df = pd.read_csv(path, usecols=['LocationID', 'Type', 'FacilityName', 'EffectiveDate',
+                                    'ARPLatitude', 'ARPLongitude'], dtype=str)
+    if types is not None:
+        df = df[df['Type'].isin(types)]
+
+    facilities = pd.DataFrame({'LocationID': df['LocationID'].str.lstrip("'").str.strip().to_numpy(),
+                               'FacilityName': df['FacilityName'].to_numpy(),
+                               'Type': df['Type'].to_numpy(),
+                               'Lat': parse_dms(df['ARPLatitude']),
+                               'Long': parse_dms(df['ARPLongitude']),
+                               'EffectiveDate': pd.to_datetime(df['EffectiveDate'], format='%m/%d/%Y',
+                                                               errors='coerce').to_numpy()})
+    facilities = facilities.dropna(subset=['Lat', 'Long'])
+    newest_first = facilities.sort_values('EffectiveDate', ascending=False, kind='stable', na_position='last')
+    keep = np.sort(newest_first.drop_duplicates('LocationID').index.to_numpy())
+    return facilities.loc[keep].drop(columns='EffectiveDate').reset_index(drop=True)
+
+
+def apply_overrides(df: pd.DataFrame, overrides_path=OVERRIDES_PATH) -> pd.DataFrame:
+    """
+    Applies the hand edits from the overrides csv. Each of its rows picks out one marker by LakeName, floatplanes,
+    Lat and Long (to 6 decimals): Action 'drop' takes it out, 'move' puts it at NewLat, NewLong. An edit that
+    doesn't match any marker anymore (lakes.csv or airports.csv changed under it) is skipped and printed.
+
+    Returns:
+        df with the edits applied, the rest of the rows as they were and in the same order.
+    """
+    overrides = pd.read_csv(overrides_path)
+    unknown = set(overrides['Action']) - {'drop', 'move'}
+    if unknown:
+        raise ValueError(f"Unknown override action(s) {sorted(unknown)} in {overrides_path}, expected 'drop' or 'move'")
+
+    keys = ['LakeName', 'floatplanes', 'Lat', 'Long']
+    markers = pd.DataFrame({'LakeName': df['LakeName'].astype(str).to_numpy(),
+                            'floatplanes': df['floatplanes'].to_numpy(dtype=np.int64),
+                            'Lat': df['Lat'].round(6).to_numpy(), 'Long': df['Long'].round(6).to_numpy(),
+                            'Row': np.arange(len(df))})
+    edits = overrides.assign(LakeName=overrides['LakeName'].astype(str),
+                             floatplanes=overrides['floatplanes'].astype(np.int64),
+                             Lat=overrides['Lat'].round(6), Long=overrides['Long'].round(6))
+    edits = edits.merge(markers, on=keys, how='left')
+
+    unmatched = edits['Row'].isna()
+    if unmatched.any():
+        print(f"{unmatched.sum()} ground truth overrides didn't match a marker and were skipped: "
+              f"{', '.join(edits.loc[unmatched, 'LakeName'])}")
+    edits = edits[~unmatched]
+    rows = edits['Row'].to_numpy(dtype=np.int64)
+    move = (edits['Action'] == 'move').to_numpy()
+
+    latitudes, longitudes = df['Lat'].to_numpy(dtype=np.float64).copy(), df['Long'].to_numpy(dtype=np.float64).copy()
+    latitudes[rows[move]] = edits['NewLat'].to_numpy(dtype=np.float64)[move]
+    longitudes[rows[move]] = edits['NewLong'].to_numpy(dtype=np.float64)[move]
+    keep = np.ones(len(df), dtype=bool)
+    keep[rows[~move]] = False
+    return df.assign(Lat=latitudes, Long=longitudes)[keep].reset_index(drop=True)
+
+
+def build_ground_truth(lakes_path=LAKES_PATH, airports_path=AIRPORTS_PATH,
+                       overrides_path=OVERRIDES_PATH) -> pd.DataFrame:
+    """
+    Puts the lakes and every FAA facility into one table. The lakes and seaplane bases get floatplanes = 1, the
+    other facilities 0. Rows at the same spot with the same floatplanes flag are only kept once. Then the hand edits
+    in overrides_path go on top, see apply_overrides (None leaves them out).
+
+    Returns:
+        a dataframe with GROUND_TRUTH_COLUMNS, lakes first.
+    """
+    lakes = pd.read_csv(lakes_path, usecols=['LakeName', 'Lat', 'Long'])
+    facilities = read_faa_facilities(airports_path, types=None)
+
+    df = pd.concat([pd.DataFrame({'Lat': lakes['Lat'].to_numpy(dtype=np.float64),
+                                  'Long': lakes['Long'].to_numpy(dtype=np.float64),
+                                  'floatplanes': np.ones(len(lakes), dtype=np.int64),
+                                  'LakeName': lakes['LakeName'].fillna('').astype(str).to_numpy()}),
+                    pd.DataFrame({'Lat': facilities['Lat'].to_numpy(),
+                                  'Long': facilities['Long'].to_numpy(),
+                                  'floatplanes': (facilities['Type'] == SEAPLANE_BASE).to_numpy(dtype=np.int64),
+                                  'LakeName': facilities['FacilityName'].fillna('').astype(str).to_numpy()})],
+                   ignore_index=True)
+    df = df.dropna(subset=['Lat', 'Long'])
+    df = df.drop_duplicates(['Lat', 'Long', 'floatplanes'], ignore_index=True)[GROUND_TRUTH_COLUMNS]
+    return df if overrides_path is None else apply_overrides(df, overrides_path)
+
+
+def ground_truth_key(lakes_path=LAKES_PATH, airports_path=AIRPORTS_PATH, overrides_path=OVERRIDES_PATH) -> str:
+    """
+    Returns: a short hash of the input files (the overrides too, if there are any) and INGEST_VERSION, the name the
+        cached table is saved under.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    overrides = 'no overrides' if overrides_path is None else file_hash(overrides_path)
+    for part in [str(INGEST_VERSION), file_hash(lakes_path), file_hash(airports_path), overrides]:
+        digest.update(part.encode())
+    return digest.hexdigest()
+
+
+def load_ground_truth(lakes_path=LAKES_PATH, airports_path=AIRPORTS_PATH, cache_dir=FLIGHT_DATA,
+                      region=None, overrides_path=OVERRIDES_PATH) -> pd.DataFrame:
+    """
+    Loads the source of truth, from the cache if these exact input files were loaded before.
+
+    Parameters:
+        lakes_path (str): the lakes csv.
+        airports_path (str): the FAA airports csv.
+        cache_dir (str): where the cached table goes, None to skip the cache.
+        region (numpy.ndarray): optional region of interest. When given only the floatplane rows inside it are
+            returned, with a roi column, the way the stats want them (see filter_ground_truth).
+        overrides_path (str): the hand edits to apply, see apply_overrides. None for the csvs as they are.
+
+    Returns:
+        a dataframe with GROUND_TRUTH_COLUMNS.
+    """
+    if cache_dir is None:
+        df = build_ground_truth(lakes_path, airports_path, overrides_path)
+    else:
+        key = ground_truth_key(lakes_path, airports_path, overrides_path)
+        cache_path = os.path.join(cache_dir, f"ground_truth_{key}.npy")
+        if os.path.exists(cache_path):
+            df = pd.DataFrame(read_results_npy(cache_path, mmap=False))
+            df['LakeName'] = df['LakeName'].astype(str)
+        else:
+            df = build_ground_truth(lakes_path, airports_path, overrides_path)
+            # the old tables are for inputs that don't exist anymore
+            for old_path in glob.glob(os.path.join(cache_dir, "ground_truth_*.npy")):
+                os.remove(old_path)
+            os.makedirs(cache_dir, exist_ok=True)
+            export_results_npy(cache_path, df)
+
+    return df if region is None else filter_ground_truth(df, region)
+
+
+def filter_ground_truth(df: pd.DataFrame, region) -> pd.DataFrame:
+    """
+    Returns: the floatplane rows of df inside region, with roi set to True. Both checks run over whole columns.
+    """
+    in_region = points_in_polygon(region, df[['Lat', 'Long']].to_numpy(dtype=np.float64))
+    working_df = df[(df['floatplanes'] == 1).to_numpy() & in_region].copy()
+    working_df['roi'] = True
+    return working_df
+
+
+def read_flight_destinations(flights_path=FLIGHTS_PATH, lakes_path=LAKES_PATH) -> pd.DataFrame:
+    """
+    The lakes the flights in the paper land on. flights.csv has one row per route (StartID to DestID) and only the
+    size of the destination, the position comes from the matching LakeID in lakes.csv.
+
+    Returns:
+        a dataframe with DestID, LakeName, Lat, Long, Dest_sqkm and Flights (AnnualFl_1 summed over every route into
+        the lake), one row per destination. Destinations that aren't in lakes.csv are dropped.
+    """
+    flights = pd.read_csv(flights_path, usecols=['DestID', 'AnnualFl_1', 'Dest_sqkm'])
+    lakes = pd.read_csv(lakes_path, usecols=['LakeID', 'LakeName', 'Lat', 'Long']).drop_duplicates('LakeID')
+
+    destinations = flights.groupby('DestID', sort=False).agg(Dest_sqkm=('Dest_sqkm', 'first'),
+                                                             Flights=('AnnualFl_1', 'sum')).reset_index()
+    destinations = destinations.merge(lakes, left_on='DestID', right_on='LakeID', how='inner')
+    return destinations[['DestID', 'LakeName', 'Lat', 'Long', 'Dest_sqkm', 'Flights']]
@@ -0,0 +1,250 @@
+"""
+The landability stage of the pipeline: runs the hull check and the chosen engine over a store of polygons and works
+out the numbers that go in the results file. It lives here instead of main.py so worker processes can import it.
+"""
+
+from collections import Counter
+from functools import partial
+import numpy as np
+import pandas as pd
+from toolbox.polygons import (LANDABILITY_ENGINES, LONGEST_LENGTH_ENGINES, has_length_within_polygon_exact,
+                              has_length_within_polygon_raster, has_length_within_polygon_simplified,
+                              planar_hull_diameter)
+from toolbox.raster import raster_screen
+from toolbox.shapes import polygon_shapes
+from toolbox.store import PolygonStore
+from toolbox.cache import ResultCache, polygon_key
+from toolbox.metrics import METRICS
+
+
+RESULT_COLUMNS = ['Polygon', 'Latitude', 'Longitude', 'Result', 'Perimeter']
+LENGTH_COLUMNS = ['Polygon', 'Latitude', 'Longitude', 'Perimeter', 'Diameter', 'Longest Edge', 'Longest']
+
+
+def evaluate_polygons(polygons: PolygonStore,
+                      target_meters: float,
+                      has_length_within_polygon,
+                      counts: Counter,
+                      visualize=False,
+                      print_info=False,
+                      cache: ResultCache = None,
+                      simplify_meters=None,
+                      budget_seconds=None):
+    """
+    Runs the landability check on every polygon in a store and works out the numbers that go in the results file.
+
+    Parameters:
+        polygons (PolygonStore): the polygons to check.
+        target_meters (float): the distance that we are checking for within the polygon
+        has_length_within_polygon: the engine, one of the values of LANDABILITY_ENGINES.
+        counts (Counter): running tallies ('passed', 'failed', 'hull', 'engine'), updated in place so they can be
+            carried across chunks.
+        visualize (bool): If True, the algorithm will be visualized.
+        print_info (bool): If True, print the information on each of the passing polygons.
+        cache (ResultCache): optional cache of engine verdicts, checked before calling the engine. Hits and misses
+            are tallied in counts as 'cache_hits' and 'cache_misses'. A hit decides the polygon without the engine,
+            so it isn't counted under 'engine'.
+        simplify_meters (float): if set, search a simplified copy of each polygon first, see
+            has_length_within_polygon_simplified. The vertices before and after are tallied in counts as
+            'original_vertices' and 'searched_vertices'.
+        budget_seconds (float): optional time limit for the engine on each polygon. A polygon it runs out on gets
+            "Fails*", counts as failed, is tallied in counts as 'out_of_budget' and doesn't go in the cache.
+
+    With the raster engine the whole store is screened at once first (see raster_screen), only the borderline
+    polygons go through the exact engine one at a time. The ones the screen settles are tallied in counts as 'raster'.
+
+    return:
+        (list of result rows, list of the positions of the passing polygons in the store)
+    """
+    engine_name = has_length_within_polygon.__name__
+    screened = None
+    if has_length_within_polygon is has_length_within_polygon_raster and not visualize:
+        screened = raster_screen(polygons, target_meters)
+        has_length_within_polygon = has_length_within_polygon_exact
+    if budget_seconds is not None:
+        has_length_within_polygon = partial(has_length_within_polygon, budget_seconds=budget_seconds)
+
+    with METRICS.stage('landability'):
+        return _evaluate_polygons(polygons, target_meters, has_length_within_polygon, engine_name, counts, visualize,
+                                  print_info, cache, simplify_meters, screened)
+
+
+def _evaluate_polygons(polygons, target_meters, has_length_within_polygon, engine_name, counts, visualize,
+                       print_info, cache, simplify_meters, screened):
+    polygon_results = []
+    passing_polygons = []  # positions of the passing polygons in the store
+
+    # the location, perimeter and edge numbers of every polygon in one go
+    shapes = polygon_shapes(polygons)
+    latitudes, longitudes, perimeters = shapes[['Latitude', 'Longitude', 'Perimeter']].to_numpy().T
+
+    for position, (polygon, vertices) in enumerate(polygons.items()):
+        METRICS.observe_vertices(len(vertices))
+        # the store projects every polygon once, the hull check and the engine both work on those same rings
+        rings = polygons.rings_in_meters(position)
+
+        # nothing inside the polygon is longer than its hull diameter, so most polygons never need the pair search
+        if screened is not None and screened[position] is not None:
+            solution = screened[position]
+            counts['raster'] += 1
+        elif planar_hull_diameter(rings[0]) < target_meters:
+            solution = "Fails"
+            counts['hull'] += 1
+        else:
+            holes = polygons.holes(position)
+            key = None
+            solution = None
+            if cache is not None and not visualize:
+                key = polygon_key(vertices, holes, target_meters,
+                                  f"{engine_name}|simplify={simplify_meters}")
+                solution = cache.get(key)
+                counts['cache_hits' if solution is not None else 'cache_misses'] += 1
+            if solution is None:
+                if simplify_meters:
+                    solution, searched_vertices = has_length_within_polygon_simplified(
+                        vertices, target_meters, has_length_within_polygon, simplify_meters, visualize, holes=holes,
+                        meters=rings)
+                    counts['original_vertices'] += len(vertices) + sum(len(hole) for hole in holes)
+                    counts['searched_vertices'] += searched_vertices
+                else:
+                    solution = has_length_within_polygon(vertices, target_meters, visualize, holes=holes, meters=rings)
+                if solution == "Fails*":
+                    counts['out_of_budget'] += 1
+                elif key is not None:
+                    cache.put(key, solution)
+                counts['engine'] += 1
+        location = (latitudes[position], longitudes[position])
+        perimeter = perimeters[position]
+
+        polygon_results.append((int(polygon), location[0], location[1], solution, perimeter))
+        if print_info and solution == "Passes":
+            shape = shapes.iloc[position]
+            printable_info = [
+                f"Polygon {polygon:>6.0f}: {solution:<10} ",
+                f"Lat,Lon: ({location[0]}, {location[1]}), # vertices: {len(vertices)}, "
+                f"Edge mean: {shape['Edge Mean']:.3f},",
+                f"Edge std: {shape['Edge Std']:.3f}, Perimeter: {perimeter:>10},",
+                f", Edge Min Length {shape['Edge Min']}, Edge Max Length {shape['Edge Max']},",
+                f"Area: {shape['Area']:.0f}, Compactness: {shape['Compactness']:.3f}"
+            ]
+            print(" ".join(printable_info))
+
+        if solution.startswith('Fails'):
+            counts['failed'] += 1
+        else:
+            # print(np.array2string(vertices, separator=', '))
+            passing_polygons.append(position)
+            counts['passed'] += 1
+
+    return polygon_results, passing_polygons
+
+
+def print_summary(counts: Counter, engine: str) -> None:
+    total = counts['passed'] + counts['failed']
+    percent_passed = (100 * counts['passed']) / total if total else 0.0
+
+    print()
+    print(f"Results:")
+    print(f"{total} total polygons.")
+    print(f"{counts['passed']} polygons passed.")
+    print(f"{counts['failed']} polygons failed.")
+    print(f"{percent_passed:.1f}% of the polygons passed.")
+    if counts['raster']:
+        print(f"{counts['raster']} polygons decided by the raster screen.")
+    print(f"{counts['hull']} polygons decided by the hull diameter check.")
+    if counts['cache_hits']:
+        print(f"{counts['cache_hits']} polygons decided by a cached verdict.")
+    print(f"{counts['engine']} polygons decided by the '{engine}' engine.")
+    if counts['out_of_budget']:
+        print(f"{counts['out_of_budget']} polygons ran out of search budget and were counted as failed.")
+
+    if counts['searched_vertices']:
+        print(f"Simplifying cut the searched vertices from {counts['original_vertices']} to "
+              f"{counts['searched_vertices']} ({counts['original_vertices'] / counts['searched_vertices']:.1f}x fewer).")
+
+    lookups = counts['cache_hits'] + counts['cache_misses']
+    if lookups:
+        print(f"{counts['cache_hits']} of {lookups} engine verdicts came from the cache "
+              f"({100 * counts['cache_hits'] / lookups:.1f}% hit rate).")
+
+
+def evaluate_shard(polygons: PolygonStore, target_meters: float, engine: str, visualize=False, cache_path=None,
+                   simplify_meters=None, collect_metrics=False, budget_seconds=None):
+    """
+    Entry point for a worker process: evaluates one shard of polygons with the engine named by engine. Each worker
+    opens its own connection to the cache at cache_path, if there is one. A worker has its own METRICS, so with
+    collect_metrics they get recorded fresh for the shard and sent back to be merged into the parent's.
+
+    Returns: (list of result rows, positions of the passing polygons in the shard, Counter of tallies,
+        the shard's Metrics or None)
+    """
+    METRICS.reset()
+    METRICS.enable(collect_metrics)
+    counts = Counter()
+    cache = ResultCache(cache_path) if cache_path else None
+    try:
+        polygon_results, passing_polygons = evaluate_polygons(polygons, target_meters, LANDABILITY_ENGINES[engine],
+                                                              counts, visualize, cache=cache,
+                                                              simplify_meters=simplify_meters,
+                                                              budget_seconds=budget_seconds)
+    finally:
+        if cache is not None:
+            cache.close()
+    return polygon_results, passing_polygons, counts, METRICS if collect_metrics else None
+
+
+def evaluate_polygon_lengths(polygons: PolygonStore, engine: str, cap_meters=np.inf, floor_meters=0.0,
+                             counts: Counter = None):
+    """
+    Instead of a Passes / Fails for one target, works out how long each polygon's longest straight line is, so any
+    number of targets can be answered afterwards with verdicts_for_target.
+
+    Parameters:
+        polygons (PolygonStore): the polygons to measure.
+        engine (str): a key of LONGEST_LENGTH_ENGINES.
+        cap_meters (float): the biggest target anyone will ask about. Once a polygon has a line this long the search
+            stops, so its Longest is only guaranteed to be at least cap_meters.
+        floor_meters (float): the smallest target anyone will ask about. Polygons that can't reach it get a Longest
+            of nan instead of a measurement, which skips most of the work on small ponds.
+        counts (Counter): optional running tallies, 'measured' is bumped for every polygon that gets the full
+            search and 'hull' for the ones the hull diameter rules out.
+
+    return:
+        a dataframe with LENGTH_COLUMNS. Diameter is the hull diameter and Longest Edge is there so the naive
+        verdicts come out the same as a normal run.
+    """
+    longest_length_within_polygon = LONGEST_LENGTH_ENGINES[engine]
+    counts = Counter() if counts is None else counts
+    rows = []
+    latitudes, longitudes, perimeters, longest_edges = polygon_shapes(polygons)[
+        ['Latitude', 'Longitude', 'Perimeter', 'Edge Max']].to_numpy().T
+    for position, (polygon, vertices) in enumerate(polygons.items()):
+        # the store projects every polygon once, the engine works on those same rings
+        rings = polygons.rings_in_meters(position)
+        diameter = planar_hull_diameter(rings[0])
+        if diameter < floor_meters:
+            longest = np.nan
+            counts['hull'] += 1
+        else:
+            longest = longest_length_within_polygon(vertices, cap_meters, holes=polygons.holes(position),
+                                                    floor_meters=floor_meters, meters=rings)
+            longest = np.nan if longest < floor_meters else longest
+            counts['measured'] += 1
+        rows.append((int(polygon), latitudes[position], longitudes[position], perimeters[position], diameter,
+                     longest_edges[position], longest))
+    return pd.DataFrame(rows, columns=LENGTH_COLUMNS)
+
+
+def verdicts_for_target(lengths: pd.DataFrame, target_meters: float, engine: str) -> pd.Series:
+    """
+    Looks up the verdict every polygon would get from evaluate_polygons with this target_meters, using the lengths
+    from evaluate_polygon_lengths. Only right for targets up to the cap_meters the lengths were measured with.
+
+    return:
+        a series of "Passes", "Fails" or "Passes*" (naive engine, target shorter than the longest edge)
+    """
+    passes = (lengths['Diameter'] >= target_meters) & (lengths['Longest'] >= target_meters)
+    verdicts = np.where(passes, "Passes", "Fails")
+    if engine == 'naive':
+        verdicts = np.where(passes & (target_meters // lengths['Longest Edge'] == 0), "Passes*", verdicts)
+    return pd.Series(verdicts, index=lengths.index, name=f"Result {target_meters:g}")
@@ -0,0 +1,122 @@
+"""
+Keeps track of which input csvs have already been run, so a rerun only redoes the files that are new or changed.
+The manifest is a small json file that remembers, for every csv, the hash of its contents, where its successful
+polygons were saved and which block of global polygon ids it owns. A file keeps its block as long as it fits, so
+re-exporting one GEE tile doesn't renumber the lakes of every other tile.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+def file_hash(path, block_size=1 << 20) -> str:
+    """
+    Returns: the hex blake2b hash of a file's contents.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path, params: dict) -> dict:
+    """
+    Loads the manifest at path. If there isn't one yet, or it was made with different params (a different
+    target_meters, engine, ...), every stored result is stale and we start from an empty manifest.
+
+    Args:
+        path: where the manifest lives.
+        params: everything besides the input files that changes the results, has to be json friendly.
+
+    Returns: a dict with 'version', 'params' and 'files' (csv path -> entry).
+    """
+    empty = {'version': MANIFEST_VERSION, 'params': params, 'files': {}}
+    if not os.path.exists(path):
+        return empty
+
+    with open(path) as file:
+        manifest = json.load(file)
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('params') != json.loads(json.dumps(params)):
+        return empty
+    return manifest
+
+
+def save_manifest(path, manifest: dict) -> None:
+    # write to a temporary file first so a crash halfway through can't leave a broken manifest behind
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temporary_path, path)
+
+
+def stale_files(manifest: dict, csv_list: list, hashes: dict) -> list:
+    """
+    Returns: the csvs from csv_list that are new, changed, or whose saved output has gone missing.
+    """
+    stale = []
+    for csv_file in csv_list:
+        entry = manifest['files'].get(csv_file)
+        if entry is None or entry['hash'] != hashes[csv_file] or not os.path.exists(entry['output']):
+            stale.append(csv_file)
+    return stale
+
+
+def assign_id_block(manifest: dict, csv_file: str, polygon_count: int) -> int:
+    """
+    Picks the first global polygon id for a file's polygons. A file keeps the block it had before as long as its new
+    polygons still fit in it; otherwise (or if it's new) it gets a fresh block after every id handed out so far.
+    The ids of the other files never move.
+
+    Returns: the first id of the block, the file's polygons get first_id, first_id + 1, ...
+    """
+    entries = manifest['files']
+    entry = entries.get(csv_file)
+    if entry is not None and polygon_count <= entry['id_span']:
+        return entry['first_id']
+
+    next_free = max((other['first_id'] + other['id_span'] for name, other in entries.items() if name != csv_file),
+                    default=1)
+    if entry is not None and entry['first_id'] >= next_free:
+        # it's already the last block, so it can just grow in place
+        return entry['first_id']
+    return next_free
+
+
+def record_file(manifest: dict, csv_file: str, content_hash: str, output: str, first_id: int, polygon_count: int):
+    """
+    Updates the manifest entry of a file that was just processed.
+    """
+    entry = manifest['files'].get(csv_file)
+    id_span = polygon_count
+    if entry is not None and entry['first_id'] == first_id:
+        id_span = max(id_span, entry['id_span'])  # hang on to the whole block even if the file shrank
+    manifest['files'][csv_file] = {'hash': content_hash, 'output': output, 'first_id': int(first_id),
+                                   'id_span': int(id_span)}
+
+
+def outputs_current(stamp_path, inputs: dict, outputs: list) -> bool:
+    """
+    Checks whether files made from the results (the stats, the map, ...) can be kept as they are: every one of them
+    has to still be there, and they have to have been made from exactly these inputs.
+
+    Args:
+        stamp_path: the small json save_outputs_stamp wrote after making them.
+        inputs: name -> hash of everything the outputs are made from, has to be json friendly.
+        outputs: the paths of the files.
+    """
+    if not os.path.exists(stamp_path) or not all(os.path.exists(output) for output in outputs):
+        return False
+    with open(stamp_path) as file:
+        stamp = json.load(file)
+    return stamp == {'version': MANIFEST_VERSION, 'inputs': json.loads(json.dumps(inputs))}
+
+
+def save_outputs_stamp(stamp_path, inputs: dict) -> None:
+    """
+    Remembers which inputs the outputs were just made from, see outputs_current.
+    """
+    save_manifest(stamp_path, {'version': MANIFEST_VERSION, 'inputs': inputs})
@@ -0,0 +1,138 @@
+"""
+Counters and timers for finding out where a run spends its time: how long each stage took, how many vertices and
+diagonals went through the engines, how often they got to stop early, and the peak memory. Everything goes through
+the one METRICS object. It starts off disabled, and while it's disabled every call returns straight away, so the
+calls can stay in the hot paths for good.
+
+    from toolbox.metrics import METRICS
+    METRICS.enable()
+    ... run the pipeline ...
+    METRICS.export_json("run_metrics.json")
+"""
+
+import json
+import sys
+from collections import Counter
+from contextlib import nullcontext
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+_DISABLED_STAGE = nullcontext()
+
+
+def peak_memory_mb():
+    """
+    Returns: the most memory this process has held so far in MB, or None where we can't tell.
+    """
+    if resource is None:
+        return None
+    # linux reports kilobytes, macos bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class _Stage:
+    # times one pass through a stage and remembers the memory high water mark when it's done
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, perf_counter() - self.start)
+        peak = peak_memory_mb()
+        if peak is not None:
+            self.metrics.peak_memory_mb = max(self.metrics.peak_memory_mb, peak)
+
+
+class Metrics:
+    """
+    Attributes:
+        enabled (bool): nothing gets recorded unless this is True.
+        counters (Counter): named tallies, like 'naive.diagonals'.
+        timings (Counter): total seconds spent in each stage.
+        calls (Counter): how many times each stage ran.
+        vertex_histogram (Counter): how many polygons had 2^(k-1) <= vertices < 2^k, keyed by k.
+        peak_memory_mb (float): the highest peak memory seen at the end of a stage.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.counters = Counter()
+        self.timings = Counter()
+        self.calls = Counter()
+        self.vertex_histogram = Counter()
+        self.peak_memory_mb = 0.0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.timings[name] += seconds
+            self.calls[name] += 1
+
+    def stage(self, name):
+        """
+        Context manager that times the code inside it as one pass through stage name.
+        """
+        return _Stage(self, name) if self.enabled else _DISABLED_STAGE
+
+    def observe_vertices(self, num_vertices):
+        if self.enabled:
+            self.vertex_histogram[int(num_vertices).bit_length()] += 1
+            self.counters['vertices'] += int(num_vertices)
+            self.counters['polygons'] += 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns: everything recorded so far as plain dicts, plus the early exit rates of the engines.
+        """
+        rates = {}
+        for engine in ('naive', 'exact'):
+            searched = self.counters[f'{engine}.polygons']
+            if searched:
+                rates[f'{engine}.early_exit_rate'] = self.counters[f'{engine}.early_exits'] / searched
+
+        return {
+            "timings": dict(self.timings),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+            "rates": rates,
+            "vertex_histogram": {f"{1 << (k - 1) if k else 0}-{(1 << k) - 1}": count
+                                 for k, count in sorted(self.vertex_histogram.items())},
+            "peak_memory_mb": self.peak_memory_mb,
+        }
+
+    def merge(self, other: "Metrics"):
+        """
+        Adds in what another Metrics recorded, like the one a worker process sends back.
+        """
+        self.counters.update(other.counters)
+        self.timings.update(other.timings)
+        self.calls.update(other.calls)
+        self.vertex_histogram.update(other.vertex_histogram)
+        self.peak_memory_mb = max(self.peak_memory_mb, other.peak_memory_mb)
+
+    def export_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+
+METRICS = Metrics()
@@ -0,0 +1,53 @@
+"""
+Finds the closest of a set of (latitude, longitude) points to each of another set, like the closest seaplane base to
+every lake, or the closest lake to every flight destination. The targets go in a spatial tree and each point is one
+query against it, instead of measuring every point against every target.
+
+The tree holds points on the unit sphere in 3d. The straight line (chord) between two of those grows with the great
+circle distance, so the closest by chord is the closest by haversine too, and a kd tree on 3d points is several
+times faster than sklearn's haversine ball tree.
+"""
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+EARTH_RADIUS_METERS = 6371000.0  # the same earth haversine in toolbox/distance.py uses
+
+
+def unit_vectors(points) -> np.ndarray:
+    """
+    Returns: (n, 3) points on the unit sphere for (n, 2) (latitude, longitude) points in degrees.
+    """
+    latitude, longitude = np.radians(np.asarray(points, dtype=float).reshape(-1, 2)).T
+    return np.column_stack([np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude),
+                            np.sin(latitude)])
+
+
+def build_point_tree(targets) -> KDTree:
+    """
+    Returns: the tree over (n, 2) (latitude, longitude) targets that nearest_points searches.
+    """
+    return KDTree(unit_vectors(targets))
+
+
+def nearest_points(points, targets, tree: KDTree = None):
+    """
+    Finds the closest target to each point.
+
+    Parameters:
+        points (numpy.ndarray): (n, 2) array of (latitude, longitude).
+        targets (numpy.ndarray): (m, 2) array of (latitude, longitude).
+        tree (KDTree): optional tree from build_point_tree over targets, so it can be reused for more queries.
+
+    Returns:
+        tuple: (the position in targets of each point's closest target, the great circle distance to it in meters).
+            With no targets the positions are -1 and the distances nan.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    if len(points) == 0 or len(targets) == 0:
+        return np.full(len(points), -1, dtype=np.int64), np.full(len(points), np.nan)
+
+    tree = tree or build_point_tree(targets)
+    chords, positions = tree.query(unit_vectors(points), k=1)
+    return positions[:, 0], 2 * np.arcsin(np.minimum(chords[:, 0] / 2, 1.0)) * EARTH_RADIUS_METERS
@@ -0,0 +1,104 @@
+"""
+Runs the landability stage on a process pool. The work gets cut into shards across files and across polygons within
+a file, sized by how much work they are rather than how many polygons they hold: the pair search grows with the
+square of the vertex count, so one big river polygon can cost more than thousands of small ponds.
+"""
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from toolbox.landability import evaluate_shard
+from toolbox.metrics import METRICS
+
+
+def polygon_costs(vertex_counts):
+    """
+    Estimated work for each polygon, proportional to its vertex count squared.
+    """
+    vertex_counts = np.asarray(vertex_counts, dtype=np.float64)
+    return vertex_counts * vertex_counts
+
+
+def plan_shards(vertex_counts_per_file, workers, shards_per_worker=4):
+    """
+    Cuts the polygons of every file into contiguous shards of roughly equal cost. Polygons that cost more than a
+    shard on their own get a shard to themselves so they can start right away on their own worker.
+
+    Parameters:
+        vertex_counts_per_file (list[numpy.ndarray]): the vertex count of every polygon, one array per file.
+        workers (int): how many processes will run the shards.
+        shards_per_worker (int): more shards per worker gives smoother load balancing but more overhead.
+
+    Returns:
+        list[tuple]: (file_index, start, stop, cost) for each shard, most expensive first. Running them in that order
+            (longest processing time first) keeps one big shard from being the last thing left running.
+    """
+    costs_per_file = [polygon_costs(counts) for counts in vertex_counts_per_file]
+    total_cost = sum(costs.sum() for costs in costs_per_file)
+    target_cost = max(total_cost / max(workers * shards_per_worker, 1), 1.0)
+
+    shards = []
+    for file_index, costs in enumerate(costs_per_file):
+        if len(costs) == 0:
+            continue
+
+        # which bucket each polygon falls in if we lay the costs end to end, plus cuts around any huge polygon
+        bucket = (np.cumsum(costs) - costs) // target_cost
+        huge = np.flatnonzero(costs >= target_cost)
+        cuts = np.union1d(np.flatnonzero(np.diff(bucket)) + 1, np.concatenate([huge, huge + 1]))
+        bounds = np.concatenate([[0], cuts[(cuts > 0) & (cuts < len(costs))], [len(costs)]])
+
+        cumulative = np.concatenate([[0.0], np.cumsum(costs)])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            shards.append((file_index, int(start), int(stop), float(cumulative[stop] - cumulative[start])))
+
+    shards.sort(key=lambda shard: shard[3], reverse=True)
+    return shards
+
+
+def evaluate_stores_in_parallel(stores, target_meters, engine='naive', workers=None, visualize=False,
+                                cache_path=None, simplify_meters=None, budget_seconds=None):
+    """
+    Runs evaluate_shard over a list of PolygonStores on a process pool and puts the pieces back together, so the
+    output is the same as running evaluate_polygons on each store one after another. If METRICS is enabled, what
+    the workers record gets merged into it.
+
+    Parameters:
+        stores (list[PolygonStore]): the polygons of each file.
+        target_meters (float): the distance that we are checking for within the polygon
+        engine (str): a key of LANDABILITY_ENGINES.
+        workers (int): how many processes to use, defaults to the number of cpus.
+        visualize (bool): passed along to the engine.
+        cache_path (str): optional path of the ResultCache the workers share.
+        simplify_meters (float): optional simplification tolerance, see evaluate_polygons.
+        budget_seconds (float): optional time limit per polygon, see evaluate_polygons.
+
+    Returns:
+        list[tuple]: for each store, (list of result rows, positions of the passing polygons, Counter of tallies)
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = plan_shards([store.vertex_counts for store in stores], workers)
+
+    pieces = [[] for _ in stores]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(file_index, start, pool.submit(evaluate_shard, stores[file_index].subset(np.arange(start, stop)),
+                                                   target_meters, engine, visualize, cache_path,
+                                                   simplify_meters, METRICS.enabled, budget_seconds))
+                   for file_index, start, stop, _ in shards]
+
+        for file_index, start, future in futures:
+            polygon_results, passing_polygons, counts, shard_metrics = future.result()
+            if shard_metrics is not None:
+                METRICS.merge(shard_metrics)
+            pieces[file_index].append((start, polygon_results, [start + position for position in passing_polygons],
+                                       counts))
+
+    # put each file's shards back in polygon order
+    outputs = []
+    for file_pieces in pieces:
+        file_pieces.sort(key=lambda piece: piece[0])
+        polygon_results = [row for piece in file_pieces for row in piece[1]]
+        passing_polygons = [position for piece in file_pieces for position in piece[2]]
+        outputs.append((polygon_results, passing_polygons, sum((piece[3] for piece in file_pieces), Counter())))
+    return outputs
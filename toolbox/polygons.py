@@ -2,8 +2,13 @@
 Code to do some work on the polygons and return some statistics.
 Written by Kai mostly and Pat
 """
+from time import perf_counter
+
 import pandas as pd
 from toolbox.distance import *
+from toolbox.metrics import METRICS
+from toolbox.raster import RASTER_RESOLUTION_METERS, raster_screen
+from toolbox.store import PolygonStore, ring_next
 
 
 def edge_lengths_of_polygon(vertices, lat_lon_to_meters):
@@ -18,15 +23,21 @@ def edge_lengths_of_polygon(vertices, lat_lon_to_meters):
         (numpy.ndarray): length of each edge. Edge n corresponds to vertices n and n+1.
     """
     num_vertices = vertices.shape[0]
-    edge_distances = np.zeros(num_vertices)
+    first = np.arange(num_vertices)
+    return distances_between_vertices(vertices, first, (first + 1) % num_vertices, lat_lon_to_meters)
 
-    for n in range(num_vertices - 1):
-        edge_distances[n] = distance_between_vertices(vertices, n, n + 1, lat_lon_to_meters)
 
-    last_edge = distance_between_vertices(vertices, num_vertices - 1, 0, lat_lon_to_meters)
+def planar_edge_lengths(points):
+    """
+    The length of each edge of a ring that's already in meters, like the ones from rings_to_meters or
+    PolygonStore.in_meters. Edge n joins points n and n+1, and the last one wraps around to the first point.
+    """
+    return np.hypot(*(np.roll(points, -1, axis=0) - points).T)
 
-    edge_distances[num_vertices - 1] = last_edge
-    return edge_distances
+
+def _planar_distances(points, i, j):
+    # distance between points[i] and points[j] for arrays of index pairs, the points already being in meters
+    return np.hypot(*(points[j] - points[i]).T)
 
 
 def perimeter_length(edge_lengths):
@@ -141,7 +152,257 @@ def is_point_in_polygon(vertices: [tuple], point_coordinates: tuple) -> bool:
 
 
 
-def has_length_within_polygon_naive(vertices, target_meters, visualize=False):
+def points_in_polygon(vertices, points, block_cells=1 << 20) -> np.ndarray:
+    """
+    is_point_in_polygon for a whole array of points at once. Uses the exact same crossing rule, so every point gets
+    the same answer it would get from is_point_in_polygon: an edge counts when min(y) < y <= max(y) and the point is
+    left of (or on) where the edge crosses its row. That means points on the right and top boundaries of a square
+    are inside, and points on the left and bottom boundaries are outside (see test_is_point_in_polygon).
+
+    Args:
+        vertices: the (x, y) coords of each point of the polygon, a list of tuples or an (n, 2) array
+        points: (m, 2) array of the points we want to check
+        block_cells: how many point / edge pairs to work on at a time, keeps memory flat for big inputs
+
+    Returns: boolean array, true for the points the polygon contains
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    inside = np.zeros(len(points), dtype=bool)
+    if len(vertices) == 0:
+        return inside
+
+    # edge k goes from vertex k - 1 to vertex k, same as the loop in is_point_in_polygon
+    x1, y1 = np.roll(vertices, 1, axis=0).T
+    x2, y2 = vertices.T
+    low_y, high_y, high_x = np.minimum(y1, y2), np.maximum(y1, y2), np.maximum(x1, x2)
+
+    block = max(block_cells // len(vertices), 1)
+    for first in range(0, len(points), block):
+        x = points[first:first + block, 0][:, None]
+        y = points[first:first + block, 1][:, None]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intercept = (y - y1) * (x2 - x1) / (y2 - y1) + x1
+        crossings = (low_y < y) & (y <= high_y) & (x <= high_x) & ((x1 == x2) | (x <= intercept))
+        inside[first:first + block] = np.count_nonzero(crossings, axis=1) % 2 == 1
+
+    return inside
+
+
+def polygons_in_region(polygons: PolygonStore, region, block_cells=1 << 20) -> np.ndarray:
+    """
+    Finds the polygons that aren't entirely outside a region, like MATSU_REGION_OF_INTEREST. A polygon is kept if any
+    of its vertices is in the region, if one of its edges crosses the region's boundary, or if any corner of the
+    region falls in the polygon's bounding box (that catches big lakes that wrap around a small region). Erring on the
+    side of keeping means nothing in the region gets dropped.
+
+    Args:
+        polygons: the store of polygons, vertices as (lat, lon).
+        region: the (lat, lon) vertices of the region.
+        block_cells: how many edge / region edge pairs to work on at a time.
+
+    Returns: boolean mask over the polygons of the store, true for the ones to keep
+    """
+    keep = np.zeros(len(polygons), dtype=bool)
+    non_empty = np.flatnonzero(polygons.vertex_counts > 0)
+    if len(non_empty) == 0:
+        return keep
+    starts = polygons.offsets[:-1][non_empty]
+
+    vertex_inside = points_in_polygon(region, polygons.coordinates)
+    keep[non_empty] = np.logical_or.reduceat(vertex_inside, starts)
+
+    region = np.asarray(region, dtype=np.float64).reshape(-1, 2)
+    lower = np.minimum.reduceat(polygons.coordinates, starts)
+    upper = np.maximum.reduceat(polygons.coordinates, starts)
+    corner_inside = ((lower[:, None, :] <= region[None, :, :]) & (region[None, :, :] <= upper[:, None, :])).all(axis=2)
+    keep[non_empty] |= corner_inside.any(axis=1)
+
+    # whatever is left and still overlaps the region's box might cut across it without a vertex inside
+    overlaps = (lower <= region.max(axis=0)).all(axis=1) & (upper >= region.min(axis=0)).all(axis=1)
+    candidates = non_empty[overlaps & ~keep[non_empty]]
+    if len(candidates):
+        candidate_store = polygons.subset(candidates)
+        edge_starts = candidate_store.coordinates
+        edge_ends = edge_starts[ring_next(candidate_store.offsets)]
+        owners = np.repeat(np.arange(len(candidates)), candidate_store.vertex_counts)
+
+        crosses = np.zeros(len(edge_starts), dtype=bool)
+        block = max(block_cells // len(region), 1)
+        for first in range(0, len(edge_starts), block):
+            crosses[first:first + block] = _segments_touch(edge_starts[first:first + block],
+                                                          edge_ends[first:first + block],
+                                                          region, np.roll(region, -1, axis=0)).any(axis=1)
+        keep[candidates[np.unique(owners[crosses])]] = True
+
+    return keep
+
+
+def _segments_touch(a, b, c, d):
+    """
+    Checks every segment a-b against every segment c-d, touching counts.
+
+    Returns: (len(a), len(c)) boolean array
+    """
+    def orientation(p, q, r):
+        return np.sign((q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) -
+                       (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0]))
+
+    a, b = a[:, None, :], b[:, None, :]
+    c, d = c[None, :, :], d[None, :, :]
+    straddle_ab = orientation(a, b, c) * orientation(a, b, d) <= 0
+    straddle_cd = orientation(c, d, a) * orientation(c, d, b) <= 0
+
+    # the orientation tests alone would call collinear segments that don't overlap touching, so check the boxes too
+    boxes_overlap = ((np.minimum(a, b) <= np.maximum(c, d)) & (np.minimum(c, d) <= np.maximum(a, b))).all(axis=2)
+    return straddle_ab & straddle_cd & boxes_overlap
+
+
+def convex_hull_indices(points):
+    """
+    Finds the convex hull of a set of points with Andrew's monotone chain algorithm in O(n log n).
+
+    Parameters:
+        points (numpy.ndarray): Array of (x, y) points.
+
+    Returns:
+        numpy.ndarray: The positions in points of the hull vertices in counterclockwise order, without collinear
+            points or a closing vertex. A point that shows up more than once is given by its first position.
+    """
+    points = np.asarray(points, dtype=float)
+    _, order = np.unique(points, axis=0, return_index=True)  # sorted by x then y
+    if len(order) < 3:
+        return order
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    def half_hull(ordered_indices):
+        chain = []
+        for index in ordered_indices:
+            while len(chain) >= 2 and cross(points[chain[-2]], points[chain[-1]], points[index]) <= 0:
+                chain.pop()
+            chain.append(index)
+        return chain
+
+    lower = half_hull(order)
+    upper = half_hull(order[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def convex_hull(points):
+    """
+    Finds the convex hull of a set of points, see convex_hull_indices.
+
+    Returns:
+        numpy.ndarray: The hull vertices in counterclockwise order, without collinear points or a closing vertex.
+    """
+    points = np.asarray(points, dtype=float)
+    return points[convex_hull_indices(points)]
+
+
+def far_vertex_pairs(points, num_directions=8):
+    """
+    Picks a handful of vertex pairs that are probably far apart, so the pair searches can try the long chords first.
+    Those are the two extreme points along a few directions, plus a double sweep (the farthest point from a vertex,
+    then the farthest point from that one, and so on). It's O(n) per direction, and the longest pair is usually in
+    there or close to it.
+
+    Parameters:
+        points (numpy.ndarray): Array of (x, y) points in meters.
+        num_directions (int): how many directions to take the extreme points along, spread over half a turn.
+
+    Returns:
+        tuple: (i, j) index arrays with i < j, without repeats.
+    """
+    angles = np.pi * np.arange(num_directions) / num_directions
+    projections = points @ np.stack([np.cos(angles), np.sin(angles)])
+
+    sweep = [0]
+    for _ in range(3):
+        sweep.append(int(np.argmax(np.sum((points - points[sweep[-1]]) ** 2, axis=1))))
+
+    pairs = np.column_stack([np.concatenate([projections.argmin(axis=0), sweep[1:-1]]),
+                             np.concatenate([projections.argmax(axis=0), sweep[2:]])])
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return pairs[:, 0], pairs[:, 1]
+
+
+class SearchBudget:
+    """
+    A per polygon limit on how long the pair searches get to run, so one monster lake can't hold up a whole run.
+    When it runs out before there's an answer the engines say 'Fails*': we don't know, treat it as a fail.
+
+    Attributes:
+        deadline (float): the perf_counter time to stop at, or None for no time limit.
+        pairs_left (int): how many more pairs can be looked at, or None for no limit.
+        exhausted (bool): True once a search asked for more than was left.
+    """
+
+    def __init__(self, seconds=None, pairs=None):
+        self.deadline = None if seconds is None else perf_counter() + seconds
+        self.pairs_left = pairs
+        self.exhausted = False
+
+    def spend(self, pairs) -> bool:
+        """
+        Call before looking at some pairs. Returns: False if the budget doesn't cover them, and the search should stop.
+        """
+        if self.pairs_left is not None:
+            self.pairs_left -= pairs
+            if self.pairs_left < 0:
+                self.exhausted = True
+        if self.deadline is not None and perf_counter() > self.deadline:
+            self.exhausted = True
+        return not self.exhausted
+
+
+def convex_hull_diameter(vertices):
+    """
+    Calculates the largest distance between any two vertices of a polygon using rotating calipers on its convex hull.
+    No straight line inside the polygon can be longer than this, so it's a quick way to reject small polygons.
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs representing the vertices of the polygon, where each pair is (latitude, longitude).
+
+    Returns:
+        float: the diameter in meters.
+    """
+    return planar_hull_diameter(rings_to_meters(vertices)[0])
+
+
+def planar_hull_diameter(points):
+    """
+    convex_hull_diameter for a ring that's already in meters, like a polygon of PolygonStore.in_meters.
+    """
+    return _hull_diameter(convex_hull(points))
+
+
+def _hull_diameter(hull):
+    # rotating calipers on the vertices of a convex hull, in counterclockwise order
+    num_hull = len(hull)
+    if num_hull < 3:
+        return float(np.hypot(*(hull[-1] - hull[0]))) if num_hull else 0.0
+
+    def twice_area(a, b, c):
+        return abs((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]))
+
+    # walk an antipodal vertex around the hull while we walk the edges
+    diameter = 0.0
+    k = 1
+    for i in range(num_hull):
+        a, b = hull[i], hull[(i + 1) % num_hull]
+        while twice_area(a, b, hull[(k + 1) % num_hull]) > twice_area(a, b, hull[k]):
+            k = (k + 1) % num_hull
+        diameter = max(diameter, np.hypot(*(hull[k] - a)), np.hypot(*(hull[k] - b)))
+
+    return float(diameter)
+
+
+def has_length_within_polygon_naive(vertices, target_meters, visualize=False, holes=None, block_size=1 << 16,
+                                    ordered=True, budget_seconds=None, max_pairs=None, meters=None):
     """
     Determines which polygons have a straight line distance of at least target_meters contained within them.
     Assumes that polygon vertices represent lattitudes and longitudes. Distances based on haversine formula.
@@ -150,63 +411,686 @@ def has_length_within_polygon_naive(vertices, target_meters, visualize=False):
     Parameters:
         vertices (numpy.ndarray): Array of ordered pairs representing the vertices of the polygon, where each pair is (latitude, longitude).
         target_meters (float): the distance that we are checking for within the polygon
+        visualize (bool): If True, print the grid of diagonals that were checked.
+        holes (list[numpy.ndarray]): Ignored, this check never looks at the inside of the polygon.
+        block_size (int): How many diagonals to measure at once. Bigger blocks mean fewer numpy calls, smaller ones
+            mean less memory and less wasted work when an early diagonal passes.
+        ordered (bool): If True, big polygons try the long diagonals first (see _ordered_naive_search) before
+            falling back on the plain row by row scan. The answer is the same either way, it just comes a lot sooner.
+        budget_seconds (float): optional time limit for the search, see SearchBudget.
+        max_pairs (int): optional limit on how many diagonals the search looks at.
+        meters (list[numpy.ndarray]): the polygon already in local meters, like PolygonStore.rings_in_meters gives.
+            Without it the vertices get projected here.
+
+    Returns:
+        str: "Passes", "Fails", "Passes*" if the target is shorter than the longest edge, or "Fails*" if the budget
+            ran out before we knew.
     """
     # TODO: if min_index_offset > num_vertices / 2, polygon should fail. (Think about what this case implies)
     # TODO: if diagonal passes length check, only then perform concave check.
     # TODO: The min_index offset thing needs to treat vertices as a closed loop and not a list.
     # TODO: Make this function readable.
-    # TODO: Add edges_checked counter which divided by num_vertices^2 gives a sense of optimization.
     # TODO: Maybe add counter for how many concave checks were made.
     
-    conversion = lat_lon_to_meters(vertices[0])
+    # project once (or not at all if the store already did), after that every distance is plain planar math
+    points = rings_to_meters(vertices)[0] if meters is None else meters[0]
 
-    edge_lengths = edge_lengths_of_polygon(vertices, conversion)
+    edge_lengths = planar_edge_lengths(points)
     longest_edge_length = edge_lengths.max()
     min_index_offset = target_meters // longest_edge_length
     
     if visualize:
         print("min_index_offset:", int(min_index_offset))
     
+    METRICS.count('naive.polygons')
     if min_index_offset == 0:
+        METRICS.count('naive.passes_star')
         return 'Passes*'
 
     solution = "Fails"
     num_vertices = vertices.shape[0]
+    METRICS.count('naive.possible_diagonals', num_vertices * (num_vertices - 1) // 2)
 
-    for i in range(num_vertices):
-        for j in range(num_vertices):
-            if i >= j - min_index_offset:
-                if visualize:
+    if visualize:
+        # print out the whole grid of diagonals, this is slow so only do it when we're looking at it
+        for i in range(num_vertices):
+            for j in range(num_vertices):
+                if i >= j - min_index_offset:
                     print(" ~", end='')
-                continue
-
-            passes = check_diagonal(vertices, i, j, target_meters, conversion, visualize)
-            solution = "Passes" if passes is True else solution
-            
-            if passes and not visualize:
-                return solution
-        if visualize:
+                    continue
+
+                passes = check_diagonal(vertices, i, j, target_meters, polygon_conversion(vertices), visualize)
+                solution = "Passes" if passes is True else solution
             print()
+        return solution
 
-    
+    # a polygon whose diagonals all fit in one block gets scanned in a single numpy call anyway
+    budget = SearchBudget(budget_seconds, max_pairs)
+    if ordered and num_vertices * (num_vertices - 1) // 2 > block_size:
+        solution = _ordered_naive_search(points, target_meters, min_index_offset, budget, block_size)
+        if solution is not None:
+            return solution
+        solution = "Fails"
+
+    for i, j in _vertex_pair_blocks(num_vertices, block_size, min_index_offset):
+        if not budget.spend(len(i)):
+            METRICS.count('naive.out_of_budget')
+            return "Fails*"
+        METRICS.count('naive.diagonals', len(i))
+        if (_planar_distances(points, i, j) >= target_meters).any():
+            METRICS.count('naive.early_exits')
+            return "Passes"
 
     return solution
 
 
-def raw_vertices_to_df(polygons: list[list]) -> pd.DataFrame:
-    data = {"Polygon": [],
-            "Latitude": [],
-            "Longitude": []}
+def _ordered_naive_search(points, target_meters, min_index_offset, budget, block_size):
+    """
+    The long diagonals first part of has_length_within_polygon_naive. Any diagonal the plain scan would accept
+    works, so it first measures the far apart pairs from far_vertex_pairs. After that the longest diagonal always
+    joins two convex hull vertices: if the hull diameter is too short nothing is long enough, otherwise only the
+    pairs of hull vertices get measured.
+
+    Returns:
+        str: "Passes", "Fails", "Fails*" if the budget ran out, or None if the min_index_offset rule got in the way
+            and the plain scan has to decide.
+    """
+    i, j = far_vertex_pairs(points)
+    METRICS.count('naive.seed_diagonals', len(i))
+    if ((_planar_distances(points, i, j) >= target_meters) & (j - i > min_index_offset)).any():
+        METRICS.count('naive.early_exits')
+        METRICS.count('naive.seed_passes')
+        return "Passes"
+
+    hull = convex_hull_indices(points)
+    # leave a hair of room for the rounding in the hull itself
+    if _hull_diameter(points[hull]) < target_meters - 1e-6:
+        return "Fails"
+
+    for a, b in _vertex_pair_blocks(len(hull), block_size):
+        if not budget.spend(len(a)):
+            METRICS.count('naive.out_of_budget')
+            return "Fails*"
+        METRICS.count('naive.hull_diagonals', len(a))
+        i, j = np.minimum(hull[a], hull[b]), np.maximum(hull[a], hull[b])
+        distances = _planar_distances(points, i, j)
+        if ((distances >= target_meters) & (j - i > min_index_offset)).any():
+            METRICS.count('naive.early_exits')
+            return "Passes"
+    return None
+
+
+def longest_length_within_polygon_naive(vertices, cap_meters=np.inf, visualize=False, holes=None, floor_meters=0.0,
+                                        meters=None):
+    """
+    The length version of has_length_within_polygon_naive: the longest distance between two vertices. Every pair the
+    naive check measures is a chord of the convex hull, so that's just the hull diameter and there's nothing to stop
+    early on. The other arguments are only there to match longest_length_within_polygon_exact.
+
+    Returns:
+        float: the length in meters.
+    """
+    return convex_hull_diameter(vertices) if meters is None else planar_hull_diameter(meters[0])
+
+
+def simplify_ring(vertices, tolerance_meters):
+    """
+    Douglas-Peucker simplification of one ring. GEE traces shorelines pixel by pixel, so most vertices sit on nearly
+    straight runs and can go without moving the outline by more than tolerance_meters. The vertices that are kept
+    are original vertices, in their original order.
+
+    Parameters:
+        vertices (numpy.ndarray): the ring as (latitude, longitude) pairs.
+        tolerance_meters (float): the furthest any dropped vertex may be from the simplified outline.
+
+    Returns:
+        numpy.ndarray: the kept vertices. Rings that would end up with fewer than 3 corners come back unchanged.
+    """
+    return vertices[simplified_vertices(rings_to_meters(vertices)[0], tolerance_meters)]
+
+
+def simplified_vertices(points, tolerance_meters):
+    """
+    simplify_ring for a ring that's already in meters.
+
+    Returns:
+        numpy.ndarray: boolean mask of the vertices to keep, all of them if the ring would end up with fewer than 3
+            corners.
+    """
+    num_vertices = len(points)
+    if num_vertices < 5 or not tolerance_meters > 0:
+        return np.ones(num_vertices, dtype=bool)
+
+    # a ring has no natural ends, so split it at the first vertex and the vertex furthest from it
+    far = int(np.argmax(np.hypot(points[:, 0], points[:, 1])))
+    keep = np.zeros(num_vertices, dtype=bool)
+    keep[[0, far, num_vertices - 1]] = True
+
+    stack = [(0, far), (far, num_vertices - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        # distance from every vertex in between to the segment first -> last
+        a, b = points[first], points[last]
+        ab = b - a
+        between = points[first + 1:last]
+        length_squared = ab @ ab
+        t = np.clip((between - a) @ ab / length_squared, 0, 1) if length_squared > 0 else np.zeros(len(between))
+        offsets = between - (a + t[:, None] * ab)
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+
+        worst = int(np.argmax(distances))
+        if distances[worst] > tolerance_meters:
+            middle = first + 1 + worst
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+
+    if len(np.unique(points[keep], axis=0)) < 3:
+        return np.ones(num_vertices, dtype=bool)
+    return keep
+
+
+def has_length_within_polygon_simplified(vertices, target_meters, has_length_within_polygon, tolerance_meters,
+                                         visualize=False, holes=None, meters=None):
+    """
+    Runs a landability engine on a simplified copy of the polygon first (see simplify_ring). Simplifying can move the
+    outline out as well as in, so a "Passes" on the simplified polygon isn't trusted: it's checked again on the
+    original. That way simplification can only ever turn a "Passes" into a "Fails", never the other way around,
+    and the expensive case (a full search that finds nothing) runs on far fewer vertices.
+
+    Parameters:
+        vertices (numpy.ndarray): the outer ring as (latitude, longitude) pairs.
+        target_meters (float): the distance that we are checking for within the polygon
+        has_length_within_polygon: the engine, one of the values of LANDABILITY_ENGINES.
+        tolerance_meters (float): see simplify_ring.
+        visualize (bool): passed along to the engine.
+        holes (list[numpy.ndarray]): optional holes, simplified the same way.
+        meters (list[numpy.ndarray]): the polygon and its holes already in local meters, see rings_to_meters. The
+            simplified copy keeps the same projection, so nothing gets projected twice.
+
+    Returns:
+        tuple: (the verdict, the number of vertices searched after simplifying)
+    """
+    rings = [np.asarray(ring, dtype=float) for ring in [vertices] + list(holes or [])]
+    meters = rings_to_meters(rings[0], rings[1:]) if meters is None else meters
+    keeps = [simplified_vertices(ring, tolerance_meters) for ring in meters]
+    simple_vertices, *simple_holes = [ring[keep] for ring, keep in zip(rings, keeps)]
+    simple_meters = [ring[keep] for ring, keep in zip(meters, keeps)]
+    simple_count = sum(int(np.count_nonzero(keep)) for keep in keeps)
+
+    solution = has_length_within_polygon(simple_vertices, target_meters, visualize, holes=simple_holes,
+                                         meters=simple_meters)
+    if solution != "Fails":
+        solution = has_length_within_polygon(vertices, target_meters, visualize, holes=rings[1:], meters=meters)
+    return solution, simple_count
+
+
+def rings_to_meters(vertices, holes=None):
+    """
+    Converts the outer ring of a polygon and its holes from lat-lons to local meters.
+    Every ring uses the conversion rate from polygon_conversion and is shifted so vertices[0] sits at the origin, this
+    keeps the numbers small enough that the cross products in the segment tests don't lose precision.
+    PolygonStore.in_meters does the same thing for a whole store at once.
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs (latitude, longitude) for the outer ring.
+        holes (list[numpy.ndarray]): Optional list of rings in the same format that are cut out of the polygon.
+
+    Returns:
+        list[numpy.ndarray]: The outer ring followed by the holes, in meters.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    conversion = polygon_conversion(vertices)
+    rings = [vertices] + [np.asarray(hole, dtype=float) for hole in (holes or [])]
+    return [(ring - vertices[0]) * conversion for ring in rings]
+
+
+def ring_edges(rings):
+    """
+    Stacks the edges of every ring into two arrays of start and end points. Zero length edges, like the one created
+    by the repeated closing vertex that gee gives us, are dropped.
+
+    Parameters:
+        rings (list[numpy.ndarray]): rings of (x, y) points.
+
+    Returns:
+        tuple: (starts, ends), each an (n, 2) array.
+    """
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    keep = np.any(starts != ends, axis=1)
+    return starts[keep], ends[keep]
+
+
+def _open_ring(ring):
+    # drop the repeated closing vertex if the ring has one
+    if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+        return ring[:-1]
+    return ring
+
+
+def _points_in_rings(points, starts, ends):
+    """
+    Even-odd ray casting for many points at once against the edges of one or more rings. Holes work for free because
+    a point inside a hole crosses the outer ring and the hole. The exact engine only asks about points that are clear
+    of the boundary, so it uses a simpler half-open rule than points_in_polygon.
+    """
+    px = points[:, 0][:, None]
+    py = points[:, 1][:, None]
+    ax, ay = starts[:, 0], starts[:, 1]
+    bx, by = ends[:, 0], ends[:, 1]
+
+    straddles = (ay > py) != (by > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intercept = ax + (py - ay) * (bx - ax) / (by - ay)
+    crossings = straddles & (px < intercept)
+    return np.count_nonzero(crossings, axis=1) % 2 == 1
+
+
+def _vertex_pair_blocks(num_vertices, block_size, min_index_offset=0):
+    """
+    Yields the vertex pairs (i, j) with j > i + min_index_offset in blocks of roughly block_size pairs, in the same
+    row by row order as the naive double loop. Each block is a pair of index arrays so the caller can do its math on
+    the whole block with numpy.
+    """
+    min_index_offset = int(min(min_index_offset, num_vertices))
+    row_counts = np.maximum(num_vertices - np.arange(num_vertices) - 1 - min_index_offset, 0)
+    row_ends = np.cumsum(row_counts)
+    total = int(row_ends[-1]) if num_vertices else 0
+
+    for first_pair in range(0, total, block_size):
+        k = np.arange(first_pair, min(first_pair + block_size, total))
+        i = np.searchsorted(row_ends, k, side='right')
+        row_starts = row_ends[i] - row_counts[i]
+        j = i + 1 + min_index_offset + (k - row_starts)
+        yield i, j
+
+
+def _clipped_line_params(p, q, lower, upper):
+    """
+    Where the infinite line p + t * (q - p) enters and leaves the bounding box [lower, upper]. Nothing on that line
+    inside the polygon can reach past these, so they give a cheap upper bound for a candidate.
+
+    Returns:
+        tuple: (t_low, t_high) for each line.
+    """
+    d = q - p
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (lower - p) / d
+        t2 = (upper - p) / d
+    t_low = np.where(d == 0, -np.inf, np.minimum(t1, t2)).max(axis=1)
+    t_high = np.where(d == 0, np.inf, np.maximum(t1, t2)).min(axis=1)
+    return t_low, t_high
+
+
+def _interior_neighbours(rings):
+    """
+    For every vertex of the open rings, the direction to the next and previous vertex, ordered so the inside of the
+    polygon is always on the left. That means the outer ring gets walked counterclockwise and the holes clockwise.
+    """
+    to_next = []
+    to_previous = []
+    for ring_number, ring in enumerate(rings):
+        ring = _open_ring(ring)
+        signed_area = np.sum(ring[:, 0] * np.roll(ring[:, 1], -1) - np.roll(ring[:, 0], -1) * ring[:, 1])
+        counterclockwise = signed_area > 0
+        if counterclockwise != (ring_number == 0):
+            to_next.append(np.roll(ring, 1, axis=0) - ring)
+            to_previous.append(np.roll(ring, -1, axis=0) - ring)
+        else:
+            to_next.append(np.roll(ring, -1, axis=0) - ring)
+            to_previous.append(np.roll(ring, 1, axis=0) - ring)
+    return np.concatenate(to_next), np.concatenate(to_previous)
+
+
+def _heads_inside(direction, to_next, to_previous):
+    """
+    Checks if leaving a vertex in the given direction goes into the polygon (or along its edge). The inside of the
+    corner is everything counterclockwise from to_next up to to_previous. Anything borderline counts as inside,
+    this is only used to throw candidates away so it has to err that way.
+    """
+    def cross(u, v):
+        return u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+
+    after_next = cross(to_next, direction) >= 0
+    before_previous = cross(direction, to_previous) >= 0
+    convex = cross(to_next, to_previous) > 0
+    return np.where(convex, after_next & before_previous, after_next | before_previous)
+
+
+def _interior_run_lengths_block(p, q, starts, ends, tolerance=1e-6):
+    """
+    Block version of interior_run_length for chords in general position. For every chord p -> q it checks the chord
+    against all edges at once, throws it out if it properly crosses an edge, and otherwise extends it to the next
+    place the line touches the boundary on each side.
+
+    When a chord runs along an edge or touches a vertex in its middle or where it stops, one sample per piece isn't
+    enough to know what's inside, so those chords are flagged for the exact (one at a time) check instead.
+
+    Returns:
+        tuple: (runs, needs_exact). runs is 0 for chords that leave the polygon and otherwise a run length that is
+            never longer than the true one.
+    """
+    d = q - p
+    length = np.hypot(d[:, 0], d[:, 1])
+    e = ends - starts
+    edge_lengths = np.hypot(e[:, 0], e[:, 1])
+    w = starts[None, :, :] - p[:, None, :]
+
+    denom = d[:, None, 0] * e[None, :, 1] - d[:, None, 1] * e[None, :, 0]
+    t_num = w[..., 0] * e[None, :, 1] - w[..., 1] * e[None, :, 0]
+    s_num = w[..., 0] * d[:, None, 1] - w[..., 1] * d[:, None, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = t_num / denom
+        s = s_num / denom
+
+    t_tolerance = (tolerance / length)[:, None]
+    s_tolerance = tolerance / edge_lengths
+    parallel = np.abs(denom) <= 1e-12 * length[:, None] * edge_lengths
+    collinear = parallel & (np.abs(s_num) <= tolerance * length[:, None])
+
+    hit = ~parallel & (s >= -s_tolerance) & (s <= 1 + s_tolerance)
+    vertex_hit = hit & ((s <= s_tolerance) | (s >= 1 - s_tolerance))
+    within_chord = (t > t_tolerance) & (t < 1 - t_tolerance)
+
+    proper = (hit & ~vertex_hit & within_chord).any(axis=1)
+    touches = (vertex_hit & within_chord).any(axis=1) | collinear.any(axis=1)
+
+    t_next = np.where(hit & (t > 1 + t_tolerance), t, np.inf).min(axis=1)
+    t_prev = np.where(hit & (t < -t_tolerance), t, -np.inf).max(axis=1)
+    with np.errstate(invalid='ignore'):
+        stops_on_vertex_next = (vertex_hit & (np.abs(t - t_next[:, None]) <= t_tolerance)).any(axis=1)
+        stops_on_vertex_prev = (vertex_hit & (np.abs(t - t_prev[:, None]) <= t_tolerance)).any(axis=1)
+
+    # one sample in the middle of the chord and one on each side of it
+    t_next_sample = np.where(np.isfinite(t_next), (1 + t_next) / 2, 1)
+    t_prev_sample = np.where(np.isfinite(t_prev), t_prev / 2, 0)
+    samples = np.concatenate([p + 0.5 * d, p + t_next_sample[:, None] * d, p + t_prev_sample[:, None] * d])
+    inside_middle, inside_next, inside_prev = np.split(_points_in_rings(samples, starts, ends), 3)
+    inside_next &= np.isfinite(t_next)
+    inside_prev &= np.isfinite(t_prev)
+
+    high = np.where(inside_next, t_next, 1.0)
+    low = np.where(inside_prev, t_prev, 0.0)
+    runs = np.where(proper | ~inside_middle | touches, 0.0, (high - low) * length)
+
+    degenerate = touches | (inside_next & stops_on_vertex_next) | (inside_prev & stops_on_vertex_prev)
+    return runs, ~proper & degenerate
+
+
+def interior_run_length(p, q, starts, ends, tolerance=1e-6):
+    """
+    Finds the longest straight run inside the polygon that contains the chord p -> q. The chord is extended in both
+    directions until it leaves the polygon. If the chord itself isn't fully inside (holes included) the run is 0.
+
+    Parameters:
+        p, q (numpy.ndarray): the end points of the chord, in meters.
+        starts, ends (numpy.ndarray): the edges of the polygon from ring_edges.
+        tolerance (float): distance in meters under which two things count as touching.
+
+    Returns:
+        float: the length in meters of the run, or 0.0 if the chord leaves the polygon.
+    """
+    d = q - p
+    length = np.hypot(d[0], d[1])
+    if length == 0:
+        return 0.0
+
+    e = ends - starts
+    w = starts - p
+    denom = d[0] * e[:, 1] - d[1] * e[:, 0]
+    t_num = w[:, 0] * e[:, 1] - w[:, 1] * e[:, 0]
+    s_num = w[:, 0] * d[1] - w[:, 1] * d[0]
+    edge_lengths = np.hypot(e[:, 0], e[:, 1])
+
+    parallel = np.abs(denom) <= 1e-12 * length * edge_lengths
+    collinear = parallel & (np.abs(s_num) / length <= tolerance)
+
+    # every place the line touches the boundary is a breakpoint where it could go from inside to outside
+    crossing = ~parallel
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = s_num[crossing] / denom[crossing]
+        t = t_num[crossing] / denom[crossing]
+    slack = tolerance / edge_lengths[crossing]
+    t = t[(s >= -slack) & (s <= 1 + slack)]
+
+    dd = length * length
+    collinear_a = (w[collinear] @ d) / dd
+    collinear_b = ((ends[collinear] - p) @ d) / dd
+
+    breakpoints = np.sort(np.concatenate([t, collinear_a, collinear_b, [0.0, 1.0]]))
+    merge_tolerance = tolerance / length
+    breakpoints = breakpoints[np.concatenate([[True], np.diff(breakpoints) > merge_tolerance])]
+
+    # the line doesn't touch the boundary between two breakpoints, so one sample tells us about the whole piece
+    middles = (breakpoints[:-1] + breakpoints[1:]) / 2
+    samples = p + middles[:, None] * d
+    inside = _points_in_rings(samples, starts, ends)
+
+    # pieces running along a boundary edge are on the closed polygon, so they count as inside
+    low = np.minimum(collinear_a, collinear_b)
+    high = np.maximum(collinear_a, collinear_b)
+    inside |= ((middles[:, None] >= low) & (middles[:, None] <= high)).any(axis=1)
+
+    first = np.argmin(np.abs(breakpoints))
+    last = np.argmin(np.abs(breakpoints - 1.0))
+    if not inside[first:last].all():
+        return 0.0
+
+    while first > 0 and inside[first - 1]:
+        first -= 1
+    while last < len(inside) and inside[last]:
+        last += 1
+
+    return (breakpoints[last] - breakpoints[first]) * length
+
+
+def has_length_within_polygon_exact(vertices, target_meters, visualize=False, holes=None, block_cells=1 << 20,
+                                    budget_seconds=None, max_pairs=None, meters=None):
+    """
+    Determines if a polygon has a straight line of at least target_meters that lies completely inside of it. Unlike
+    has_length_within_polygon_naive this works for concave polygons (the thin 'S' case) and for polygons with holes.
+    See longest_length_within_polygon_exact for how it works.
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs representing the vertices of the polygon, where each pair is (latitude, longitude).
+        target_meters (float): the distance that we are checking for within the polygon
+        visualize (bool): If True, print how many chords made it through each step.
+        holes (list[numpy.ndarray]): Optional rings, in the same format as vertices, that are cut out of the polygon.
+        block_cells (int): Caps the size of the chord x edge matrices so memory stays bounded.
+        budget_seconds (float): optional time limit for the search, see SearchBudget.
+        max_pairs (int): optional limit on how many chords get checked against the edges.
+        meters (list[numpy.ndarray]): the polygon and its holes already in local meters, see
+            longest_length_within_polygon_exact.
+
+    Returns:
+        str: "Passes", "Fails", or "Fails*" if the budget ran out before we knew.
+    """
+    budget = SearchBudget(budget_seconds, max_pairs)
+    longest = longest_length_within_polygon_exact(vertices, target_meters, visualize, holes, target_meters, block_cells,
+                                                  budget, meters)
+    if longest >= target_meters:
+        return "Passes"
+    return "Fails*" if budget.exhausted else "Fails"
+
+
+def longest_length_within_polygon_exact(vertices, cap_meters=np.inf, visualize=False, holes=None, floor_meters=0.0,
+                                        block_cells=1 << 20, budget=None, meters=None):
+    """
+    Finds the longest straight line that lies completely inside a polygon (holes cut out), stopping as soon as it
+    finds one of at least cap_meters.
+
+    The longest segment inside a polygon can always be moved until it touches two vertices, so we only need to look
+    at lines through pairs of vertices and how far each one runs inside the polygon. The far apart pairs from
+    far_vertex_pairs go first, since they usually settle a passing lake on their own. The rest are handled in blocks:
+        1. give up on the whole polygon if its bounding box diagonal is shorter than floor_meters.
+        2. drop pairs whose chord heads out of the polygon at either end, or whose line can't beat the best run so
+           far (or floor_meters).
+        3. for the whole block at once, drop chords that properly cross an edge and extend the rest to the boundary.
+        4. chords that graze vertices or run along edges get the exact one at a time check.
+    Within a block the chords with the longest possible runs are checked first.
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs representing the vertices of the polygon, where each pair is (latitude, longitude).
+        cap_meters (float): stop looking once a line at least this long turns up.
+        visualize (bool): If True, print how many chords made it through each step.
+        holes (list[numpy.ndarray]): Optional rings, in the same format as vertices, that are cut out of the polygon.
+        floor_meters (float): lines shorter than this don't matter, which lets the search skip a lot more chords.
+        block_cells (int): Caps the size of the chord x edge matrices so memory stays bounded.
+        budget (SearchBudget): optional limit on the search. If it runs out the longest line found so far is
+            returned and budget.exhausted is set.
+        meters (list[numpy.ndarray]): the outer ring followed by the holes, already in local meters, like
+            PolygonStore.rings_in_meters gives. Without it vertices and holes get projected with rings_to_meters.
+
+    Returns:
+        float: the length in meters of the longest line inside the polygon, if it's between floor_meters and
+            cap_meters. Above cap_meters it's the first line found that's at least cap_meters. Below floor_meters it's
+            just some number below floor_meters.
+    """
+    rings = rings_to_meters(vertices, holes) if meters is None else meters
+    starts, ends = ring_edges(rings)
+    points = np.concatenate([_open_ring(ring) for ring in rings])
+    to_next, to_previous = _interior_neighbours(rings)
+
+    lower = points.min(axis=0)
+    upper = points.max(axis=0)
+    if np.hypot(*(upper - lower)) < floor_meters or len(starts) < 3:
+        return 0.0
+
+    block_size = max(1, block_cells // len(starts))
+    chunk_size = min(16, block_size)
+    budget = budget or SearchBudget()
+
+    def check_chords(p, q, longest):
+        runs, needs_exact = _interior_run_lengths_block(p, q, starts, ends)
+        if len(runs):
+            longest = max(longest, runs.max())
+        checked = 0
+        for a, b in zip(p[needs_exact], q[needs_exact]):
+            if longest >= cap_meters:
+                break
+            checked += 1
+            longest = max(longest, interior_run_length(a, b, starts, ends))
+        return longest, checked
+
+    # the far apart pairs first, they're cheap and a passing lake usually passes on one of them
+    i, j = far_vertex_pairs(points)
+    chords = candidates = len(i)
+    longest, exact_checks = check_chords(points[i], points[j], 0.0)
+
+    for i, j in _vertex_pair_blocks(len(points), max(block_size, 1 << 16)):
+        if longest >= cap_meters or budget.exhausted:
+            break
+        p, q = points[i], points[j]
+        chords += len(p)
+        d = q - p
+
+        # the chord has to leave both ends into the water, and it can only keep going past an end if that end is
+        # a reflex corner it fits through. that gives us an upper bound on how long its run could be.
+        enters = _heads_inside(d, to_next[i], to_previous[i]) & _heads_inside(-d, to_next[j], to_previous[j])
+        extends_back = _heads_inside(-d, to_next[i], to_previous[i])
+        extends_forward = _heads_inside(d, to_next[j], to_previous[j])
+
+        t_low, t_high = _clipped_line_params(p, q, lower, upper)
+        with np.errstate(invalid='ignore'):
+            bound = (np.where(extends_forward, t_high, 1) - np.where(extends_back, t_low, 0)) * np.hypot(d[:, 0], d[:, 1])
+
+        long_enough = enters & (bound >= max(floor_meters, longest))
+        order = np.argsort(-bound[long_enough], kind='stable')
+        p, q, bound = p[long_enough][order], q[long_enough][order], bound[long_enough][order]
+        candidates += len(p)
+
+        # longest possible runs first, and passing lakes usually pass on one of the first few chords, so start small
+        # and grow the chunks. once the bounds drop under the best run so far the rest of the block can't beat it
+        start = 0
+        while start < len(p) and longest < cap_meters and bound[start] >= max(floor_meters, longest):
+            stop = start + chunk_size
+            keep = bound[start:stop] >= max(floor_meters, longest)
+            if not budget.spend(int(np.count_nonzero(keep))):
+                break
+            longest, checked = check_chords(p[start:stop][keep], q[start:stop][keep], longest)
+            exact_checks += checked
+
+            start = stop
+            chunk_size = min(2 * chunk_size, block_size)
+
+    if visualize:
+        print(f"candidate chords: {candidates}, exact checks: {exact_checks}, longest: {longest:.1f}")
+
+    if METRICS.enabled:
+        METRICS.count('exact.polygons')
+        METRICS.count('exact.chords', chords)
+        METRICS.count('exact.candidates', candidates)
+        METRICS.count('exact.exact_checks', exact_checks)
+        METRICS.count('exact.early_exits', int(longest >= cap_meters))
+        METRICS.count('exact.out_of_budget', int(budget.exhausted and longest < cap_meters))
+
+    return float(longest)
+
+
+def has_length_within_polygon_raster(vertices, target_meters, visualize=False, holes=None,
+                                     resolution_meters=RASTER_RESOLUTION_METERS, **exact_options):
+    """
+    The raster screen from toolbox/raster.py with the exact engine behind it. If the scanlines already show a line
+    of at least target_meters, or show that nothing that long fits, that's the answer. Only the borderline
+    polygons go through has_length_within_polygon_exact, so the answer is always the same as the exact engine's.
+    evaluate_polygons screens a whole store at once instead of calling this one polygon at a time.
+
+    Parameters:
+        vertices (numpy.ndarray): Array of ordered pairs representing the vertices of the polygon, where each pair is (latitude, longitude).
+        target_meters (float): the distance that we are checking for within the polygon
+        visualize (bool): passed along to the exact engine.
+        holes (list[numpy.ndarray]): Optional rings, in the same format as vertices, that are cut out of the polygon.
+        resolution_meters (float): the space between scanlines.
+        exact_options: passed along to has_length_within_polygon_exact, like budget_seconds or meters.
+
+    Returns:
+        str: "Passes", "Fails", or "Fails*" if the exact engine ran out of budget.
+    """
+    holes = [np.asarray(hole, dtype=float).reshape(-1, 2) for hole in (holes or [])]
+    store = PolygonStore(vertices, [0, len(vertices)],
+                         hole_coordinates=np.concatenate(holes) if holes else np.empty((0, 2)),
+                         hole_offsets=np.cumsum([0] + [len(hole) for hole in holes]),
+                         hole_owners=np.zeros(len(holes), dtype=np.int64))
+    solution = raster_screen(store, target_meters, resolution_meters)[0]
+    if solution is None:
+        solution = has_length_within_polygon_exact(vertices, target_meters, visualize, holes, **exact_options)
+    return solution
+
+
+LONGEST_LENGTH_ENGINES = {
+    "naive": longest_length_within_polygon_naive,
+    "exact": longest_length_within_polygon_exact,
+    "raster": longest_length_within_polygon_exact,  # the raster engine always agrees with the exact one
+}
+
+
+LANDABILITY_ENGINES = {
+    "naive": has_length_within_polygon_naive,
+    "exact": has_length_within_polygon_exact,
+    "raster": has_length_within_polygon_raster,
+}
+
+
+def raw_vertices_to_df(polygons) -> pd.DataFrame:
+    """
+    Converts polygons to a dataframe in Kai's format (Polygon, Latitude, Longitude), numbering them 0, 1, 2, ...
+
+    Args:
+        polygons: a PolygonStore, or a list of vertex arrays
+    """
+    if not isinstance(polygons, PolygonStore):
+        polygons = PolygonStore.from_vertices(polygons)
 
-    for polygon_number, polygon in enumerate(polygons):
-        for latitude, longitude in polygon:
-            data["Polygon"].append(polygon_number)
-            data["Latitude"].append(latitude)
-            data["Longitude"].append(longitude)
+    return polygons.to_frame(ids=np.arange(len(polygons)))
 
-    return pd.DataFrame(data, columns=['Polygon', 'Latitude', 'Longitude'])
 
 def find_most_common_id_and_remove(df: pd.DataFrame) -> pd.DataFrame:
+    # nothing passed (like a file with no lakes in the region), so there's no surrounding polygon to drop either
+    if df.empty:
+        return df
     # get the id of the polygon that occurs the most
     surrounding_poly = df['Polygon'].mode()[0]
     return df[df['Polygon'] != surrounding_poly]
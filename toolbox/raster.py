@@ -0,0 +1,147 @@
+"""
+A rough but fast way to size up lots of polygons at once. Every polygon in a store gets rasterized onto the same set
+of scanlines, resolution_meters apart, at a handful of headings. Each scanline is kept as runs (where it goes in and
+out of the polygon) instead of pixels, so a run is a straight line that really is inside the polygon. The longest
+run is a lower bound on the longest straight line inside the polygon, and the widest the polygon gets along the
+headings gives an upper bound. All of it is plain numpy over every polygon in a batch, there's no loop per polygon.
+
+Most polygons land clearly on one side of the target, only the ones whose bounds straddle it need a real engine.
+"""
+
+import numpy as np
+from toolbox.metrics import METRICS
+from toolbox.store import PolygonStore, ring_next
+
+RASTER_RESOLUTION_METERS = 10.0
+RASTER_HEADINGS = 16
+
+
+def _store_edges_in_meters(polygons: PolygonStore, start, stop):
+    """
+    Every edge of every ring (holes included) of polygons start to stop, in the local meters of
+    PolygonStore.in_meters. The polygons and their holes are stored in order, so that's one slice of each array.
+
+    Returns:
+        tuple: (outer ring vertices in meters, edge starts, edge ends, the position of the polygon of each edge,
+            counted from start)
+    """
+    meters, hole_meters = polygons.in_meters()
+    offsets = polygons.offsets[start:stop + 1]
+    first_hole, last_hole = np.searchsorted(polygons.hole_owners, [start, stop])
+    hole_offsets = polygons.hole_offsets[first_hole:last_hole + 1]
+
+    points = meters[offsets[0]:offsets[-1]]
+    hole_points = hole_meters[hole_offsets[0]:hole_offsets[-1]]
+    vertex_owners = np.repeat(np.arange(stop - start), np.diff(offsets))
+    hole_owners = np.repeat(polygons.hole_owners[first_hole:last_hole] - start, np.diff(hole_offsets))
+
+    starts = np.concatenate([points, hole_points])
+    ends = np.concatenate([points[ring_next(offsets - offsets[0])],
+                           hole_points[ring_next(hole_offsets - hole_offsets[0])]])
+    return points, starts, ends, np.concatenate([vertex_owners, hole_owners])
+
+
+def _longest_runs(starts, ends, owners, num_polygons, heading, resolution_meters):
+    """
+    Rasterizes the edges onto scanlines along one heading and finds each polygon's longest run.
+    A scanline sits at w = (k + 0.5) * resolution_meters. An edge counts as crossing it if its ends are on
+    different sides, with an end exactly on the line counted as above, so every scanline crosses every ring an even
+    number of times and the crossings pair up into runs.
+    """
+    direction = np.array([np.cos(heading), np.sin(heading)])
+    normal = np.array([-direction[1], direction[0]])
+    u_start, u_end = starts @ direction, ends @ direction
+    w_start, w_end = starts @ normal, ends @ normal
+
+    low = np.ceil(np.minimum(w_start, w_end) / resolution_meters - 0.5).astype(np.int64)
+    high = np.ceil(np.maximum(w_start, w_end) / resolution_meters - 0.5).astype(np.int64)
+    crossings = high - low
+
+    edge = np.repeat(np.arange(len(starts)), crossings)
+    row = np.repeat(low - np.cumsum(crossings) + crossings, crossings) + np.arange(crossings.sum())
+    w = (row + 0.5) * resolution_meters
+    u = u_start[edge] + (w - w_start[edge]) * (u_end[edge] - u_start[edge]) / (w_end[edge] - w_start[edge])
+
+    # group the crossings by polygon and scanline, in order along the line. sorting by u and then doing a stable
+    # sort on one integer key is a lot quicker than lexsort
+    polygon = owners[edge]
+    key = polygon * (row.max(initial=0) - row.min(initial=0) + 1) + (row - row.min(initial=0))
+    order = np.argsort(u)
+    order = order[np.argsort(key[order], kind='stable')]
+    u, polygon = u[order], polygon[order]
+    runs, run_polygon = u[1::2] - u[::2], polygon[::2]
+
+    longest = np.zeros(num_polygons)
+    if len(runs):
+        first_run = np.flatnonzero(np.concatenate([[True], run_polygon[1:] != run_polygon[:-1]]))
+        longest[run_polygon[first_run]] = np.maximum.reduceat(runs, first_run)
+    return longest
+
+
+def raster_length_bounds(polygons: PolygonStore, resolution_meters=RASTER_RESOLUTION_METERS,
+                         num_headings=RASTER_HEADINGS, block_cells=1 << 22):
+    """
+    Brackets the longest straight line inside each polygon (holes cut out) without looking at them one at a time.
+
+    The lower bound is the longest scanline run over all the headings, so there really is a line that long inside the
+    polygon. The upper bound comes from the widths: the longest line can't be longer than the diameter, and the
+    diameter is within half the heading spacing of one of the headings, so it's at most the widest width over
+    cos(pi / (2 * num_headings)). Finer resolutions and more headings pull the lower bound up at the cost of more
+    scanline crossings.
+
+    Parameters:
+        polygons (PolygonStore): the polygons to size up.
+        resolution_meters (float): the space between scanlines.
+        num_headings (int): how many headings to rasterize at, spread over half a turn.
+        block_cells (int): roughly how many scanline crossings to work on at once, so memory stays bounded.
+
+    Returns:
+        tuple: (lower, upper) arrays in meters, one entry per polygon. The true length is always in between, so
+            upper - lower is the error bound.
+    """
+    lower = np.zeros(len(polygons))
+    upper = np.zeros(len(polygons))
+    headings = np.pi * np.arange(num_headings) / num_headings
+
+    # a ring crosses about (its perimeter / resolution) scanlines per heading, cut the store up by that
+    owners = np.repeat(np.arange(len(polygons)), polygons.vertex_counts)
+    steps = np.diff(polygons.in_meters()[0], axis=0)
+    same_polygon = owners[1:] == owners[:-1]
+    perimeters = np.bincount(owners[1:][same_polygon], np.hypot(*steps[same_polygon].T), minlength=len(polygons))
+    cost = (perimeters / resolution_meters + polygons.vertex_counts) * num_headings
+    batch_starts = np.flatnonzero(np.diff((np.cumsum(cost) - cost) // block_cells, prepend=-1))
+
+    for start, stop in zip(batch_starts, list(batch_starts[1:]) + [len(polygons)]):
+        points, starts, ends, edge_owners = _store_edges_in_meters(polygons, start, stop)
+        counts = polygons.vertex_counts[start:stop]
+        first_vertices = (polygons.offsets[start:stop] - polygons.offsets[start])[counts > 0]
+
+        for heading in headings:
+            runs = _longest_runs(starts, ends, edge_owners, stop - start, heading, resolution_meters)
+            lower[start:stop] = np.maximum(lower[start:stop], runs)
+
+            u = points @ np.array([np.cos(heading), np.sin(heading)])
+            width = np.zeros(stop - start)
+            width[counts > 0] = np.maximum.reduceat(u, first_vertices) - np.minimum.reduceat(u, first_vertices)
+            upper[start:stop] = np.maximum(upper[start:stop], width)
+
+    upper /= np.cos(np.pi / (2 * num_headings))
+    METRICS.count('raster.polygons', len(polygons))
+    return lower, np.maximum(upper, lower)
+
+
+def raster_screen(polygons: PolygonStore, target_meters, resolution_meters=RASTER_RESOLUTION_METERS,
+                  num_headings=RASTER_HEADINGS):
+    """
+    Sorts polygons into the ones that surely pass, the ones that surely fail, and the borderline ones an engine
+    still has to look at, see raster_length_bounds.
+
+    Returns:
+        numpy.ndarray: "Passes", "Fails" or None for each polygon.
+    """
+    lower, upper = raster_length_bounds(polygons, resolution_meters, num_headings)
+    verdicts = np.full(len(polygons), None, dtype=object)
+    verdicts[upper < target_meters] = "Fails"
+    verdicts[lower >= target_meters] = "Passes"
+    METRICS.count('raster.borderline', int(np.count_nonzero(verdicts == None)))  # noqa: E711
+    return verdicts
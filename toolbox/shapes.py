@@ -0,0 +1,194 @@
+"""
+Sizes up every polygon in a store at once (area, perimeter, edge lengths, how round it is) and lines the polygons up
+with the flight destinations from the paper, so we can see which sizes of lake we find and which ones we miss.
+Everything is plain numpy over the flat arrays of the store, there's no loop per polygon.
+"""
+
+import numpy as np
+import pandas as pd
+from toolbox.nearest import nearest_points
+from toolbox.spatial_index import BoundingBoxGrid
+from toolbox.store import PolygonStore, ring_next
+
+SHAPE_COLUMNS = ['Polygon', 'Latitude', 'Longitude', 'Vertices', 'Area', 'Perimeter', 'Edge Mean', 'Edge Std',
+                 'Edge Min', 'Edge Max', 'Compactness']
+MATCH_COLUMNS = ['DestID', 'LakeName', 'Lat', 'Long', 'Dest_sqkm', 'Flights', 'Polygon', 'Match', 'Area_sqkm',
+                 'Area Ratio']
+SIZE_BINS_SQKM = (0, 0.1, 1, 10, 100, np.inf)
+
+
+def _ring_areas(points, offsets):
+    # shoelace area of every ring, the points already in meters
+    following = points[ring_next(offsets)]
+    cross = points[:, 0] * following[:, 1] - following[:, 0] * points[:, 1]
+    owners = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return np.abs(np.bincount(owners, cross, minlength=len(offsets) - 1)) / 2
+
+
+def polygon_shapes(polygons: PolygonStore) -> pd.DataFrame:
+    """
+    Works out the shape numbers of every polygon in one pass, in the local meters of PolygonStore.in_meters.
+
+    Area is the shoelace area of the outer ring minus its holes, in square meters. Perimeter and the edge numbers are
+    for the outer ring only, the same edges as the Perimeter in the results file (the last one wraps around to the
+    first vertex), and Edge Std is np.std of them. Compactness is 4 pi Area / Perimeter^2 (Polsby-Popper): 1 for a
+    circle, close to 0 for a long thin lake or a ragged shoreline.
+
+    Returns:
+        a dataframe with SHAPE_COLUMNS, one row per polygon in store order. Latitude and Longitude are the average
+        vertex, like average_vertice_location. Polygons without vertices get nans.
+    """
+    meters, hole_meters = polygons.in_meters()
+    counts = polygons.vertex_counts
+    owners = np.repeat(np.arange(len(polygons)), counts)
+    non_empty = counts > 0
+    starts = polygons.offsets[:-1][non_empty]
+
+    edges = np.hypot(*(meters[ring_next(polygons.offsets)] - meters).T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perimeter = np.bincount(owners, edges, minlength=len(polygons))
+        edge_mean = perimeter / counts
+        edge_std = np.sqrt(np.bincount(owners, (edges - edge_mean[owners]) ** 2, minlength=len(polygons)) / counts)
+        latitude = np.bincount(owners, polygons.coordinates[:, 0], minlength=len(polygons)) / counts
+        longitude = np.bincount(owners, polygons.coordinates[:, 1], minlength=len(polygons)) / counts
+
+    edge_min = np.full(len(polygons), np.nan)
+    edge_max = np.full(len(polygons), np.nan)
+    if len(starts):
+        edge_min[non_empty] = np.minimum.reduceat(edges, starts)
+        edge_max[non_empty] = np.maximum.reduceat(edges, starts)
+
+    area = _ring_areas(meters, polygons.offsets)
+    area -= np.bincount(polygons.hole_owners, _ring_areas(hole_meters, polygons.hole_offsets),
+                        minlength=len(polygons))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        compactness = np.where(perimeter > 0, 4 * np.pi * area / perimeter ** 2, np.nan)
+
+    return pd.DataFrame({'Polygon': polygons.ids, 'Latitude': latitude, 'Longitude': longitude, 'Vertices': counts,
+                         'Area': area, 'Perimeter': perimeter, 'Edge Mean': edge_mean, 'Edge Std': edge_std,
+                         'Edge Min': edge_min, 'Edge Max': edge_max, 'Compactness': compactness},
+                        columns=SHAPE_COLUMNS)
+
+
+def polygons_containing(polygons: PolygonStore, points, block_cells=1 << 22):
+    """
+    Finds every (point, polygon) pair where the polygon's outer ring holds the point, using the same crossing rule as
+    points_in_polygon. The bounding box grid narrows it down to a few candidate pairs, then all the edges of all the
+    candidates get checked together.
+
+    Args:
+        polygons (PolygonStore): the polygons.
+        points: (m, 2) array of (lat, lon).
+        block_cells (int): roughly how many pair / edge checks to do at once, so memory stays bounded.
+
+    Returns: (point_index, polygon_index) arrays of the pairs, grouped by point.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    point_index, polygon_index = BoundingBoxGrid.from_store(polygons).candidates(points)
+    counts = polygons.vertex_counts[polygon_index]
+    inside = np.zeros(len(point_index), dtype=bool)
+
+    batch_starts = np.flatnonzero(np.diff((np.cumsum(counts) - counts) // block_cells, prepend=-1))
+    for start, stop in zip(batch_starts, list(batch_starts[1:]) + [len(point_index)]):
+        batch_counts = counts[start:stop]
+        pair = np.repeat(np.arange(stop - start), batch_counts)
+        ring_start = np.repeat(polygons.offsets[polygon_index[start:stop]], batch_counts)
+        step = np.arange(batch_counts.sum()) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+
+        # edge k goes from vertex k - 1 to vertex k, same as points_in_polygon
+        x1, y1 = polygons.coordinates[ring_start + (step - 1) % np.repeat(batch_counts, batch_counts)].T
+        x2, y2 = polygons.coordinates[ring_start + step].T
+        x, y = points[point_index[start:stop][pair]].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intercept = (y - y1) * (x2 - x1) / (y2 - y1) + x1
+        crossings = ((np.minimum(y1, y2) < y) & (y <= np.maximum(y1, y2)) & (x <= np.maximum(x1, x2)) &
+                     ((x1 == x2) | (x <= intercept)))
+        inside[start:stop] = np.bincount(pair, crossings, minlength=stop - start) % 2 == 1
+
+    return point_index[inside], polygon_index[inside]
+
+
+def match_destinations(polygons: PolygonStore, destinations: pd.DataFrame, shapes: pd.DataFrame = None,
+                       max_area_ratio=4.0) -> pd.DataFrame:
+    """
+    Pairs each flight destination with the polygon that is that lake, by location and area.
+
+    A destination inside one or more polygons gets the one whose area is closest to its Dest_sqkm (on a log scale,
+    so half as big and twice as big are equally far off). One that isn't inside any polygon, like a point that
+    missed a crescent shaped lake, gets the polygon with the closest average vertex if that's no farther away than
+    the lake is wide (the square root of its area) and the two areas are within max_area_ratio of each other.
+
+    Parameters:
+        polygons (PolygonStore): the polygons to match against, usually the ones that passed.
+        destinations (pandas.DataFrame): Lat, Long and Dest_sqkm per destination, like read_flight_destinations.
+        shapes (pandas.DataFrame): polygon_shapes of polygons, if it's already been worked out.
+        max_area_ratio (float): how far off the areas of a 'nearby' match can be.
+
+    Returns:
+        destinations with the MATCH_COLUMNS it has plus Polygon (the polygon id, -1 if there's no match), Match
+        ('inside', 'nearby' or ''), Area_sqkm (the polygon's area) and Area Ratio (polygon area / Dest_sqkm).
+    """
+    shapes = polygon_shapes(polygons) if shapes is None else shapes
+    points = destinations[['Lat', 'Long']].to_numpy(dtype=np.float64)
+    dest_area = destinations['Dest_sqkm'].to_numpy(dtype=np.float64) * 1e6
+    area = shapes['Area'].to_numpy()
+    matched = np.full(len(destinations), -1, dtype=np.int64)
+    match = np.full(len(destinations), '', dtype=object)
+
+    point_index, polygon_index = polygons_containing(polygons, points)
+    if len(point_index):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            miss = np.abs(np.log(area[polygon_index] / dest_area[point_index]))
+        miss = np.where(np.isnan(miss), np.inf, miss)
+        order = np.lexsort([miss, point_index])
+        first = order[np.concatenate([[True], np.diff(point_index[order]) != 0])]
+        matched[point_index[first]] = polygon_index[first]
+        match[point_index[first]] = 'inside'
+
+    outside = np.flatnonzero(matched < 0)
+    if len(outside) and len(polygons):
+        centers = shapes[['Latitude', 'Longitude']].to_numpy()
+        usable = np.flatnonzero(~np.isnan(centers).any(axis=1))
+        positions, distances = nearest_points(points[outside], centers[usable])
+        closest = usable[np.maximum(positions, 0)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = area[closest] / dest_area[outside]
+        near = ((positions >= 0) & (distances <= np.sqrt(dest_area[outside])) &
+                (ratio <= max_area_ratio) & (ratio >= 1 / max_area_ratio))
+        matched[outside[near]] = closest[near]
+        match[outside[near]] = 'nearby'
+
+    found = matched >= 0
+    result = destinations.copy()
+    result['Polygon'] = np.where(found, polygons.ids[np.maximum(matched, 0)] if len(polygons) else -1, -1)
+    result['Match'] = match
+    result['Area_sqkm'] = np.where(found, area[np.maximum(matched, 0)] / 1e6 if len(polygons) else np.nan, np.nan)
+    result['Area Ratio'] = result['Area_sqkm'] / result['Dest_sqkm']
+    return result
+
+
+def detection_by_size(matches: pd.DataFrame, bins=SIZE_BINS_SQKM) -> pd.DataFrame:
+    """
+    Sums up match_destinations by lake size.
+
+    Returns:
+        one row per Dest_sqkm bin with how many destinations fall in it, how many got matched, the percent matched,
+        the percent of the bin's flights that go to a matched lake, and the median Area Ratio of the matches.
+    """
+    found = matches['Match'].to_numpy() != ''
+    df = pd.DataFrame({'Size_sqkm': pd.cut(matches['Dest_sqkm'], list(bins), right=False),
+                       'Detected': found,
+                       'Flights': matches['Flights'].to_numpy(),
+                       'Detected Flights': np.where(found, matches['Flights'].to_numpy(), 0),
+                       'Area Ratio': np.where(found, matches['Area Ratio'].to_numpy(), np.nan)})
+    summary = df.groupby('Size_sqkm', observed=False).agg(Destinations=('Detected', 'size'),
+                                                          Detected=('Detected', 'sum'),
+                                                          Flights=('Flights', 'sum'),
+                                                          detected_flights=('Detected Flights', 'sum'),
+                                                          median_ratio=('Area Ratio', 'median'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary['Detected %'] = 100 * summary['Detected'] / summary['Destinations']
+        summary['Flights Detected %'] = 100 * summary['detected_flights'] / summary['Flights']
+    summary = summary.rename(columns={'median_ratio': 'Median Area Ratio'}).drop(columns='detected_flights')
+    return summary.reset_index()[['Size_sqkm', 'Destinations', 'Detected', 'Detected %', 'Flights',
+                                  'Flights Detected %', 'Median Area Ratio']]
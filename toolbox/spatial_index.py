@@ -0,0 +1,113 @@
+"""
+A uniform grid over the bounding boxes of a set of polygons, so a point only gets checked against the handful of
+polygons whose boxes could hold it instead of every polygon in the file.
+"""
+
+import numpy as np
+from toolbox.store import PolygonStore
+
+
+def polygon_bounding_boxes(polygons: PolygonStore) -> np.ndarray:
+    """
+    Returns: (k, 4) array of (min lat, min lon, max lat, max lon) for every polygon in the store.
+    """
+    boxes = np.full((len(polygons), 4), np.nan)
+    non_empty = np.flatnonzero(polygons.vertex_counts > 0)
+    if len(non_empty):
+        starts = polygons.offsets[:-1][non_empty]
+        boxes[non_empty, :2] = np.minimum.reduceat(polygons.coordinates, starts)
+        boxes[non_empty, 2:] = np.maximum.reduceat(polygons.coordinates, starts)
+    return boxes
+
+
+class BoundingBoxGrid:
+    """
+    Buckets polygon bounding boxes into grid cells. Every cell keeps the list of boxes that touch it, stored the same
+    ragged way as PolygonStore (cell_polygons[cell_offsets[c]:cell_offsets[c + 1]]).
+
+    Attributes:
+        boxes (numpy.ndarray): (min lat, min lon, max lat, max lon) of each polygon.
+        origin (numpy.ndarray): the (lat, lon) corner of cell (0, 0).
+        cell_size (numpy.ndarray): the (lat, lon) size of one cell.
+        shape (tuple): number of cells along lat and lon.
+    """
+
+    def __init__(self, boxes, cells_per_polygon=1.0):
+        """
+        Args:
+            boxes: (k, 4) bounding boxes, see polygon_bounding_boxes. Boxes with nans are never returned.
+            cells_per_polygon: roughly how many grid cells to make for each polygon.
+        """
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        valid = np.flatnonzero(~np.isnan(self.boxes).any(axis=1))
+
+        if len(valid) == 0:
+            self.origin, self.cell_size, self.shape = np.zeros(2), np.ones(2), (1, 1)
+            self.cell_offsets, self.cell_polygons = np.zeros(2, dtype=np.int64), np.empty(0, dtype=np.int64)
+            return
+
+        lower = self.boxes[valid, :2].min(axis=0)
+        upper = self.boxes[valid, 2:].max(axis=0)
+        extent = np.maximum(upper - lower, 1e-9)
+
+        # square-ish cells, about cells_per_polygon of them per polygon but never smaller than a typical box, so most
+        # boxes only land in a cell or two
+        cell = np.sqrt(extent.prod() / max(cells_per_polygon * len(valid), 1))
+        typical_box = np.median(self.boxes[valid, 2:] - self.boxes[valid, :2], axis=0)
+        cell_size = np.maximum(np.maximum(cell, typical_box), extent / 4096)
+
+        self.origin = lower
+        self.cell_size = cell_size
+        self.shape = tuple(int(n) for n in np.floor(extent / cell_size).astype(np.int64) + 1)
+
+        # every (cell, polygon) pair a box covers
+        first = self._cell_indices(self.boxes[valid, :2])
+        last = self._cell_indices(self.boxes[valid, 2:])
+        span_lat = last[:, 0] - first[:, 0] + 1
+        span_lon = last[:, 1] - first[:, 1] + 1
+        covered = span_lat * span_lon
+
+        owner = np.repeat(np.arange(len(valid)), covered)
+        step = np.arange(covered.sum()) - np.repeat(np.cumsum(covered) - covered, covered)
+        cell_lat = first[owner, 0] + step // span_lon[owner]
+        cell_lon = first[owner, 1] + step % span_lon[owner]
+        cell_ids = cell_lat * self.shape[1] + cell_lon
+
+        order = np.argsort(cell_ids, kind='stable')
+        self.cell_polygons = valid[owner[order]]
+        self.cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(cell_ids, minlength=self.shape[0] *
+                                                                       self.shape[1]))])
+
+    @classmethod
+    def from_store(cls, polygons: PolygonStore, cells_per_polygon=1.0):
+        return cls(polygon_bounding_boxes(polygons), cells_per_polygon)
+
+    def _cell_indices(self, points):
+        cells = np.floor((np.asarray(points, dtype=np.float64) - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, np.array(self.shape) - 1)
+
+    def candidates(self, points):
+        """
+        Finds the polygons whose bounding box holds each point, edges included.
+
+        Args:
+            points: (m, 2) array of (lat, lon).
+
+        Returns: (point_index, polygon_index) arrays listing every point / box pair, grouped by point.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        cells = self._cell_indices(points)
+        cell_ids = cells[:, 0] * self.shape[1] + cells[:, 1]
+
+        starts = self.cell_offsets[cell_ids]
+        counts = self.cell_offsets[cell_ids + 1] - starts
+        point_index = np.repeat(np.arange(len(points)), counts)
+        polygon_index = self.cell_polygons[np.repeat(starts - np.cumsum(counts) + counts, counts) +
+                                           np.arange(counts.sum())]
+
+        # the cell is only a coarse filter, check the actual box
+        boxes = self.boxes[polygon_index]
+        p = points[point_index]
+        inside = ((boxes[:, 0] <= p[:, 0]) & (p[:, 0] <= boxes[:, 2]) &
+                  (boxes[:, 1] <= p[:, 1]) & (p[:, 1] <= boxes[:, 3]))
+        return point_index[inside], polygon_index[inside]
@@ -2,8 +2,11 @@
 contains a helper function to generate some statistics, written by kai
 """
 
+import numpy as np
 import pandas as pd
 from toolbox.polygons import is_point_in_polygon
+from toolbox.spatial_index import BoundingBoxGrid
+from toolbox.store import PolygonStore
 from toolbox.debugging_tools import stop_watch
 
 @stop_watch
@@ -25,28 +28,22 @@ def generate_positive_identification_statistics(outline_df: pd.DataFrame,
 
     """
 
-    unique_polygon_numbers = outline_df['Polygon'].unique()
+    # group the vertices by polygon once, then index their bounding boxes so each marker only gets checked against
+    # the few polygons that could hold it
+    outlines = PolygonStore.from_frame(outline_df)
+    grid = BoundingBoxGrid.from_store(outlines)
 
-    known_lakes_considered = 0
-    lakes_correctedly_detected = 0
+    markers = marker_df[['Lat', 'Long']].to_numpy(dtype=np.float64)
+    marker_index, polygon_index = grid.candidates(markers)
 
-    marker_df['detected'] = 0
+    detected = np.zeros(len(markers), dtype=int)
+    for marker, polygon in zip(marker_index, polygon_index):
+        if not detected[marker] and is_point_in_polygon(outlines[polygon].tolist(), tuple(markers[marker])):
+            detected[marker] = 1
 
-    for index, row in marker_df.iterrows():
-        # get the lat long of the lake
-        lat, lon = row['Lat'], row['Long']
-        known_lakes_considered += 1
-
-        for poly_id in unique_polygon_numbers:
-            poly = outline_df[outline_df['Polygon'] == poly_id]
-            poly_lats = poly['Latitude'].to_list()
-            poly_lons = poly['Longitude'].to_list()
-            poly_verts = list(zip(poly_lats, poly_lons))
-
-            if is_point_in_polygon(poly_verts, (lat, lon)):
-                lakes_correctedly_detected += 1
-                marker_df.at[index, 'detected'] = 1  # Set 'detected' flag directly on the original DataFrame
-                break
+    marker_df['detected'] = detected
+    known_lakes_considered = len(marker_df)
+    lakes_correctedly_detected = int(detected.sum())
 
     if verbose:
         print(f'considered {known_lakes_considered} lakes')
@@ -0,0 +1,234 @@
+"""
+A compact container for all the polygons in a file. Instead of a dict of small arrays we keep every vertex in one
+flat array and an offsets array that says where each polygon starts and stops, so loading, subsetting and exporting
+are all plain numpy operations.
+"""
+
+import numpy as np
+import pandas as pd
+from toolbox.distance import lat_lon_to_meters
+
+
+def _gather(offsets, positions):
+    """
+    For a ragged array described by offsets, finds the flat indices of the items at positions and the offsets of the
+    ragged array made of just those items.
+    """
+    counts = np.diff(offsets)[positions]
+    new_offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+
+    # index of every item we keep: the start of its row plus how far into the row it is
+    flat_index = np.repeat(offsets[positions] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return flat_index, new_offsets
+
+
+def ring_next(offsets) -> np.ndarray:
+    """
+    For rings stored the ragged way (ring k is items offsets[k] to offsets[k + 1]), finds the index of the next item
+    around each ring, with the last item of a ring wrapping back to its first. Edge i of a ring goes from item i to
+    item ring_next(offsets)[i].
+    """
+    offsets = np.asarray(offsets)
+    following = np.arange(1, offsets[-1] + 1)
+    non_empty = np.diff(offsets) > 0
+    following[offsets[1:][non_empty] - 1] = offsets[:-1][non_empty]
+    return following
+
+
+class PolygonStore:
+    """
+    Ragged array of polygons.
+
+    Attributes:
+        coordinates (numpy.ndarray): (n, 2) array of every vertex as (latitude, longitude), one polygon after another.
+        offsets (numpy.ndarray): polygon k is coordinates[offsets[k]:offsets[k + 1]].
+        ids (numpy.ndarray): the polygon id of each polygon.
+        hole_coordinates (numpy.ndarray): the vertices of every hole, stored the same way as the polygons.
+        hole_offsets (numpy.ndarray): hole r is hole_coordinates[hole_offsets[r]:hole_offsets[r + 1]].
+        hole_owners (numpy.ndarray): the position of the polygon each hole belongs to, in increasing order.
+        features (numpy.ndarray): the row of the gee export each polygon came from. The parts of a MultiPolygon
+            share a row.
+    """
+
+    def __init__(self, coordinates, offsets, ids=None,
+                 hole_coordinates=None, hole_offsets=None, hole_owners=None, features=None):
+        self.coordinates = np.ascontiguousarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        if ids is None:
+            ids = np.arange(len(self.offsets) - 1)
+        self.ids = np.ascontiguousarray(ids, dtype=np.int64)
+
+        if hole_offsets is None:
+            hole_coordinates, hole_offsets, hole_owners = np.empty((0, 2)), [0], []
+        self.hole_coordinates = np.ascontiguousarray(hole_coordinates, dtype=np.float64).reshape(-1, 2)
+        self.hole_offsets = np.ascontiguousarray(hole_offsets, dtype=np.int64)
+        self.hole_owners = np.ascontiguousarray(hole_owners, dtype=np.int64)
+        self.features = np.ascontiguousarray(self.ids if features is None else features, dtype=np.int64)
+        self._meters = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, k):
+        # a view into the flat array, nothing gets copied
+        return self.coordinates[self.offsets[k]:self.offsets[k + 1]]
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def items(self):
+        """
+        Iterates over (id, vertices) pairs, the same way we used to loop over the dict of polygons.
+        """
+        for k in range(len(self)):
+            yield self.ids[k], self[k]
+
+    def holes(self, k):
+        """
+        Returns: the list of hole rings of polygon k, each one a view like self[k].
+        """
+        first, last = np.searchsorted(self.hole_owners, [k, k + 1])
+        return [self.hole_coordinates[self.hole_offsets[r]:self.hole_offsets[r + 1]] for r in range(first, last)]
+
+    def rings_in_meters(self, k):
+        """
+        Returns: polygon k followed by its holes in local meters, views into in_meters. It's the same list
+            rings_to_meters would give for the polygon, without projecting it again.
+        """
+        meters, hole_meters = self.in_meters()
+        first, last = np.searchsorted(self.hole_owners, [k, k + 1])
+        return [meters[self.offsets[k]:self.offsets[k + 1]]] + [
+            hole_meters[self.hole_offsets[r]:self.hole_offsets[r + 1]] for r in range(first, last)]
+
+    @property
+    def vertex_counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        arrays = [self.coordinates, self.offsets, self.ids,
+                  self.hole_coordinates, self.hole_offsets, self.hole_owners, self.features]
+        return sum(array.nbytes for array in arrays)
+
+    def in_meters(self):
+        """
+        Every vertex in local meters, worked out for all the polygons in one go and kept for next time. Polygon k is
+        done the same way rings_to_meters does it: shifted so its first vertex is the origin and scaled with the
+        conversion rate at the middle of its latitude range (see polygon_conversion). Its holes use the same origin
+        and rate.
+
+        Returns: (coordinates, hole_coordinates), lined up with the lat-lon arrays.
+        """
+        if self._meters is None:
+            counts = self.vertex_counts
+            starts = self.offsets[:-1][counts > 0]
+            origins = np.zeros((len(self), 2))
+            origins[counts > 0] = self.coordinates[starts]
+            middle = np.zeros(len(self))
+            if len(starts):
+                latitudes = self.coordinates[:, 0]
+                lowest, highest = np.minimum.reduceat(latitudes, starts), np.maximum.reduceat(latitudes, starts)
+                middle[counts > 0] = (lowest + highest) / 2
+            conversions = lat_lon_to_meters(np.column_stack([middle, np.zeros(len(self))]))
+
+            owners = np.repeat(np.arange(len(self)), counts)
+            hole_owners = np.repeat(self.hole_owners, np.diff(self.hole_offsets))
+            self._meters = ((self.coordinates - origins[owners]) * conversions[owners],
+                            (self.hole_coordinates - origins[hole_owners]) * conversions[hole_owners])
+        return self._meters
+
+    def vertex_polygon_ids(self):
+        """
+        Returns: the polygon id of every vertex, lined up with coordinates.
+        """
+        return np.repeat(self.ids, self.vertex_counts)
+
+    def subset(self, selection):
+        """
+        Makes a new store with only some of the polygons.
+
+        Args:
+            selection: a boolean mask or an array of polygon positions (not ids).
+
+        Returns: a PolygonStore with copies of the selected polygons, in the order they were selected.
+        """
+        positions = np.arange(len(self))[selection]
+        vertex_index, new_offsets = _gather(self.offsets, positions)
+
+        # the holes of each selected polygon, moved over to the polygon's new position
+        hole_starts = np.searchsorted(self.hole_owners, np.arange(len(self) + 1))
+        hole_index, _ = _gather(hole_starts, positions)
+        hole_vertex_index, new_hole_offsets = _gather(self.hole_offsets, hole_index)
+        new_hole_owners = np.repeat(np.arange(len(positions)), np.diff(hole_starts)[positions])
+
+        return PolygonStore(self.coordinates[vertex_index], new_offsets, self.ids[positions],
+                            self.hole_coordinates[hole_vertex_index], new_hole_offsets, new_hole_owners,
+                            self.features[positions])
+
+    def head(self, max_polygons):
+        """
+        Returns: a store with at most the first max_polygons polygons.
+        """
+        if max_polygons is None or max_polygons >= len(self):
+            return self
+        return self.subset(np.arange(max_polygons))
+
+    @classmethod
+    def from_vertices(cls, polygons, ids=None):
+        """
+        Builds a store from a list of (n, 2) vertex arrays.
+        """
+        polygons = [np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons]
+        counts = [len(polygon) for polygon in polygons]
+        coordinates = np.concatenate(polygons) if polygons else np.empty((0, 2))
+        return cls(coordinates, np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]), ids)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Puts several stores one after another in a single store. The ids and features are kept as they are, so they
+        can repeat if the stores came from different files.
+        """
+        stores = list(stores)
+        if not stores:
+            return cls(np.empty((0, 2)), [0])
+
+        polygon_starts = np.cumsum([0] + [len(store) for store in stores])
+        vertex_starts = np.cumsum([0] + [store.offsets[-1] for store in stores])
+        hole_starts = np.cumsum([0] + [store.hole_offsets[-1] for store in stores])
+        return cls(np.concatenate([store.coordinates for store in stores]),
+                   np.concatenate([[0]] + [store.offsets[1:] + start for store, start in zip(stores, vertex_starts)]),
+                   np.concatenate([store.ids for store in stores]),
+                   np.concatenate([store.hole_coordinates for store in stores]),
+                   np.concatenate([[0]] + [store.hole_offsets[1:] + start
+                                           for store, start in zip(stores, hole_starts)]),
+                   np.concatenate([store.hole_owners + start for store, start in zip(stores, polygon_starts)]),
+                   np.concatenate([store.features for store in stores]))
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame):
+        """
+        Builds a store from a dataframe in Kai's format (Polygon, Latitude, Longitude). Polygons keep the order they
+        first show up in, and a polygon's vertices keep their order even if its rows aren't next to each other.
+        """
+        codes, ids = pd.factorize(df['Polygon'])
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(ids))
+        coordinates = np.column_stack([df['Latitude'].to_numpy(dtype=np.float64),
+                                       df['Longitude'].to_numpy(dtype=np.float64)])[order]
+        return cls(coordinates, np.concatenate([[0], np.cumsum(counts)]), np.asarray(ids))
+
+    def to_frame(self, ids=None) -> pd.DataFrame:
+        """
+        Converts the store back into a dataframe in Kai's format. Only the outer rings are written, the holes don't
+        fit in that format.
+
+        Args:
+            ids: optional ids to use instead of the stored ones, one per polygon.
+        """
+        ids = self.ids if ids is None else np.asarray(ids)
+        return pd.DataFrame({"Polygon": np.repeat(ids, self.vertex_counts),
+                             "Latitude": self.coordinates[:, 0],
+                             "Longitude": self.coordinates[:, 1]},
+                            columns=['Polygon', 'Latitude', 'Longitude'])
@@ -0,0 +1,106 @@
+"""
+Makes up lakes for the benchmarks and tests. Every generator builds a closed ring in meters around (0, 0) with an
+exact number of vertices, then moves it to a spot in the Mat-Su so it looks like what GEE gives us.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+from toolbox.distance import lat_lon_to_meters
+
+MATSU_ORIGIN = (61.5, -150.0)
+
+
+def meters_to_lat_lon(points, origin=MATSU_ORIGIN):
+    """
+    Moves (north, east) offsets in meters to (lat, lon) around origin.
+    """
+    return np.asarray(origin) + np.asarray(points, dtype=float) / lat_lon_to_meters(origin)
+
+
+def _close(ring):
+    return np.vstack([ring, ring[:1]])
+
+
+def convex_blob(num_vertices, radius_meters=1000.0, rng=None):
+    """
+    An ellipse with unevenly spaced vertices, the easy case for every engine.
+    """
+    rng = rng or np.random.default_rng(0)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices - 1))
+    return _close(np.column_stack([radius_meters * np.cos(angles), 0.6 * radius_meters * np.sin(angles)]))
+
+
+def thin_s(num_vertices, length_meters=3000.0, width_meters=60.0, rng=None):
+    """
+    A thin 'S' shaped channel. Its ends are far apart but no long straight line fits inside, the case the naive
+    engine gets wrong.
+    """
+    half = (num_vertices - 1) // 2
+    t = np.linspace(0, 1, half)
+    center = np.column_stack([0.15 * length_meters * np.sin(2 * np.pi * t), length_meters * (t - 0.5)])
+
+    # offset the center line sideways by half the width on each side
+    tangent = np.gradient(center, axis=0)
+    normal = np.column_stack([-tangent[:, 1], tangent[:, 0]]) / np.hypot(tangent[:, 0], tangent[:, 1])[:, None]
+    left = center + normal * width_meters / 2
+    right = center - normal * width_meters / 2
+    ring = np.vstack([left, right[::-1]])
+    if len(ring) < num_vertices - 1:
+        ring = np.vstack([ring, (left[:1] + right[:1]) / 2])
+    return _close(ring)
+
+
+def star(num_vertices, outer_meters=1000.0, inner_meters=300.0, rng=None):
+    """
+    A star with (num_vertices - 1) / 2 points, lots of reflex corners.
+    """
+    angles = np.linspace(0, 2 * np.pi, num_vertices - 1, endpoint=False)
+    radii = np.where(np.arange(num_vertices - 1) % 2 == 0, outer_meters, inner_meters)
+    return _close(np.column_stack([radii * np.cos(angles), radii * np.sin(angles)]))
+
+
+def jagged_shoreline(num_vertices, radius_meters=1000.0, rng=None):
+    """
+    A lake with bays and points at a few scales plus pixel sized wiggles, like a shoreline traced off imagery.
+    """
+    rng = rng or np.random.default_rng(0)
+    angles = np.linspace(0, 2 * np.pi, num_vertices - 1, endpoint=False)
+    radii = np.ones_like(angles)
+    for harmonic in (2, 3, 5, 9, 17):
+        radii += rng.uniform(0.02, 0.25) / np.sqrt(harmonic) * np.sin(harmonic * angles + rng.uniform(0, 2 * np.pi))
+    radii = radius_meters * np.clip(radii, 0.2, None) + rng.uniform(-5, 5, len(angles))
+    return _close(np.column_stack([radii * np.cos(angles), radii * np.sin(angles)]))
+
+
+GENERATORS = {
+    "convex": convex_blob,
+    "thin_s": thin_s,
+    "star": star,
+    "jagged": jagged_shoreline,
+}
+
+
+def synthetic_lakes(shape, num_polygons, num_vertices, spacing_meters=5000.0, seed=0):
+    """
+    Lays out num_polygons lakes of one shape on a grid so they don't overlap.
+
+    Returns: list of (n, 2) (lat, lon) arrays
+    """
+    rng = np.random.default_rng(seed)
+    columns = int(np.ceil(np.sqrt(num_polygons)))
+    lakes = []
+    for k in range(num_polygons):
+        ring = GENERATORS[shape](num_vertices, rng=rng)
+        offset = spacing_meters * np.array([k // columns, k % columns])
+        lakes.append(meters_to_lat_lon(ring + offset))
+    return lakes
+
+
+def write_gee_csv(path, polygons) -> None:
+    """
+    Writes polygons the way a GEE export does: one row per polygon with its GeoJSON in the .geo column, lon first.
+    """
+    geo = [json.dumps({"type": "Polygon", "coordinates": [np.asarray(polygon)[:, ::-1].tolist()]})
+           for polygon in polygons]
+    pd.DataFrame({"system:index": [str(k) for k in range(len(polygons))], ".geo": geo}).to_csv(path, index=False)
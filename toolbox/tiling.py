@@ -0,0 +1,112 @@
+"""
+Splits the region of interest into a grid of tiles so the landability stage only ever sees polygons that are in the
+region, and so a tile can be run (and its results saved) on its own. Tiles are fixed cells of a global lat / lon
+grid, named by their row and column, so the same tile has the same name no matter which region or files asked for it.
+"""
+
+import hashlib
+import numpy as np
+from toolbox.polygons import polygons_in_region
+from toolbox.spatial_index import polygon_bounding_boxes
+from toolbox.store import PolygonStore
+
+
+def tile_name(row, column) -> str:
+    return f"{row}_{column}"
+
+
+def tiles_in_region(region, tile_degrees=0.25) -> dict:
+    """
+    Finds the grid cells that touch a region.
+
+    Args:
+        region: the (lat, lon) vertices of the region.
+        tile_degrees: the size of a tile in degrees of lat and lon.
+
+    Returns: tile name -> (min lat, min lon, max lat, max lon) for every tile that isn't entirely outside the region
+    """
+    region = np.asarray(region, dtype=np.float64).reshape(-1, 2)
+    first_row, first_column = np.floor(region.min(axis=0) / tile_degrees).astype(int)
+    last_row, last_column = np.floor(region.max(axis=0) / tile_degrees).astype(int)
+
+    rows, columns = np.meshgrid(np.arange(first_row, last_row + 1), np.arange(first_column, last_column + 1),
+                                indexing='ij')
+    rows, columns = rows.ravel(), columns.ravel()
+    lower = np.column_stack([rows, columns]) * tile_degrees
+    upper = lower + tile_degrees
+
+    # each tile as a little square polygon, so polygons_in_region can do the work
+    corners = np.stack([lower, np.column_stack([lower[:, 0], upper[:, 1]]), upper,
+                        np.column_stack([upper[:, 0], lower[:, 1]])], axis=1)
+    squares = PolygonStore(corners.reshape(-1, 2), np.arange(0, 4 * len(rows) + 1, 4))
+    touching = polygons_in_region(squares, region)
+
+    return {tile_name(row, column): (*low, *high)
+            for row, column, low, high, keep in zip(rows, columns, lower, upper, touching) if keep}
+
+
+def _tile_cells(boxes, tile_degrees):
+    # (row, column) of the cell holding the middle of each bounding box
+    return np.floor((boxes[:, :2] + boxes[:, 2:]) / 2 / tile_degrees).astype(np.int64)
+
+
+def assign_tiles(polygons: PolygonStore, tile_degrees=0.25) -> np.ndarray:
+    """
+    Every polygon belongs to exactly one tile, the one holding the middle of its bounding box. Big lakes spill over
+    into neighbouring tiles, but they only get checked once.
+
+    Returns: the tile name of every polygon in the store
+    """
+    cells = _tile_cells(polygon_bounding_boxes(polygons), tile_degrees)
+    return np.array([tile_name(row, column) for row, column in cells], dtype=object)
+
+
+def polygons_in_tiles(polygons: PolygonStore, region, tile_boxes: dict, tile_degrees=0.25):
+    """
+    Picks out the polygons that belong to one of the given tiles (see assign_tiles) and aren't entirely outside the
+    region. The bounding boxes go first: only polygons whose box middle lands inside the wanted tiles get a tile name
+    and the region check, so a statewide chunk costs about a box per polygon when one borough is asked for.
+
+    Args:
+        polygons: the store, usually one chunk of a gee export.
+        region: the (lat, lon) vertices of the region.
+        tile_boxes: tile name -> box of the wanted tiles, like tiles_in_region gives.
+        tile_degrees: the size of a tile in degrees of lat and lon.
+
+    Returns: (positions in the store, tile name of each) of the polygons to keep
+    """
+    if not tile_boxes or len(polygons) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=object)
+
+    boxes = polygon_bounding_boxes(polygons)
+    non_empty = np.flatnonzero(~np.isnan(boxes).any(axis=1))
+    cells = _tile_cells(boxes[non_empty], tile_degrees)
+    wanted = _tile_cells(np.array(list(tile_boxes.values()), dtype=np.float64), tile_degrees)
+    near = (cells >= wanted.min(axis=0)).all(axis=1) & (cells <= wanted.max(axis=0)).all(axis=1)
+
+    positions = non_empty[near]
+    names = np.array([tile_name(row, column) for row, column in cells[near]], dtype=object)
+    in_tiles = np.isin(names, list(tile_boxes)) if len(names) else np.zeros(0, dtype=bool)
+    positions, names = positions[in_tiles], names[in_tiles]
+
+    in_region = polygons_in_region(polygons.subset(positions), region)
+    return positions[in_region], names[in_region]
+
+
+def tile_hash(pieces, params: dict) -> str:
+    """
+    Content hash of a tile: the polygons from each file that landed in it (their positions, ids, vertices and holes)
+    plus the parameters of the run. If any of that changes, the saved results of the tile don't get reused.
+
+    Args:
+        pieces: list of (file name, positions in the file, PolygonStore of those polygons).
+        params: the run parameters, anything with a stable repr.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(sorted(params.items())).encode())
+    for file_name, positions, store in pieces:
+        digest.update(file_name.encode())
+        for array in (np.asarray(positions, dtype=np.int64), store.ids, store.offsets, store.coordinates,
+                      store.hole_offsets, store.hole_owners, store.hole_coordinates):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
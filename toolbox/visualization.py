@@ -2,9 +2,20 @@
 This script needs to provide a function to join together the .csv files containing polygon vertices
 and load them into a single map, together with the cleaned landable lakes data from Toby's work.
 """
+import base64
+import json
+import numpy as np
 import pandas as pd
 import folium
+from branca.element import Element, MacroElement
+from folium.plugins import FastMarkerCluster
+from jinja2 import Template
+from toolbox.spatial_index import polygon_bounding_boxes
+from toolbox.store import PolygonStore
 
+# (min zoom, max zoom, grid size in meters) for each level of detail of the outlines. the grid is about one pixel at
+# the most zoomed in end of the level up here (~150 m at zoom 9, ~20 m at zoom 12), so simplifying doesn't show
+MAP_DETAIL_LEVELS = [(0, 9, 150.0), (10, 12, 20.0), (13, 18, 0.0)]
 
 
 def map_lakes(outline_df: pd.DataFrame, marker_df: pd.DataFrame, map_file_name: str = "lake_map.html") -> None:
@@ -63,3 +74,221 @@ def map_lakes(outline_df: pd.DataFrame, marker_df: pd.DataFrame, map_file_name:
 
     map.save(map_file_name)
 
+
+def simplified_outlines(polygons: PolygonStore, tolerance_meters: float) -> PolygonStore:
+    """
+    Simplifies every outline for a zoom level by snapping: each polygon's vertices are put on a grid of
+    tolerance_meters cells and only the first vertex of each run in the same cell is kept. That's done for every
+    polygon at once, so it takes about as long as reading the vertices. A lake that ends up with fewer than three
+    corners is smaller than a cell, so it's left as a single vertex in the middle of its bounding box.
+
+    Args:
+        polygons: the outlines.
+        tolerance_meters: the size of the grid cells, 0 to keep every vertex.
+
+    Returns: a PolygonStore of the simplified outlines, same ids and order.
+    """
+    if not tolerance_meters > 0 or len(polygons.coordinates) == 0:
+        return PolygonStore(polygons.coordinates, polygons.offsets, polygons.ids)
+
+    # the grid is laid out in each polygon's local meters (see PolygonStore.in_meters), which the store keeps, so
+    # the other zoom levels get them for free
+    owner = np.repeat(np.arange(len(polygons)), polygons.vertex_counts)
+    meters, _ = polygons.in_meters()
+    cells = np.floor(meters / tolerance_meters).astype(np.int64)
+
+    keep = np.ones(len(owner), dtype=bool)
+    keep[1:] = (cells[1:] != cells[:-1]).any(axis=1) | (owner[1:] != owner[:-1])
+    ends = polygons.offsets[1:][polygons.vertex_counts > 0] - 1
+    keep[ends] = True  # the closing vertex
+
+    counts = np.bincount(owner[keep], minlength=len(polygons))
+    coordinates = polygons.coordinates[keep]
+
+    # swap the rings that collapsed for the middle of their bounding box
+    tiny = (counts < 4) & (counts > 0)
+    if tiny.any():
+        boxes = polygon_bounding_boxes(polygons)
+        middles = (boxes[:, :2] + boxes[:, 2:]) / 2
+        kept_counts = np.where(tiny, 0, counts)
+        coordinates = np.insert(coordinates[~np.repeat(tiny, counts)], np.cumsum(kept_counts)[tiny], middles[tiny],
+                                axis=0)
+        counts = np.where(tiny, 1, counts)
+    return PolygonStore(coordinates, np.concatenate([[0], np.cumsum(counts)]), polygons.ids)
+
+
+def encode_outlines(polygons: PolygonStore, precision=5) -> dict:
+    """
+    Packs outlines into a few base64 strings for the browser to unpack, which is a lot smaller and quicker to write
+    than GeoJSON: every coordinate is rounded to precision decimals, stored as an integer, and every vertex after the
+    first of its ring only stores how far it moved from the one before.
+
+    Returns: dict with 'scale' (10 ** precision), 'ids' (float64), 'counts' (int32 vertices per polygon) and
+        'coordinates' (int32 lat, lon pairs), all little endian.
+    """
+    scale = 10 ** precision
+    quantized = np.round(polygons.coordinates * scale).astype(np.int64)
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    starts = polygons.offsets[:-1][polygons.vertex_counts > 0]
+    deltas[starts] = quantized[starts]
+
+    def pack(array, dtype):
+        return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode('ascii')
+
+    return {"scale": scale,
+            "ids": pack(polygons.ids, '<f8'),
+            "counts": pack(polygons.vertex_counts, '<i4'),
+            "coordinates": pack(deltas, '<i4')}
+
+
+class _RawScript(Element):
+    _template = Template("{{ this.text }}")
+
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+
+
+class _OutlineLayer(Element):
+    """
+    One Leaflet GeoJSON layer holding every outline, unpacked in the browser from encode_outlines. A polygon that was
+    squashed down to one vertex is drawn as a small circle. The layer isn't added to the map here, _ZoomLevels does
+    that.
+    """
+    _script = Template("""
+        var {{ name }} = (function (packed) {
+            function unpack(text, Type) {
+                var bytes = atob(text), buffer = new Uint8Array(bytes.length);
+                for (var i = 0; i < bytes.length; i++) { buffer[i] = bytes.charCodeAt(i); }
+                return new Type(buffer.buffer);
+            }
+            var ids = unpack(packed.ids, Float64Array), counts = unpack(packed.counts, Int32Array);
+            var numbers = unpack(packed.coordinates, Int32Array);
+            var features = [], n = 0;
+            for (var k = 0; k < counts.length; k++) {
+                var lat = 0, lon = 0, ring = [];
+                for (var v = 0; v < counts[k]; v++, n += 2) {
+                    lat += numbers[n];
+                    lon += numbers[n + 1];
+                    ring.push([lon / packed.scale, lat / packed.scale]);
+                }
+                var geometry = ring.length == 1 ? {type: 'Point', coordinates: ring[0]}
+                                                : {type: 'Polygon', coordinates: [ring]};
+                features.push({type: 'Feature', properties: {Polygon: ids[k]}, geometry: geometry});
+            }
+            return L.geoJson({type: 'FeatureCollection', features: features}, {
+                style: {{ style }},
+                pointToLayer: function (feature, latlng) { return L.circleMarker(latlng, {radius: 3}); }
+            });
+        })({{ packed }});
+    """)
+
+    def __init__(self, polygons: PolygonStore, style: dict):
+        super().__init__()
+        self._name = 'OutlineLayer'
+        self.packed = json.dumps(encode_outlines(polygons))
+        self.style = json.dumps(style)
+
+    def render(self, **kwargs):
+        # the script goes in the figure's script section as it is. a MacroElement would have branca turn it back
+        # into a template of its own, and lexing all that base64 takes longer than everything else put together
+        script = self._script.render(name=self.get_name(), style=self.style, packed=self.packed)
+        self.get_root().script.add_child(_RawScript(script), name=self.get_name())
+
+
+class _ZoomLevels(MacroElement):
+    """
+    Shows each level of detail in a feature group only while the map's zoom is in that level's range.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var levels = [
+                {% for layer, min_zoom, max_zoom in this.levels %}
+                {layer: {{ layer.get_name() }}, min: {{ min_zoom }}, max: {{ max_zoom }}},
+                {% endfor %}
+            ];
+            function showLevel() {
+                var zoom = {{ this._parent.get_name() }}.getZoom();
+                levels.forEach(function(level) {
+                    var wanted = zoom >= level.min && zoom <= level.max;
+                    if (wanted && !{{ this.group.get_name() }}.hasLayer(level.layer)) {
+                        {{ this.group.get_name() }}.addLayer(level.layer);
+                    } else if (!wanted && {{ this.group.get_name() }}.hasLayer(level.layer)) {
+                        {{ this.group.get_name() }}.removeLayer(level.layer);
+                    }
+                });
+            }
+            {{ this._parent.get_name() }}.on('zoomend', showLevel);
+            showLevel();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, group, levels):
+        super().__init__()
+        self.group = group
+        self.levels = levels
+
+
+def _marker_callback(color):
+    # builds the markers in the browser from plain [lat, lon, popup] rows, so the html holds data and not code
+    return f"""
+        function (row) {{
+            var icon = L.AwesomeMarkers.icon({{markerColor: '{color}', icon: 'info-sign', prefix: 'glyphicon'}});
+            var marker = L.marker(new L.LatLng(row[0], row[1]), {{icon: icon}});
+            marker.bindPopup(row[2]);
+            return marker;
+        }}"""
+
+
+def map_lakes_grouped(outline_df: pd.DataFrame,
+                      marker_df: pd.DataFrame,
+                      map_file_name: str = "lake_map.html",
+                      detail_levels=MAP_DETAIL_LEVELS) -> None:
+    """
+    Same map as map_lakes, built so it stays small and quick at statewide scale:
+        - the vertices get grouped by polygon in one pass instead of filtering the dataframe once per lake
+        - all the outlines go in one GeoJSON layer per level of detail, simplified more the further out you zoom
+          (see simplified_outlines), and only the level for the current zoom is shown
+        - the markers are clustered, and built in the browser from their coordinates
+
+    Args:
+        outline_df: the dataframe containing the points you wish to outline
+        marker_df: the dataframe containing the points you wish to save as markers, with a 'detected' column
+        map_file_name: where to save the html
+        detail_levels: list of (min zoom, max zoom, grid size in meters), see MAP_DETAIL_LEVELS
+    """
+    polygons = PolygonStore.from_frame(outline_df)
+
+    map = folium.Map(location=[outline_df['Latitude'].mean(), outline_df['Longitude'].mean()], zoom_start=3)
+    folium.TileLayer(
+        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        attr='Esri',
+        name='Satellite Image',
+        overlay=True
+    ).add_to(map)
+
+    outlines_fg = folium.FeatureGroup(name='Detected Lake Polygons')
+    outlines_fg.add_to(map)
+    levels = []
+    for min_zoom, max_zoom, tolerance_meters in detail_levels:
+        layer = _OutlineLayer(simplified_outlines(polygons, tolerance_meters),
+                              {"color": "red", "weight": 2.5, "opacity": 1, "fill": False})
+        layer.add_to(map)
+        levels.append((layer, min_zoom, max_zoom))
+    _ZoomLevels(outlines_fg, levels).add_to(map)
+
+    detected = marker_df['detected'].to_numpy(dtype=bool)
+    rows = np.column_stack([marker_df['Lat'].to_numpy(dtype=np.float64),
+                            marker_df['Long'].to_numpy(dtype=np.float64)]).tolist()
+    for row, name in zip(rows, marker_df['LakeName'].astype(str)):
+        row.append(f"Known Landable Lake:  {name}")
+
+    for name, color, keep in (("Correctly Marked Lakes", "green", detected),
+                              ("Incorrectly Labeled Lakes", "red", ~detected)):
+        FastMarkerCluster([row for row, wanted in zip(rows, keep) if wanted], callback=_marker_callback(color),
+                          name=name).add_to(map)
+
+    folium.LayerControl().add_to(map)
+    map.save(map_file_name)
@@ -3,6 +3,32 @@ unit test to test some work pat did
 -pat
 """
 from toolbox.polygons import *
+from toolbox.store import PolygonStore, ring_next
+from toolbox.files import (parse_gee_geometries, iter_polygons_from_csv, read_polygons_from_csv, read_polygons_npy,
+                           read_results_npy)
+from toolbox.landability import evaluate_polygons, evaluate_polygon_lengths, verdicts_for_target
+from toolbox.parallel import plan_shards, evaluate_stores_in_parallel
+from toolbox.raster import raster_length_bounds
+from toolbox.bases import nearest_base_per_polygon, nearest_bases, read_faa_facilities
+from toolbox.ingest import AIRPORTS_PATH, LAKES_PATH, ground_truth_key, load_ground_truth, parse_dms
+from toolbox.shapes import detection_by_size, match_destinations, polygon_shapes, polygons_containing
+from toolbox.spatial_index import BoundingBoxGrid
+from toolbox.statistics import generate_positive_identification_statistics
+from toolbox.cache import ResultCache, polygon_key
+from toolbox.manifest import assign_id_block, file_hash, outputs_current, record_file, save_outputs_stamp
+from toolbox.tiling import assign_tiles, polygons_in_tiles, tile_hash, tiles_in_region
+from toolbox.synthetic import GENERATORS, synthetic_lakes, write_gee_csv
+from toolbox.metrics import METRICS
+from toolbox.constants import MATSU_REGION_OF_INTEREST
+from toolbox.visualization import encode_outlines, simplified_outlines
+from benchmarks import compare_to_baseline, environment_differences
+from main import main_function, main_function_incremental, main_function_tiled
+from service import LakeService, MicroBatcher
+from collections import Counter
+import base64
+import json
+import pytest
+import toolbox.polygons
 import os
 
 def test_is_point_in_polygon():
@@ -38,3 +64,757 @@ the desired result was {"inside" if desired_result else "outside"}
 
 
 
+
+
+def meters_to_lat_lon(points, origin=(61.5, -150.0)):
+    """
+    helper to build test polygons in meters around a point in the Mat-Su, returns an array of (lat, lon)
+    """
+    conversion = lat_lon_to_meters(origin)
+    return np.asarray(origin) + np.asarray(points, dtype=float) / conversion
+
+
+def test_exact_engine_rejects_concave_shortcuts():
+    """
+    A 'U' is 1166m corner to corner, but those chords cross the land between the arms. The naive check passes it,
+    the exact one shouldn't. The longest run that stays in the water is the ~1005m diagonal of the bottom bar.
+    """
+    u_shape = meters_to_lat_lon([
+        (0, 0), (1000, 0), (1000, 600), (900, 600), (900, 100), (100, 100), (100, 600), (0, 600), (0, 0)
+    ])
+    strip = meters_to_lat_lon([(0, 0), (1000, 0), (1000, 100), (0, 100), (0, 0)])
+
+    assert has_length_within_polygon_naive(u_shape, 1100) != "Fails"
+    assert has_length_within_polygon_exact(u_shape, 1100) == "Fails"
+    assert has_length_within_polygon_exact(u_shape, 1000) == "Passes"
+    assert has_length_within_polygon_exact(strip, 1000) == "Passes"
+    assert has_length_within_polygon_exact(strip, 1010) == "Fails"
+
+
+def test_exact_engine_respects_holes():
+    """
+    An island in the middle of a square lake blocks the diagonals and the middle lines, so only the runs along
+    the shore are left.
+    """
+    lake = meters_to_lat_lon([(0, 0), (1000, 0), (1000, 1000), (0, 1000), (0, 0)])
+    island = meters_to_lat_lon([(100, 100), (900, 100), (900, 900), (100, 900), (100, 100)])
+
+    assert has_length_within_polygon_exact(lake, 1300) == "Passes"
+    assert has_length_within_polygon_exact(lake, 1300, holes=[island]) == "Fails"
+    assert has_length_within_polygon_exact(lake, 990, holes=[island]) == "Passes"
+
+
+def test_convex_hull_diameter():
+    """
+    The hull diameter of the 'U' is its corner to corner distance, even though that line isn't in the water.
+    """
+    u_shape = meters_to_lat_lon([
+        (0, 0), (1000, 0), (1000, 600), (900, 600), (900, 100), (100, 100), (100, 600), (0, 600), (0, 0)
+    ])
+    square = [(0, 0), (1, 0), (1, 1), (0, 1), (0.5, 0.5)]
+
+    assert len(convex_hull(square)) == 4
+    points = rings_to_meters(u_shape)[0]
+    brute_force = np.hypot(*(points[:, None] - points[None, :]).T).max()
+    assert abs(convex_hull_diameter(u_shape) - brute_force) < 1e-6
+    # the helper builds the 'U' with the scale at its south edge, the polygon is measured at its middle
+    assert abs(convex_hull_diameter(u_shape) - np.hypot(1000, 600)) < 0.1
+
+
+def test_polygon_store_round_trip():
+    """
+    The store should give back the same polygons, in the same order, that went into it.
+    """
+    df = pd.DataFrame({"Polygon": [7, 7, 7, 3, 3, 3, 3, 7],
+                       "Latitude": [0.0, 1.0, 2.0, 10.0, 11.0, 12.0, 13.0, 3.0],
+                       "Longitude": [0.0, -1.0, -2.0, -10.0, -11.0, -12.0, -13.0, -3.0]})
+    store = PolygonStore.from_frame(df)
+
+    assert list(store.ids) == [7, 3]
+    assert list(store.vertex_counts) == [4, 4]
+    assert np.array_equal(store[0][:, 0], [0.0, 1.0, 2.0, 3.0])
+
+    passing = store.subset(np.array([1]))
+    assert list(passing.ids) == [3]
+    assert np.array_equal(passing.to_frame()["Latitude"], [10.0, 11.0, 12.0, 13.0])
+    assert list(raw_vertices_to_df(store)["Polygon"]) == [0] * 4 + [1] * 4
+
+
+def test_parse_gee_geometries_keeps_rings_and_holes():
+    """
+    The first ring passes back through its start point, which used to split it in two. The MultiPolygon has two
+    lakes and the second one has an island.
+    """
+    geo = [
+        '{"type":"Polygon","coordinates":[[[0,0],[2,0],[2,2],[0,0],[0,2],[0,0]]]}',
+        '{"type":"MultiPolygon","coordinates":[[[[5,5],[6,5],[6,6],[5,5]]],'
+        '[[[10,10],[20,10],[20,20],[10,10]],[[12,11],[13,11],[13,12],[12,11]]]]}',
+    ]
+    store = parse_gee_geometries(geo)
+
+    assert list(store.vertex_counts) == [6, 4, 4]
+    assert list(store.features) == [0, 1, 1]
+    assert np.array_equal(store[1][0], [5, 5])  # (lat, lon)
+    assert [len(store.holes(k)) for k in range(3)] == [0, 0, 1]
+    assert np.array_equal(store.holes(2)[0][0], [11, 12])
+
+    # a mangled number has to be an error, not a ring that quietly comes up short
+    with pytest.raises(ValueError):
+        parse_gee_geometries(['{"type":"Polygon","coordinates":[[[0,0],[2,1.2.3],[2,2],[0,0]]]}'])
+
+
+def test_iter_polygons_from_csv_matches_whole_file(tmp_path):
+    """
+    Reading in chunks should give the same polygons and ids as reading the whole file at once.
+    """
+    square = '{{"type":"Polygon","coordinates":[[[{0},0],[{0},1],[{1},1],[{0},0]]]}}'
+    pair = '{{"type":"MultiPolygon","coordinates":[[[[{0},0],[{0},1],[{1},1],[{0},0]]],[[[{0},5],[{0},6],[{1},6],[{0},5]]]]}}'
+    geo = [(pair if k % 3 == 0 else square).format(k, k + 1) for k in range(10)]
+    path = tmp_path / "export.csv"
+    pd.DataFrame({"system:index": range(10), ".geo": geo}).to_csv(path, index=False)
+
+    whole = read_polygons_from_csv(path)
+    chunks = list(iter_polygons_from_csv(path, chunksize=3))
+
+    assert len(chunks) == 4
+    assert np.array_equal(np.concatenate([chunk.ids for chunk in chunks]), whole.ids)
+    assert np.array_equal(np.concatenate([chunk.features for chunk in chunks]), whole.features)
+    assert np.array_equal(np.concatenate([chunk.coordinates for chunk in chunks]), whole.coordinates)
+    assert sum(len(chunk) for chunk in iter_polygons_from_csv(path, chunksize=3, max_polygons=5)) == 5
+
+
+def test_parallel_matches_serial():
+    """
+    The shards have to cover every polygon exactly once, the big polygon gets a shard of its own, and putting the
+    pieces back together gives the same rows and passing positions as the serial loop.
+    """
+    vertex_counts = [np.array([4] * 30 + [400] + [4] * 30), np.array([5, 6]), np.array([], dtype=int)]
+    shards = plan_shards(vertex_counts, workers=2)
+    for file_index, counts in enumerate(vertex_counts):
+        ranges = sorted((start, stop) for index, start, stop, _ in shards if index == file_index)
+        covered = [k for start, stop in ranges for k in range(start, stop)]
+        assert covered == list(range(len(counts)))
+    assert shards[0][:3] == (0, 30, 31)
+
+    polygons = [meters_to_lat_lon(np.array([[0, 0], [size, 0], [size, 100], [0, 100]])) for size in range(100, 1500, 100)]
+    store = PolygonStore.from_vertices(polygons)
+    counts = Counter()
+    serial = evaluate_polygons(store, 700, LANDABILITY_ENGINES['exact'], counts)
+
+    (rows, passing, parallel_counts), = evaluate_stores_in_parallel([store], 700, 'exact', workers=2)
+    assert rows == serial[0]
+    assert passing == serial[1]
+    assert parallel_counts == counts
+
+
+def test_bounding_box_grid_statistics_match_brute_force():
+    """
+    Markers checked through the grid should get the same detected flags as checking every polygon.
+    """
+    rng = np.random.default_rng(0)
+    polygons = [center + rng.uniform(0.1, 1.0) * np.column_stack([np.cos(angles), np.sin(angles)])
+                for center, angles in zip(rng.uniform(0, 20, (60, 2)),
+                                          np.sort(rng.uniform(0, 2 * np.pi, (60, 7)), axis=1))]
+    outline_df = PolygonStore.from_vertices(polygons).to_frame()
+    markers = pd.DataFrame(rng.uniform(-1, 21, (300, 2)), columns=['Lat', 'Long'])
+
+    grid = BoundingBoxGrid.from_store(PolygonStore.from_vertices(polygons))
+    marker_index, polygon_index = grid.candidates(markers.to_numpy())
+    assert len(polygon_index) < len(markers) * len(polygons) / 10
+
+    expected = [int(any(is_point_in_polygon(polygon.tolist(), tuple(point)) for polygon in polygons))
+                for point in markers.to_numpy()]
+    detected = generate_positive_identification_statistics(outline_df, markers)['detected']
+    assert list(detected) == expected
+    assert sum(expected) > 0
+
+
+def test_points_in_polygon_matches_is_point_in_polygon():
+    """
+    The batched check has to agree with is_point_in_polygon everywhere, including points on edges and vertices.
+    """
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        vertices = rng.integers(0, 6, (rng.integers(3, 9), 2)).astype(float)
+        points = np.vstack([rng.integers(-1, 7, (40, 2)), rng.uniform(-1, 7, (40, 2))])
+        expected = [is_point_in_polygon(vertices.tolist(), tuple(point)) for point in points]
+        assert points_in_polygon(vertices, points, block_cells=37).tolist() == expected
+
+    region = [(0, 0), (10, 0), (10, 10), (0, 10)]
+    store = PolygonStore.from_vertices([[(1, 1), (2, 1), (2, 2)],  # inside
+                                        [(20, 20), (21, 20), (21, 21)],  # outside
+                                        [(-5, 5), (15, 5), (15, 6), (-5, 6)],  # crosses, no vertex inside
+                                        [(-1, -1), (11, -1), (11, 11), (-1, 11)]])  # wraps around the region
+    assert polygons_in_region(store, region).tolist() == [True, False, True, True]
+
+
+def test_result_cache_hits_and_evicts_least_recently_used(tmp_path):
+    """
+    A second pass over the same polygons should come entirely from the cache with the same verdicts, and going over
+    the cap should throw out the entries that haven't been used in the longest time.
+    """
+    polygons = [meters_to_lat_lon(np.array([[0, 0], [size, 0], [size, 100], [0, 100]])) for size in range(600, 1000, 100)]
+    store = PolygonStore.from_vertices(polygons)
+    path = tmp_path / "cache.sqlite"
+
+    results = []
+    for _ in range(2):
+        counts = Counter()
+        with ResultCache(path) as cache:
+            results.append(evaluate_polygons(store, 750, has_length_within_polygon_exact, counts, cache=cache))
+    assert results[0] == results[1]
+    assert counts['cache_hits'] == 2 and counts['engine'] == counts['cache_misses'] == 0  # the others fail the hull check
+    assert counts['hull'] + counts['cache_hits'] == counts['passed'] + counts['failed'] == len(polygons)
+
+    assert polygon_key(polygons[0], [], 750, 'a') != polygon_key(polygons[0], [], 751, 'a')
+    assert polygon_key(polygons[0], [], 750, 'a') != polygon_key(polygons[0], [polygons[1]], 750, 'a')
+
+    with ResultCache(tmp_path / "small.sqlite", max_entries=2) as cache:
+        for key in [b'a', b'b']:
+            cache.put(key, "Fails")
+        cache.flush()
+        cache.get(b'a')  # b is now the oldest
+        cache.flush()
+        cache.put(b'c', "Passes")
+        cache.flush()
+        assert len(cache) == 2
+        assert cache.get(b'b') is None and cache.get(b'a') == "Fails" and cache.get(b'c') == "Passes"
+
+
+def test_length_sweep_matches_single_target_runs():
+    """
+    Measuring each polygon once and looking the verdicts up should agree with running every target on its own.
+    """
+    u_shape = meters_to_lat_lon([
+        (0, 0), (1000, 0), (1000, 600), (900, 600), (900, 100), (100, 100), (100, 600), (0, 600), (0, 0)
+    ])
+    strips = [meters_to_lat_lon([(0, 0), (size, 0), (size, 100), (0, 100)]) for size in (300, 700, 1200)]
+    store = PolygonStore.from_vertices([u_shape] + strips)
+    targets = [250, 600, 1004, 1100]
+
+    # corner of the bar, through the inside corner of the arm and on to the far wall
+    assert abs(longest_length_within_polygon_exact(u_shape) - np.hypot(1000, 1000 / 9)) < 1
+
+    for engine in LANDABILITY_ENGINES:
+        lengths = evaluate_polygon_lengths(store, engine, cap_meters=max(targets), floor_meters=min(targets))
+        for target in targets:
+            rows, _ = evaluate_polygons(store, target, LANDABILITY_ENGINES[engine], Counter())
+            assert list(verdicts_for_target(lengths, target, engine)) == [row[3] for row in rows]
+
+
+def test_manifest_id_blocks_stay_put():
+    """
+    Files keep their block of polygon ids when they're rerun and still fit. One that outgrows its block moves to
+    the end without moving anybody else, and the last block can just grow.
+    """
+    manifest = {'files': {}}
+    for csv_file, count in [('a.csv', 10), ('b.csv', 5), ('c.csv', 7)]:
+        record_file(manifest, csv_file, 'hash', 'out', assign_id_block(manifest, csv_file, count), count)
+    assert [manifest['files'][name]['first_id'] for name in ('a.csv', 'b.csv', 'c.csv')] == [1, 11, 16]
+
+    assert assign_id_block(manifest, 'b.csv', 3) == 11
+    assert assign_id_block(manifest, 'b.csv', 6) == 23
+    assert assign_id_block(manifest, 'c.csv', 50) == 16
+    assert assign_id_block(manifest, 'd.csv', 1) == 23
+
+
+def test_simplification_never_turns_a_fail_into_a_pass():
+    """
+    The strip has two 6m spikes of land, one from each side, that block every long line. Simplifying at 8m smooths
+    them away, so the simplified strip passes, but the full check on the original has to bring it back to a fail. A pixel staircase should lose
+    most of its vertices.
+    """
+    dented = meters_to_lat_lon([(0, 0), (502, 0), (505, 6), (508, 0), (1000, 0), (1000, 10),
+                                (503, 10), (500, 4), (497, 10), (0, 10), (0, 0)])
+    assert len(simplify_ring(dented, 8)) == 5
+    assert has_length_within_polygon_exact(simplify_ring(dented, 8), 990) == "Passes"
+    assert has_length_within_polygon_exact(dented, 990) == "Fails"
+    assert has_length_within_polygon_simplified(dented, 990, has_length_within_polygon_exact, 8)[0] == "Fails"
+
+    steps = np.arange(0, 1000, 10)
+    staircase = meters_to_lat_lon(np.concatenate([np.column_stack([np.repeat(steps, 2)[1:], np.repeat(steps, 2)[:-1]]),
+                                                  [(990, 0), (0, 0)]]))
+    solution, searched = has_length_within_polygon_simplified(staircase, 500, has_length_within_polygon_exact, 10)
+    assert solution == has_length_within_polygon_exact(staircase, 500) == "Passes"
+    assert searched < len(staircase) / 10
+
+
+def test_tiles_cover_the_region_and_own_each_polygon_once():
+    """
+    An L shaped region two tiles wide leaves out the corner tile it doesn't touch. A polygon belongs to the tile with
+    the middle of its box in it, even when it spills over into the next tile.
+    """
+    region = [(0.1, 0.1), (0.9, 0.1), (0.9, 0.4), (0.4, 0.4), (0.4, 0.9), (0.1, 0.9)]
+    assert sorted(tiles_in_region(region, 0.5)) == ['0_0', '0_1', '1_0']
+    assert tiles_in_region(region, 0.5)['0_1'] == (0.0, 0.5, 0.5, 1.0)
+
+    store = PolygonStore.from_vertices([[(0.2, 0.2), (0.3, 0.2), (0.3, 0.3)],
+                                        [(0.2, 0.45), (0.3, 0.45), (0.3, 0.7)],
+                                        [(-0.3, -0.2), (-0.1, -0.2), (-0.1, -0.1)]])
+    assert list(assign_tiles(store, 0.5)) == ['0_0', '0_1', '-1_-1']
+
+    pieces = [('a.csv', np.arange(3), store)]
+    assert tile_hash(pieces, {'target_meters': 500}) == tile_hash(pieces, {'target_meters': 500})
+    assert tile_hash(pieces, {'target_meters': 500}) != tile_hash(pieces, {'target_meters': 600})
+    assert tile_hash(pieces, {}) != tile_hash([('a.csv', np.arange(1, 4), store)], {})
+
+
+def test_tiled_run_matches_main_function_and_skips_files_outside_the_tiles(tmp_path):
+    """
+    Running by tiles should pass the same polygons as running each file with the region, and a file with nothing in
+    the tiles that were asked for (a statewide export when only one borough is run) should just come back empty.
+    """
+    inside, outside = tmp_path / "inside.csv", tmp_path / "outside.csv"
+    write_gee_csv(inside, synthetic_lakes("jagged", 6, 40) + synthetic_lakes("thin_s", 3, 60, seed=2))
+    write_gee_csv(outside, [lake + np.array([10.0, 0.0]) for lake in synthetic_lakes("convex", 4, 30)])
+
+    expected = main_function(polygons_path=str(inside), region=MATSU_REGION_OF_INTEREST)
+    assert len(expected)
+    # small chunks split the files mid way, and the last run reads the saved tiles back
+    for tiles_dir, chunksize in [(None, 10_000), (tmp_path / "tiles", 4), (tmp_path / "tiles", 4)]:
+        passing = main_function_tiled([str(inside), str(outside)], tiles_dir=tiles_dir, chunksize=chunksize)
+        assert len(passing) == 2 and passing[1].empty
+        pd.testing.assert_frame_equal(passing[0], expected)
+
+    store = read_polygons_from_csv(str(inside))
+    used = set(assign_tiles(store))
+    one = sorted(used)[0]
+    positions, names = polygons_in_tiles(store, MATSU_REGION_OF_INTEREST,
+                                         {one: tiles_in_region(MATSU_REGION_OF_INTEREST)[one]})
+    assert set(names) == {one} and np.array_equal(positions, np.flatnonzero(assign_tiles(store) == one))
+    unused = [tile for tile in tiles_in_region(MATSU_REGION_OF_INTEREST) if tile not in used][:1]
+    passing = main_function_tiled([str(inside), str(outside)], tiles=unused)
+    assert len(passing) == 2 and all(frame.empty for frame in passing)
+    assert list(passing[0].columns) == ['Polygon', 'Latitude', 'Longitude']
+
+
+def test_incremental_run_only_redoes_changed_files(tmp_path):
+    """
+    A second run with nothing changed shouldn't process anything and gives back the same polygons. Editing one file
+    only reprocesses that one, and the other files keep their polygon ids. A file with nothing in the region is fine.
+    The outputs made from the results are stale as soon as an input changes or one of them goes missing.
+    """
+    paths = [tmp_path / name for name in ["a.csv", "b.csv", "outside.csv"]]
+    write_gee_csv(paths[0], synthetic_lakes("jagged", 6, 40))
+    write_gee_csv(paths[1], synthetic_lakes("thin_s", 4, 60, seed=2))
+    write_gee_csv(paths[2], [lake + np.array([10.0, 0.0]) for lake in synthetic_lakes("convex", 3, 30)])
+    csv_list = [str(path) for path in paths]
+    options = dict(manifest_path=str(tmp_path / "manifest.json"), output_dir=str(tmp_path / "successful"),
+                   region=MATSU_REGION_OF_INTEREST)
+
+    first, changed = main_function_incremental(csv_list, **options)
+    assert changed == csv_list and len(first[0]) and len(first[1]) and first[2].empty
+    again, changed = main_function_incremental(csv_list, **options)
+    assert changed == []
+    for before, after in zip(first, again):
+        pd.testing.assert_frame_equal(before, after, check_dtype=False)
+
+    write_gee_csv(paths[1], synthetic_lakes("thin_s", 5, 60, seed=3))
+    edited, changed = main_function_incremental(csv_list, **options)
+    assert changed == [csv_list[1]]
+    pd.testing.assert_frame_equal(edited[0], first[0])
+    assert set(edited[1]['Polygon']).isdisjoint(edited[0]['Polygon'])
+
+    stamp, outputs = tmp_path / "outputs.json", [tmp_path / "map.html"]
+    inputs = {'lake results': file_hash(options['manifest_path']), 'ground truth': 'abc'}
+    assert not outputs_current(stamp, inputs, outputs)
+    outputs[0].write_text("map")
+    save_outputs_stamp(stamp, inputs)
+    assert outputs_current(stamp, inputs, outputs)
+    assert not outputs_current(stamp, {**inputs, 'ground truth': 'abd'}, outputs)
+    outputs[0].unlink()
+    assert not outputs_current(stamp, inputs, outputs)
+
+
+def test_synthetic_lakes_and_baseline_comparison():
+    """
+    The generators have to give closed rings with exactly the vertex count asked for, and the thin S is the shape the
+    naive engine gets wrong. Only cases that got a lot slower (and not just by noise) count as regressions.
+    """
+    for shape in GENERATORS:
+        for num_vertices in (51, 200):
+            lake = synthetic_lakes(shape, 1, num_vertices)[0]
+            assert len(lake) == num_vertices
+            assert np.array_equal(lake[0], lake[-1])
+
+    s_shape = synthetic_lakes("thin_s", 1, 200)[0]
+    target = 0.9 * convex_hull_diameter(s_shape)
+    assert has_length_within_polygon_naive(s_shape, target) != "Fails"
+    assert has_length_within_polygon_exact(s_shape, target) == "Fails"
+
+    baseline = {"fast": 0.001, "slow": 1.0, "gone": 1.0}
+    timings = {"fast": 0.003, "slow": 1.6, "new": 5.0}
+    assert compare_to_baseline(timings, baseline) == [("slow", 1.0, 1.6)]
+
+    recorded = {"python": "3.11.7", "numpy": "1.26.4", "pandas": "2.1.4", "machine": "x86_64"}
+    assert environment_differences(dict(recorded), recorded) == []
+    assert environment_differences(dict(recorded, numpy="2.4.6"), recorded) == [("numpy", "1.26.4", "2.4.6")]
+
+
+def test_metrics_record_only_when_enabled(tmp_path):
+    """
+    The metrics should stay empty while they're off, and once on, the workers' numbers should add up to the serial
+    run's.
+    """
+    polygons = synthetic_lakes("jagged", 6, 50) + synthetic_lakes("thin_s", 4, 60, seed=1)
+    store = PolygonStore.from_vertices(polygons)
+
+    METRICS.reset()
+    evaluate_polygons(store, 500, LANDABILITY_ENGINES['naive'], Counter())
+    assert METRICS.snapshot()['counters'] == {}
+
+    try:
+        METRICS.enable()
+        evaluate_polygons(store, 500, LANDABILITY_ENGINES['naive'], Counter())
+        serial = METRICS.snapshot()
+        assert serial['counters']['polygons'] == len(polygons)
+        assert serial['counters']['vertices'] == sum(len(vertices) for vertices in polygons)
+        assert sum(serial['vertex_histogram'].values()) == len(polygons)
+        assert 0 < serial['rates']['naive.early_exit_rate'] <= 1
+        assert serial['calls']['landability'] == 1
+
+        METRICS.reset()
+        evaluate_stores_in_parallel([store], 500, 'naive', workers=2)
+        assert METRICS.snapshot()['counters'] == serial['counters']
+
+        METRICS.export_json(tmp_path / "metrics.json")
+        with open(tmp_path / "metrics.json") as file:
+            assert json.load(file)['counters'] == serial['counters']
+    finally:
+        METRICS.enable(False)
+        METRICS.reset()
+
+
+def test_simplified_outlines_and_encoding():
+    """
+    Snapping should only keep original vertices (plus the closing one), squash lakes smaller than the grid to one
+    point, and the packed outlines should unpack back to the same coordinates.
+    """
+    # plus a 2 m square pond in the middle of a 50 m grid cell
+    conversion = lat_lon_to_meters(np.array([61.5, -150.0]))
+    middle = (np.floor(np.array([61.5, -150.0]) * conversion / 50) + 0.5) * 50 / conversion
+    pond = middle + np.array([[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]) / conversion
+    lakes = synthetic_lakes("jagged", 4, 300) + [pond]
+    store = PolygonStore.from_vertices(lakes)
+
+    assert np.array_equal(simplified_outlines(store, 0).coordinates, store.coordinates)
+
+    simple = simplified_outlines(store, 50.0)
+    assert np.array_equal(simple.ids, store.ids)
+    for k in range(4):
+        assert 4 <= len(simple[k]) < len(store[k])
+        assert np.array_equal(simple[k][[0, -1]], store[k][[0, -1]])
+        assert (simple[k][:, None] == store[k][None]).all(axis=2).any(axis=1).all()
+    assert len(simple[4]) == 1 and np.allclose(simple[4][0], store[4].mean(axis=0))
+
+    packed = encode_outlines(simple)
+    counts = np.frombuffer(base64.b64decode(packed['counts']), dtype='<i4')
+    deltas = np.frombuffer(base64.b64decode(packed['coordinates']), dtype='<i4').reshape(-1, 2)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    unpacked = np.cumsum(deltas, axis=0)
+    unpacked -= np.concatenate([[[0, 0]], unpacked[np.cumsum(counts)[:-1] - 1]])[owner]
+    assert np.array_equal(counts, simple.vertex_counts)
+    assert np.allclose(unpacked / packed['scale'], simple.coordinates, atol=1e-5)
+
+
+def test_binary_outputs_match_csv_outputs(tmp_path):
+    """
+    Writing the outputs as .npy should hold the same results and passing vertices as the csvs, and map back in
+    without reading everything.
+    """
+    path = tmp_path / "lakes.csv"
+    write_gee_csv(path, synthetic_lakes("jagged", 12, 40) + synthetic_lakes("thin_s", 5, 60, seed=2))
+
+    csv_passing = main_function(polygons_path=str(path), results_path=str(tmp_path / "out.csv"),
+                                export_successful=True)
+    npy_passing = main_function(polygons_path=str(path), results_path=str(tmp_path / "out.npy"),
+                                export_successful=True)
+    pd.testing.assert_frame_equal(csv_passing, npy_passing)
+
+    records = read_results_npy(tmp_path / "out.npy")
+    assert isinstance(records, np.memmap)
+    pd.testing.assert_frame_equal(pd.DataFrame(records), pd.read_csv(tmp_path / "out.csv"), check_dtype=False)
+
+    store = read_polygons_npy(tmp_path / "out_vertices")
+    assert not store.coordinates.flags.writeable  # still the read only map of the file
+    vertices = pd.read_csv(tmp_path / "out_vertices.csv")
+    assert np.allclose(store.coordinates, vertices[['Latitude', 'Longitude']].to_numpy())
+    assert np.array_equal(store.subset([1])[0], store[1])
+
+
+def test_file_outside_the_region_gives_empty_outputs(tmp_path):
+    """
+    A GEE export with nothing in the region of interest (or nothing at all) should come back as an empty frame in
+    Kai's format instead of crashing on the missing surrounding polygon.
+    """
+    outside = tmp_path / "outside.csv"
+    write_gee_csv(outside, [lake + np.array([10.0, 0.0]) for lake in synthetic_lakes("convex", 5, 30)])
+    empty = tmp_path / "empty.csv"
+    write_gee_csv(empty, [])
+
+    for path in [outside, empty]:
+        passing = main_function(polygons_path=str(path), results_path=str(tmp_path / "out.csv"),
+                                export_successful=True, region=MATSU_REGION_OF_INTEREST)
+        assert passing.empty and list(passing.columns) == ['Polygon', 'Latitude', 'Longitude']
+        assert pd.read_csv(tmp_path / "out.csv").empty
+
+
+def test_lake_service_answers_match_the_pipeline(tmp_path):
+    """
+    The service should give the same verdicts as evaluate_polygons no matter what order the targets are asked in,
+    and answer a batch of mixed requests in order.
+    """
+    paths = [tmp_path / "a.csv", tmp_path / "b.csv"]
+    write_gee_csv(paths[0], synthetic_lakes("jagged", 9, 40))
+    write_gee_csv(paths[1], synthetic_lakes("thin_s", 6, 60, seed=3))
+    service = LakeService([str(path) for path in paths], engine='exact')
+    assert len(service.polygons) == 15 and list(service.files).count(str(paths[1])) == 6
+
+    for target in (1500, 500, 2500, 1000, 1500):
+        _, passing = evaluate_polygons(service.polygons, target, LANDABILITY_ENGINES['exact'], Counter())
+        assert list(service.landable(target)) == passing
+
+    vertices = service.polygons[10]
+    responses = service.handle_batch([
+        {'id': 'a', 'op': 'check', 'target_meters': 1000, 'vertices': vertices.tolist()},
+        {'id': 'b', 'op': 'check', 'target_meters': 1000, 'point': service.polygons[0].mean(axis=0).tolist()},
+        {'id': 'c', 'op': 'landable', 'target_meters': 1000},
+        {'id': 'd', 'op': 'check', 'target_meters': 1000, 'vertices': vertices[:2].tolist()},
+    ])
+    assert [response['id'] for response in responses] == ['a', 'b', 'c', 'd']
+    assert responses[0]['result'] == has_length_within_polygon_exact(vertices, 1000)
+    assert responses[2]['count'] == len(service.landable(1000))
+    assert responses[1]['lake']['polygon'] == 0
+    assert (responses[1]['result'] == "Passes") == (0 in service.landable(1000))
+    assert 'error' in responses[3]
+
+    # the naive engine's "Passes*" comes back as it is, for a loaded lake too
+    longest_edge = polygon_shapes(service.polygons)['Edge Max'][0]
+    response, = service.handle_batch([{'op': 'check', 'engine': 'naive', 'target_meters': longest_edge / 2,
+                                       'point': service.polygons[0].mean(axis=0).tolist()}])
+    assert response['result'] == "Passes*" == has_length_within_polygon_naive(service.polygons[0], longest_edge / 2)
+
+    # when a whole batch blows up, every error still says which request it's for
+    def broken(requests):
+        raise RuntimeError("boom")
+    batcher = MicroBatcher(broken, max_wait_seconds=0.05)
+    futures = [batcher.submit({'id': name, 'op': 'landable', 'target_meters': 500}) for name in 'xy']
+    batcher.close()
+    assert [future.result() for future in futures] == [{'id': name, 'error': "RuntimeError: boom"} for name in 'xy']
+
+
+def test_long_chords_first_search_matches_the_plain_scan():
+    """
+    Trying the far apart pairs first shouldn't change any verdict, and a search that runs out of budget says
+    "Fails*" instead of guessing.
+    """
+    # a big ellipse whose long diagonal sits at high indices, so the plain scan only finds it near the end
+    angles = np.linspace(0, 2 * np.pi, 1201)
+    lake = np.column_stack([61 + 0.02 * np.sin(angles), -150 + 0.01 * np.cos(angles)])
+    lake = np.vstack([np.roll(lake[:-1], 900, axis=0), np.roll(lake[:-1], 900, axis=0)[:1]])
+    lakes = [lake] + synthetic_lakes("jagged", 4, 300) + synthetic_lakes("thin_s", 2, 200, seed=2)
+
+    for vertices in lakes:
+        for target in (300, 1000, 2500, 4440, 4450):
+            plain = has_length_within_polygon_naive(vertices, target, ordered=False)
+            assert has_length_within_polygon_naive(vertices, target, block_size=4096) == plain
+    for vertices in lakes[1:]:
+        for target in (300, 1000, 2500):
+            assert has_length_within_polygon_exact(vertices, target) == has_length_within_polygon_exact(
+                vertices, target, block_cells=1 << 14)
+
+    i, j = far_vertex_pairs(rings_to_meters(lake)[0])
+    assert (i < j).all() and len(i) <= 10
+    assert has_length_within_polygon_naive(lake, 4450, ordered=False, max_pairs=1000) == "Fails*"
+    assert has_length_within_polygon_naive(lake, 4440, max_pairs=0) == "Passes"
+
+    # the thin 'S' is long enough end to end, but only the full search can tell it has no long straight line
+    counts = Counter()
+    results, passing = evaluate_polygons(PolygonStore.from_vertices(lakes[-1:]), 2500, has_length_within_polygon_exact,
+                                         counts, budget_seconds=0.0)
+    assert results[0][3] == "Fails*" and passing == [] and counts['out_of_budget'] == 1 and counts['failed'] == 1
+
+
+def test_raster_bounds_bracket_the_exact_length():
+    """
+    The scanline runs are real lines inside the polygon and the widths can't miss the diameter, so the exact longest
+    line has to land between the two bounds. The raster engine should then give the exact engine's verdicts.
+    """
+    lake = meters_to_lat_lon([(0, 0), (1000, 0), (1000, 1000), (0, 1000), (0, 0)])
+    island = meters_to_lat_lon([(100, 100), (900, 100), (900, 900), (100, 900), (100, 100)])
+    store = PolygonStore.concatenate([
+        PolygonStore(lake, [0, len(lake)], hole_coordinates=island, hole_offsets=[0, len(island)], hole_owners=[0]),
+        PolygonStore.from_vertices(synthetic_lakes("star", 3, 41) + synthetic_lakes("thin_s", 3, 80, seed=1)),
+        PolygonStore.from_vertices([meters_to_lat_lon([(0, 0), (0.5, 0), (0.5, 0.5), (0, 0)])]),  # gee noise
+    ])
+
+    lower, upper = raster_length_bounds(store, resolution_meters=5.0, block_cells=5000)
+    exact = np.array([longest_length_within_polygon_exact(store[k], holes=store.holes(k)) for k in range(len(store))])
+    assert (lower <= exact + 1e-6).all() and (exact <= upper + 1e-6).all()
+    assert (upper - lower < 0.1 * upper)[1:4].all()  # the widths know nothing about the island
+    assert lower[-1] == 0 and upper[-1] < 1
+
+    for target in (300, 995, 1500):
+        raster_counts = Counter()
+        raster_results, _ = evaluate_polygons(store, target, LANDABILITY_ENGINES['raster'], raster_counts)
+        exact_results, _ = evaluate_polygons(store, target, LANDABILITY_ENGINES['exact'], Counter())
+        assert raster_results == exact_results
+        assert raster_counts['raster'] > 0
+        assert [has_length_within_polygon_raster(store[k], target, holes=store.holes(k)) for k in range(len(store))] \
+            == [row[3] for row in exact_results]
+
+
+def test_projection_in_one_pass_matches_per_polygon_and_haversine(monkeypatch):
+    """
+    The store's meters should be the same numbers rings_to_meters gives one polygon at a time, and measuring from
+    the middle latitude should stay close to the haversine distances even for a long north-south lake. The engines
+    work on the store's rings instead of projecting every polygon again.
+    """
+    long_lake = meters_to_lat_lon([(0, 0), (20_000, 0), (20_000, 5000), (0, 5000), (0, 0)])
+    lake = meters_to_lat_lon([(0, 0), (1000, 0), (1000, 1000), (0, 1000), (0, 0)])
+    island = meters_to_lat_lon([(100, 100), (900, 100), (900, 900), (100, 900), (100, 100)])
+    store = PolygonStore.concatenate([
+        PolygonStore.from_vertices([long_lake]),
+        PolygonStore(lake, [0, len(lake)], hole_coordinates=island, hole_offsets=[0, len(island)], hole_owners=[0]),
+        PolygonStore.from_vertices(synthetic_lakes("jagged", 3, 50)),
+    ])
+
+    meters, hole_meters = store.in_meters()
+    assert store.in_meters()[0] is meters  # kept, not worked out again
+    for k in range(len(store)):
+        rings = rings_to_meters(store[k], store.holes(k))
+        assert np.allclose(meters[store.offsets[k]:store.offsets[k + 1]], rings[0], atol=1e-9)
+    assert np.allclose(hole_meters, rings_to_meters(lake, [island])[1], atol=1e-9)
+
+    errors = projection_errors(store.coordinates, meters, store.offsets)
+    assert (errors < 2e-3).all()  # mostly the gap between 111,120 m per degree and the haversine earth
+    first_vertex_scale = (long_lake - long_lake[0]) * lat_lon_to_meters(long_lake[0])
+    assert errors[0] < projection_errors(long_lake, first_vertex_scale, np.array([0, len(long_lake)]))[0]
+
+    runs = [(engine, simplify) for engine in LANDABILITY_ENGINES for simplify in (None, 5)]
+    expected = [evaluate_polygons(store, 900, LANDABILITY_ENGINES[engine], Counter(), simplify_meters=simplify)
+                for engine, simplify in runs]
+    lengths = evaluate_polygon_lengths(store, 'exact')
+
+    def projected_again(*args, **kwargs):
+        raise AssertionError("a polygon got projected again")
+    monkeypatch.setattr(toolbox.polygons, 'rings_to_meters', projected_again)
+    for (engine, simplify), before in zip(runs, expected):
+        assert evaluate_polygons(store, 900, LANDABILITY_ENGINES[engine], Counter(), simplify_meters=simplify) == before
+    pd.testing.assert_frame_equal(evaluate_polygon_lengths(store, 'exact'), lengths)
+
+
+def test_nearest_base_matches_brute_force_haversine():
+    """
+    The tree should find the same base, at the same great circle distance, as measuring every lake against every
+    base. The facility coordinates in seconds should agree with the DMS ones.
+    """
+    bases = read_faa_facilities()
+    assert len(bases) and (bases['Type'] == "SEAPLANE BASE").all()
+    assert len(read_faa_facilities(types=None)) > len(bases)
+    lake_hood = bases[bases['LocationID'] == 'LHD'].iloc[0]
+    assert abs(lake_hood['Lat'] - (61 + 10 / 60 + 53.9 / 3600)) < 1e-9 and lake_hood['Long'] < -149
+
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(55, 70, 500), rng.uniform(-170, -130, 500)])
+    positions, distances = nearest_bases(points, bases)
+    brute_force = haversine(points[:, None, 0], points[:, None, 1], bases['Lat'].to_numpy()[None],
+                            bases['Long'].to_numpy()[None])
+    assert np.array_equal(positions, brute_force.argmin(axis=1))
+    assert np.allclose(distances, brute_force.min(axis=1), rtol=0, atol=1e-3)
+
+    df = PolygonStore.from_vertices(synthetic_lakes("convex", 3, 20), ids=[5, 6, 7]).to_frame()
+    by_base = nearest_base_per_polygon(df, bases)
+    assert sorted(by_base['Polygon']) == [5, 6, 7] and by_base['BaseDistance'].is_monotonic_increasing
+    center = df[df['Polygon'] == by_base['Polygon'][0]][['Latitude', 'Longitude']].mean().to_numpy()
+    assert np.isclose(by_base['BaseDistance'][0], nearest_bases(center, bases)[1][0])
+
+
+def test_ground_truth_parses_dms_and_caches_by_file_hash(tmp_path):
+    """
+    The column at a time DMS parser should match the old one row at a time dms_to_decimal, a facility listed twice
+    should only show up once, and the cached table should come back the same until one of the csvs changes.
+    """
+    def dms_to_decimal(dms):
+        degrees, minutes, rest = dms.split('-')
+        decimal = float(degrees) + float(minutes) / 60 + float(rest[:-1]) / 3600
+        return -decimal if rest[-1] in ['S', 'W'] else decimal
+
+    airports = pd.read_csv(AIRPORTS_PATH, dtype=str)
+    for column in ['ARPLatitude', 'ARPLongitude']:
+        assert np.allclose(parse_dms(airports[column]), airports[column].apply(dms_to_decimal), rtol=0, atol=1e-12)
+    assert np.isnan(parse_dms(pd.Series(['not a coordinate']))).all()
+
+    lakes_path, airports_path = tmp_path / "lakes.csv", tmp_path / "airports.csv"
+    pd.read_csv(LAKES_PATH).head(50).to_csv(lakes_path, index=False)
+    pd.concat([airports.head(40), airports.head(5)]).to_csv(airports_path, index=False)
+
+    built = load_ground_truth(lakes_path, airports_path, cache_dir=tmp_path, overrides_path=None)
+    assert len(built) == 90 and list(built.columns) == ['Lat', 'Long', 'floatplanes', 'LakeName']
+    assert built['floatplanes'].sum() == 50 + (airports.head(40)['Type'] == "SEAPLANE BASE").sum()
+    cached = load_ground_truth(lakes_path, airports_path, cache_dir=tmp_path, overrides_path=None)
+    pd.testing.assert_frame_equal(cached, built)
+
+    key = ground_truth_key(lakes_path, airports_path, overrides_path=None)
+    assert ground_truth_key(lakes_path, airports_path) != key
+    pd.read_csv(LAKES_PATH).head(60).to_csv(lakes_path, index=False)
+    assert ground_truth_key(lakes_path, airports_path, overrides_path=None) != key
+    assert len(load_ground_truth(lakes_path, airports_path, cache_dir=tmp_path, overrides_path=None)) == 100
+    assert len(list(tmp_path.glob("ground_truth_*.npy"))) == 1
+
+    # with the overrides applied the table is the hand edited cleaned.csv again, apart from the WASILLA LAKE typo
+    # written down in toolbox/ingest.py
+    rounded = ['Lat', 'Long', 'floatplanes']
+    full = load_ground_truth(cache_dir=None).round({'Lat': 5, 'Long': 5})
+    cleaned = pd.read_csv(os.path.join(os.path.dirname(LAKES_PATH), "cleaned.csv")).round({'Lat': 5, 'Long': 5})
+    assert (len(full), len(cleaned), len(full[rounded].merge(cleaned[rounded]))) == (1467, 1467, 1466)
+    assert len(load_ground_truth(cache_dir=None, overrides_path=None)) == 1488
+
+
+def test_polygon_shapes_and_destination_matching():
+    """
+    The batched shape numbers should match measuring each polygon on its own (a 1000 x 600 m rectangle with a
+    200 x 100 m hole has 580,000 square meters of water), the batched containment should agree with points_in_polygon,
+    and a destination should get the polygon it's in, or a close one of about its size.
+    """
+    rectangle = meters_to_lat_lon([(0, 0), (1000, 0), (1000, 600), (0, 600)])
+    hole = meters_to_lat_lon([(400, 200), (600, 200), (600, 300), (400, 300)])
+    lakes = synthetic_lakes("star", 30, 40, seed=3)
+    store = PolygonStore.concatenate([PolygonStore(rectangle, [0, 4], [100], hole, [0, 4], [0]),
+                                      PolygonStore.from_vertices(lakes)])
+    shapes = polygon_shapes(store)
+
+    assert ring_next([0, 3, 3, 5]).tolist() == [1, 2, 0, 4, 3]  # the empty ring in the middle has no edges
+    assert abs(shapes['Area'][0] - 580000) < 600 and abs(shapes['Perimeter'][0] - 3200) < 2
+    assert abs(shapes['Compactness'][0] - 4 * np.pi * shapes['Area'][0] / shapes['Perimeter'][0] ** 2) < 1e-12
+    meters, _ = store.in_meters()
+    for position in range(1, len(store)):
+        points = meters[store.offsets[position]:store.offsets[position + 1]]
+        edges = planar_edge_lengths(points)
+        x, y = points.T
+        expected = [np.sum(edges), np.mean(edges), np.std(edges), np.max(edges),
+                    abs(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2]
+        row = shapes.iloc[position]
+        assert np.allclose([row['Perimeter'], row['Edge Mean'], row['Edge Std'], row['Edge Max'], row['Area']],
+                           expected, rtol=1e-9)
+
+    rng = np.random.default_rng(1)
+    low, high = store.coordinates.min(axis=0), store.coordinates.max(axis=0)
+    points = rng.uniform(low, high, size=(3000, 2))
+    point_index, polygon_index = polygons_containing(store, points, block_cells=500)
+    pairs = set(zip(point_index.tolist(), polygon_index.tolist()))
+    assert pairs == {(p, k) for k in range(len(store)) for p in np.flatnonzero(points_in_polygon(store[k], points))}
+
+    # just past the tip of a star, a bit smaller than the star says it is
+    center = store[3].mean(axis=0)
+    ring = meters[store.offsets[3]:store.offsets[4]]
+    tip = store[3][np.argmax(np.hypot(*(ring - ring.mean(axis=0)).T))]
+    past_tip = center + 1.05 * (tip - center)
+    destinations = pd.DataFrame({'Lat': [rectangle[:, 0].mean(), past_tip[0], 70.0],
+                                 'Long': [rectangle[:, 1].mean() + 0.003, past_tip[1], -150.0],
+                                 'Dest_sqkm': [0.5, 2 * shapes['Area'][3] / 1e6, 1.0], 'Flights': [5, 10, 20]})
+    matches = match_destinations(store, destinations, shapes)
+    assert matches['Match'].tolist() == ['inside', 'nearby', '']
+    assert matches['Polygon'].tolist()[:2] == [100, store.ids[3]]
+    summary = detection_by_size(matches)
+    assert summary['Destinations'].sum() == 3 and summary['Detected'].sum() == 2